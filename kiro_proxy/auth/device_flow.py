@@ -12,7 +12,6 @@ Social Auth (Google/GitHub):
 3. 启动本地回调服务器接收授权码
 4. 用授权码交换 Token
 """
-import json
 import time
 import httpx
 import secrets
@@ -294,8 +293,8 @@ async def save_credentials_to_file(credentials: dict, name: str = "kiro-proxy-au
     # 生成文件名
     file_path = cache_dir / f"{name}.json"
     
-    with open(file_path, "w") as f:
-        json.dump(credentials, f, indent=2)
+    from ..core.persistence import atomic_write_json
+    atomic_write_json(file_path, credentials)
     
     print(f"[DeviceFlow] 凭证已保存到: {file_path}")
     return str(file_path)
@@ -9,6 +9,10 @@ from pathlib import Path
 
 def cmd_serve(args):
     """启动代理服务"""
+    if args.workers > 1:
+        from .prefork import serve
+        serve(port=args.port, workers=args.workers)
+        return
     from .main import run
     run(port=args.port)
 
@@ -173,7 +177,7 @@ def cmd_accounts_import(args):
             token_path=file_path,
             enabled=acc_data.get("enabled", True)
         )
-        state.accounts.append(account)
+        state.add_account(account)
         account.load_credentials()
         imported += 1
         print(f"已导入: {account.name}")
@@ -215,7 +219,7 @@ def cmd_accounts_add(args):
         name=name,
         token_path=file_path
     )
-    state.accounts.append(account)
+    state.add_account(account)
     account.load_credentials()
     state._save_accounts()
     
@@ -261,7 +265,7 @@ def cmd_accounts_scan(args):
                     name=t["name"],
                     token_path=t["path"]
                 )
-                state.accounts.append(account)
+                state.add_account(account)
                 account.load_credentials()
                 added += 1
         state._save_accounts()
@@ -338,7 +342,7 @@ def cmd_login_social(args):
                 name=f"{provider.title()} 登录",
                 token_path=file_path
             )
-            state.accounts.append(account)
+            state.add_account(account)
             account.load_credentials()
             state._save_accounts()
             
@@ -377,6 +381,7 @@ def main():
     # serve
     serve_parser = subparsers.add_parser("serve", help="启动代理服务")
     serve_parser.add_argument("-p", "--port", type=int, default=8080, help="端口号")
+    serve_parser.add_argument("-w", "--workers", type=int, default=1, help="worker 进程数（>1 时启用 prefork 多进程模式）")
     serve_parser.set_defaults(func=cmd_serve)
     
     # status
@@ -20,6 +20,12 @@ from .error_handler import (
 from .rate_limiter import RateLimiter, RateLimitConfig, rate_limiter, get_rate_limiter
 from .log_broadcaster import log_broadcaster, LogBroadcaster
 from .http_pool import http_pool, HttpClientPool
+from .admission import AdmissionController, AdmissionRejected, admission, get_admission
+from .hedging import HedgePolicy, HedgeConfig, hedge_policy, get_hedge_policy
+from .coordination import CoordinationStore, MemoryStore, SQLiteStore, get_store
+from .token_manager import TokenManager, token_manager, get_token_manager
+from .probe import ProbeEngine, ProbeResult, probe_engine, get_probe_engine
+from .upstream import UpstreamExecutor, UpstreamRequest, UpstreamStream, UpstreamError
 
 __all__ = [
     "state", "ProxyState", "RequestLog", "Account", 
@@ -35,5 +41,11 @@ __all__ = [
     "ErrorType", "KiroError", "classify_error", "is_account_suspended",
     "get_anthropic_error_response", "format_error_log",
     "RateLimiter", "RateLimitConfig", "rate_limiter", "get_rate_limiter",
-    "log_broadcaster", "LogBroadcaster"
+    "log_broadcaster", "LogBroadcaster",
+    "AdmissionController", "AdmissionRejected", "admission", "get_admission",
+    "HedgePolicy", "HedgeConfig", "hedge_policy", "get_hedge_policy",
+    "CoordinationStore", "MemoryStore", "SQLiteStore", "get_store",
+    "TokenManager", "token_manager", "get_token_manager",
+    "ProbeEngine", "ProbeResult", "probe_engine", "get_probe_engine",
+    "UpstreamExecutor", "UpstreamRequest", "UpstreamStream", "UpstreamError"
 ]
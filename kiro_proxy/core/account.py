@@ -1,4 +1,5 @@
 """账号管理"""
+import asyncio
 import json
 import time
 from dataclasses import dataclass, field
@@ -9,6 +10,7 @@ from ..credential import (
     KiroCredentials, TokenRefresher, CredentialStatus,
     generate_machine_id, quota_manager
 )
+from .persistence import write_behind
 
 
 @dataclass
@@ -25,6 +27,21 @@ class Account:
     
     _credentials: Optional[KiroCredentials] = field(default=None, repr=False)
     _machine_id: Optional[str] = field(default=None, repr=False)
+    _header_templates: dict = field(default_factory=dict, repr=False)
+    _registry: Optional[object] = field(default=None, repr=False, compare=False)
+    
+    # 这些字段变化时通知 AccountRegistry 更新可用索引
+    _INDEXED_FIELDS = frozenset({"enabled", "status"})
+    
+    # Token 刷新租约时长（秒）
+    REFRESH_LEASE_SECONDS = 60
+    
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in Account._INDEXED_FIELDS:
+            registry = self.__dict__.get("_registry")
+            if registry is not None:
+                registry.update(self)
     
     def is_available(self) -> bool:
         """检查账号是否可用"""
@@ -39,16 +56,28 @@ class Account:
     def load_credentials(self) -> Optional[KiroCredentials]:
         """加载凭证信息"""
         try:
-            self._credentials = KiroCredentials.from_file(self.token_path)
-            
-            if self._credentials.client_id_hash and not self._credentials.client_id:
-                self._merge_client_credentials()
-            
-            return self._credentials
+            return self.set_credentials(KiroCredentials.from_file(self.token_path))
         except Exception as e:
             print(f"[Account] 加载凭证失败 {self.id}: {e}")
             return None
     
+    async def reload_credentials(self) -> Optional[KiroCredentials]:
+        """token 文件被外部更新后重新加载（文件读取在线程池中执行）"""
+        loop = asyncio.get_running_loop()
+        try:
+            creds = await loop.run_in_executor(None, KiroCredentials.from_file, self.token_path)
+        except Exception as e:
+            print(f"[Account] 重新加载凭证失败 {self.id}: {e}")
+            return None
+        return self.set_credentials(creds)
+    
+    def set_credentials(self, creds: KiroCredentials) -> KiroCredentials:
+        self._credentials = creds
+        if creds.client_id_hash and not creds.client_id:
+            self._merge_client_credentials()
+        self.invalidate_headers()
+        return creds
+    
     def _merge_client_credentials(self):
         """合并 clientIdHash 对应的凭证文件"""
         if not self._credentials or not self._credentials.client_id_hash:
@@ -75,16 +104,9 @@ class Account:
         return self._credentials
     
     def get_token(self) -> str:
-        """获取 access_token"""
+        """获取 access_token（文件变化由 token_watcher 负责重新加载，这里不读盘）"""
         creds = self.get_credentials()
-        if creds and creds.access_token:
-            return creds.access_token
-        
-        try:
-            with open(self.token_path) as f:
-                return json.load(f).get("accessToken", "")
-        except Exception:
-            return ""
+        return creds.access_token if creds and creds.access_token else ""
     
     def get_machine_id(self) -> str:
         """获取基于此账号的 Machine ID"""
@@ -99,6 +121,24 @@ class Account:
         
         return self._machine_id
     
+    def get_headers(self, agent_mode: str = "vibe") -> dict:
+        """构建此账号的 Kiro API 请求头
+        
+        machine_id、user-agent 等身份信息缓存为模板，每次只生成 invocation id 和 token。
+        """
+        from ..kiro_api import _default_provider
+        
+        template = self._header_templates.get(agent_mode)
+        if template is None:
+            template = _default_provider.build_header_template(self.get_machine_id(), agent_mode)
+            self._header_templates[agent_mode] = template
+        return _default_provider.build_headers(self.get_token(), agent_mode, template=template)
+    
+    def invalidate_headers(self):
+        """凭证变化后清除缓存的身份信息"""
+        self._machine_id = None
+        self._header_templates = {}
+    
     def is_token_expired(self) -> bool:
         """检查 token 是否过期"""
         creds = self.get_credentials()
@@ -110,7 +150,32 @@ class Account:
         return creds.is_expiring_soon(minutes) if creds else False
     
     async def refresh_token(self) -> tuple:
-        """刷新 token"""
+        """刷新 token
+        
+        刷新前获取协调存储中的租约，同一账号同时只有一个进程向上游刷新；
+        其他进程等待租约释放后从文件重新加载刷新后的凭证。
+        """
+        from .coordination import get_store
+        store = get_store()
+        lease = f"refresh:{self.id}"
+        
+        if not store.acquire_lease(lease, self.REFRESH_LEASE_SECONDS):
+            deadline = time.time() + self.REFRESH_LEASE_SECONDS
+            while store.lease_held(lease) and time.time() < deadline:
+                await asyncio.sleep(0.5)
+            creds = await self.reload_credentials()
+            if creds and not creds.is_expiring_soon():
+                self.status = CredentialStatus.ACTIVE
+                return True, "Token 已由其他进程刷新"
+            if not store.acquire_lease(lease, self.REFRESH_LEASE_SECONDS):
+                return False, "Token 正在由其他进程刷新"
+        
+        try:
+            return await self._refresh_token()
+        finally:
+            store.release_lease(lease)
+    
+    async def _refresh_token(self) -> tuple:
         creds = self.get_credentials()
         if not creds:
             return False, "无法加载凭证"
@@ -119,8 +184,11 @@ class Account:
         success, result = await refresher.refresh()
         
         if success:
-            creds.save_to_file(self.token_path)
+            # 立即落盘：其他进程在刷新租约释放后会从文件读取新 token
+            write_behind.merge(self.token_path, creds.save_updates())
+            await write_behind.flush(self.token_path)
             self._credentials = creds
+            self.invalidate_headers()
             self.status = CredentialStatus.ACTIVE
             return True, "Token 刷新成功"
         else:
@@ -162,4 +230,5 @@ class Account:
             "provider": creds.provider if creds else None,
             "has_refresh_token": bool(creds and creds.refresh_token),
             "idc_config_complete": bool(creds and creds.client_id and creds.client_secret) if creds and creds.auth_method == "idc" else None,
+            "load": self._registry.load(self.id).to_dict() if self._registry else None,
         }
@@ -0,0 +1,368 @@
+"""账号索引与负载均衡
+
+- id -> Account 字典，替代对账号列表的线性扫描
+- 可用账号集合（支持 O(1) 随机采样），账号状态变化时增量更新
+- 冷却到期由时间轮触发，不再在每次请求时扫描全部冷却记录
+- 按在途流数、TTFB 和吞吐的 EWMA 做 power-of-two-choices 选择
+- 共享协调存储下，在途流数包含其他 worker 的计数
+- 多 worker（prefork）模式下只调度本 worker 分区内的账号
+"""
+import math
+import random
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+from ..credential import quota_manager
+
+if TYPE_CHECKING:
+    from .account import Account
+
+
+def _share_inflight(account_id: str, delta: int):
+    from .coordination import get_store
+    store = get_store()
+    if store.shared:
+        try:
+            store.add_inflight(account_id, delta)
+        except Exception as e:
+            print(f"[Registry] 同步在途数失败: {e}")
+
+
+class TimerWheel:
+    """哈希时间轮（默认 100ms 精度）
+
+    超过一圈的定时器保留在槽里，直到所在圈数到期才触发。
+    """
+
+    def __init__(self, slots: int = 1024, resolution: float = 0.1):
+        self.resolution = resolution
+        self._slots: List[List[Tuple[int, str]]] = [[] for _ in range(slots)]
+        self._tick = int(time.time() / resolution)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def schedule(self, deadline: float, key: str):
+        """在 deadline（时间戳）到期后触发 key"""
+        tick = max(math.ceil(deadline / self.resolution), self._tick + 1)
+        self._slots[tick % len(self._slots)].append((tick, key))
+        self._size += 1
+
+    def advance(self, now: Optional[float] = None) -> List[str]:
+        """推进到当前时间，返回到期的 key"""
+        target = int((now if now is not None else time.time()) / self.resolution)
+        if target <= self._tick:
+            return []
+        expired = []
+        n = len(self._slots)
+        for step in range(1, min(target - self._tick, n) + 1):
+            slot = self._slots[(self._tick + step) % n]
+            if not slot:
+                continue
+            due = [key for tick, key in slot if tick <= target]
+            if due:
+                slot[:] = [(tick, key) for tick, key in slot if tick > target]
+                expired.extend(due)
+        self._tick = target
+        self._size -= len(expired)
+        return expired
+
+
+@dataclass
+class AccountLoad:
+    """账号负载信号"""
+    inflight: int = 0                      # 在途的上游流
+    remote_inflight: int = 0               # 其他 worker 的在途流（共享协调存储）
+    ttfb_ms: Optional[float] = None        # 首字节时间 EWMA
+    tokens_per_sec: Optional[float] = None  # 输出吞吐 EWMA（按字符估算 token）
+    samples: int = 0
+
+    EWMA_ALPHA = 0.2
+
+    def record_ttfb(self, ttfb_ms: float):
+        if self.ttfb_ms is None:
+            self.ttfb_ms = ttfb_ms
+        else:
+            self.ttfb_ms += self.EWMA_ALPHA * (ttfb_ms - self.ttfb_ms)
+        self.samples += 1
+
+    def record_throughput(self, tokens_per_sec: float):
+        if self.tokens_per_sec is None:
+            self.tokens_per_sec = tokens_per_sec
+        else:
+            self.tokens_per_sec += self.EWMA_ALPHA * (tokens_per_sec - self.tokens_per_sec)
+
+    @property
+    def total_inflight(self) -> int:
+        return self.inflight + self.remote_inflight
+    
+    def to_dict(self) -> dict:
+        return {
+            "inflight": self.inflight,
+            "remote_inflight": self.remote_inflight,
+            "ttfb_ewma_ms": round(self.ttfb_ms) if self.ttfb_ms is not None else None,
+            "tokens_per_sec": round(self.tokens_per_sec, 1) if self.tokens_per_sec is not None else None,
+        }
+
+
+class AccountRegistry:
+    """账号注册表
+
+    Account 的 enabled / status 被修改时会回调 update()，可用集合随之更新；
+    冷却中的账号在到期时由时间轮重新评估。
+    """
+
+    DEFAULT_TTFB_MS = 1000.0
+    REFERENCE_TTL = 1.0
+
+    def __init__(self):
+        self._accounts: Dict[str, "Account"] = {}
+        self._available: List[str] = []
+        self._available_pos: Dict[str, int] = {}
+        self._loads: Dict[str, AccountLoad] = {}
+        self._wheel = TimerWheel()
+        self._reference_cache: Tuple[float, Optional[float]] = (self.DEFAULT_TTFB_MS, None)
+        self._reference_at = 0.0
+        self.version = 0  # 账号增删时递增（一致性哈希环据此重建）
+        self._partition: Optional[Tuple[int, int]] = None
+        self._owned: set = set()
+        self._primary: set = set()
+        self._owned_version = -1
+
+    def __len__(self) -> int:
+        return len(self._accounts)
+
+    def __iter__(self) -> Iterator["Account"]:
+        return iter(list(self._accounts.values()))
+
+    def __contains__(self, account_id: str) -> bool:
+        return account_id in self._accounts
+
+    def get(self, account_id: str) -> Optional["Account"]:
+        return self._accounts.get(account_id)
+
+    def values(self) -> List["Account"]:
+        return list(self._accounts.values())
+
+    @property
+    def available_count(self) -> int:
+        self.tick()
+        return len(self._available)
+
+    def add(self, account: "Account"):
+        """注册账号（同 id 会替换旧账号）"""
+        old = self._accounts.get(account.id)
+        if old is not None and old is not account:
+            old._registry = None
+        self._accounts[account.id] = account
+        account._registry = self
+        self.version += 1
+        self._reevaluate(account)
+
+    def remove(self, account_id: str) -> Optional["Account"]:
+        account = self._accounts.pop(account_id, None)
+        self._discard(account_id)
+        self._loads.pop(account_id, None)
+        if account is not None:
+            account._registry = None
+            self.version += 1
+            self._reevaluate()
+        return account
+
+    def _reevaluate(self, account: Optional["Account"] = None):
+        """账号增删后重新评估（分区模式下归属可能整体变化）"""
+        if self._partition is None:
+            if account is not None:
+                self.update(account)
+            return
+        for acc in list(self._accounts.values()):
+            self.update(acc)
+
+    def clear(self):
+        for account in self._accounts.values():
+            account._registry = None
+        self._accounts.clear()
+        self._available.clear()
+        self._available_pos.clear()
+        self._loads.clear()
+        self.version += 1
+
+    def _discard(self, account_id: str):
+        """从可用集合中移除（与末尾交换，O(1)）"""
+        pos = self._available_pos.pop(account_id, None)
+        if pos is None:
+            return
+        last = self._available.pop()
+        if last != account_id:
+            self._available[pos] = last
+            self._available_pos[last] = pos
+
+    # ==================== 分区 ====================
+
+    def set_partition(self, index: int, count: int):
+        """只调度第 index 个分区（共 count 个）内的账号"""
+        self._partition = (index, count) if count > 1 else None
+        self.version += 1
+        for account in list(self._accounts.values()):
+            self.update(account)
+
+    def owns(self, account_id: str) -> bool:
+        """账号是否属于本分区
+
+        按 id 排序后轮流分配，分区之间均衡且互不相交；
+        账号数少于分区数时，多出来的分区复用已有账号，保证每个分区都有账号可用。
+        """
+        if self._partition is None:
+            return True
+        self._refresh_partition()
+        return account_id in self._owned
+
+    def manages(self, account_id: str) -> bool:
+        """账号的后台维护（Token 刷新、健康检查）是否由本分区负责
+
+        复用账号的分区只调度，不维护，避免多个进程同时刷新同一个 Token。
+        """
+        if self._partition is None:
+            return True
+        self._refresh_partition()
+        return account_id in self._primary
+
+    def _refresh_partition(self):
+        if self._owned_version == self.version:
+            return
+        index, count = self._partition
+        ids = sorted(self._accounts)
+        self._primary = {aid for pos, aid in enumerate(ids) if pos % count == index}
+        self._owned = set(self._primary)
+        if ids and len(ids) < count:
+            self._owned.add(ids[index % len(ids)])
+        self._owned_version = self.version
+
+    def get_partition(self) -> Optional[dict]:
+        if self._partition is None:
+            return None
+        index, count = self._partition
+        return {
+            "index": index,
+            "count": count,
+            "accounts": sorted(aid for aid in self._accounts if self.owns(aid)),
+        }
+
+    def update(self, account: "Account"):
+        """账号状态变化后重新评估可用性"""
+        if self._accounts.get(account.id) is not account:
+            return
+        if not self.owns(account.id):
+            self._discard(account.id)
+        elif account.is_available():
+            if account.id not in self._available_pos:
+                self._available_pos[account.id] = len(self._available)
+                self._available.append(account.id)
+        else:
+            self._discard(account.id)
+            record = quota_manager.exceeded_records.get(account.id)
+            if record is not None and account.enabled:
+                self._wheel.schedule(record.cooldown_until, account.id)
+
+    def tick(self, now: Optional[float] = None):
+        """处理到期的冷却"""
+        for account_id in self._wheel.advance(now):
+            account = self._accounts.get(account_id)
+            if account is not None:
+                self.update(account)
+
+    # ==================== 负载信号 ====================
+
+    def load(self, account_id: str) -> AccountLoad:
+        load = self._loads.get(account_id)
+        if load is None:
+            load = self._loads[account_id] = AccountLoad()
+        return load
+
+    def stream_started(self, account_id: str):
+        self.load(account_id).inflight += 1
+        _share_inflight(account_id, 1)
+
+    def stream_finished(self, account_id: str, output_chars: int = 0, duration: float = 0):
+        """上游流结束：减少在途数并记录吞吐（约 4 字符 / token）"""
+        load = self.load(account_id)
+        load.inflight = max(0, load.inflight - 1)
+        _share_inflight(account_id, -1)
+        if output_chars >= 200 and duration > 0:
+            load.record_throughput(output_chars / 4 / duration)
+
+    def set_remote_inflight(self, counts: Dict[str, int]):
+        """更新其他 worker 的在途流数（由协调存储同步任务调用）"""
+        for account_id in self._accounts:
+            self.load(account_id).remote_inflight = counts.get(account_id, 0)
+
+    def record_ttfb(self, account_id: str, ttfb_ms: float):
+        self.load(account_id).record_ttfb(ttfb_ms)
+
+    def _reference(self) -> Tuple[float, Optional[float]]:
+        """所有账号 TTFB / 吞吐的中位数，作为无样本账号的默认值（每秒最多重算一次）"""
+        now = time.time()
+        if now - self._reference_at >= self.REFERENCE_TTL:
+            ttfbs = sorted(load.ttfb_ms for load in self._loads.values() if load.ttfb_ms is not None)
+            tps = sorted(load.tokens_per_sec for load in self._loads.values() if load.tokens_per_sec)
+            self._reference_cache = (
+                ttfbs[len(ttfbs) // 2] if ttfbs else self.DEFAULT_TTFB_MS,
+                tps[len(tps) // 2] if tps else None,
+            )
+            self._reference_at = now
+        return self._reference_cache
+
+    def _cost(self, account_id: str, ref_ttfb: float, ref_tps: Optional[float]) -> float:
+        """期望等待代价：(在途数 + 1) × TTFB ÷ 相对吞吐"""
+        load = self._loads.get(account_id) or AccountLoad()
+        ttfb = load.ttfb_ms if load.ttfb_ms is not None else ref_ttfb
+        speed = 1.0
+        if ref_tps and load.tokens_per_sec:
+            speed = min(max(load.tokens_per_sec / ref_tps, 0.25), 4.0)
+        return (load.total_inflight + 1) * max(ttfb, 1.0) / speed
+
+    def _sample(self, exclude_id: Optional[str]) -> List[str]:
+        """从可用集合中随机取至多两个不同的账号"""
+        pool = self._available
+        if len(pool) <= 3:
+            eligible = [aid for aid in pool if aid != exclude_id]
+            return random.sample(eligible, min(2, len(eligible)))
+        picked: List[str] = []
+        while len(picked) < 2:
+            account_id = random.choice(pool)
+            if account_id != exclude_id and account_id not in picked:
+                picked.append(account_id)
+        return picked
+
+    def pick(self, exclude_id: Optional[str] = None) -> Optional["Account"]:
+        """power-of-two-choices：随机取两个可用账号，选代价较低的一个"""
+        self.tick()
+        while True:
+            candidates = self._sample(exclude_id)
+            stale = [aid for aid in candidates if not self._accounts[aid].is_available()]
+            if not stale:
+                break
+            # 有未通知到的状态变化（如手动恢复配额），重新评估后重新采样
+            for account_id in stale:
+                self.update(self._accounts[account_id])
+
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return self._accounts[candidates[0]]
+        ref_ttfb, ref_tps = self._reference()
+        best = min(candidates, key=lambda aid: self._cost(aid, ref_ttfb, ref_tps))
+        return self._accounts[best]
+
+    def restore_cooldown(self) -> int:
+        """所有账号都不可用时，恢复处于 COOLDOWN 状态的账号"""
+        from ..credential import CredentialStatus
+        restored = 0
+        for account in list(self._accounts.values()):
+            if account.enabled and account.status == CredentialStatus.COOLDOWN:
+                quota_manager.restore(account.id)
+                account.status = CredentialStatus.ACTIVE
+                restored += 1
+        return restored
@@ -0,0 +1,199 @@
+"""准入控制 - 按限速配置排队放行请求
+
+取代"限速时 sleep 一下再照发"：
+- 每账号一个 FIFO 队列 + 一个全局 FIFO 队列，队首拿到许可才放行
+- 放行时在 RateLimiter 中预占请求额度，后面的请求按限速间隔依次放行
+- 队列超过上限或等待超过截止时间时立即拒绝（429/529 + Retry-After）
+- 队列深度、等待时间等指标见 get_stats()
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from . import metrics
+from .rate_limiter import RateLimiter, get_rate_limiter
+
+
+class AdmissionRejected(Exception):
+    """请求未获准入（队列已满或等待超时）"""
+
+    def __init__(self, scope: str, retry_after: int, message: str):
+        super().__init__(message)
+        self.scope = scope              # "account" / "global"
+        self.retry_after = retry_after
+        self.message = message
+
+    @property
+    def headers(self) -> dict:
+        return {"Retry-After": str(self.retry_after)}
+
+    def status_code(self, protocol: str) -> int:
+        """全局过载时 Anthropic 协议使用 529，其余一律 429"""
+        if protocol == "anthropic" and self.scope == "global":
+            return 529
+        return 429
+
+    def body(self, protocol: str) -> dict:
+        """按协议格式生成错误响应体"""
+        if protocol == "anthropic":
+            error_type = "overloaded_error" if self.scope == "global" else "rate_limit_error"
+            return {"type": "error", "error": {"type": error_type, "message": self.message}}
+        if protocol == "gemini":
+            return {"error": {"code": 429, "message": self.message, "status": "RESOURCE_EXHAUSTED"}}
+        # OpenAI Chat Completions / Responses
+        return {"error": {"message": self.message, "type": "rate_limit_exceeded", "code": "rate_limit_exceeded"}}
+
+
+class AdmissionQueue:
+    """单个 FIFO 准入队列
+
+    acquire() 返回 (can_request, wait_seconds, reason)，可放行时已原子地预占额度；
+    release() 退还一次预占（已放行但调用方被取消时）。
+    """
+
+    def __init__(self, name: str, acquire: Callable[[], Tuple], release: Callable[[], None],
+                 interval: Callable[[], float]):
+        self.name = name
+        self._acquire = acquire
+        self._release = release
+        self._interval = interval
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._pump_task: Optional[asyncio.Task] = None
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(1 for w in self._waiters if not w.done())
+
+    def retry_after(self) -> int:
+        """按当前排队长度估算的 Retry-After（秒）"""
+        return max(1, math.ceil((self.depth + 1) * self._interval()))
+
+    async def acquire(self, deadline: float, max_depth: int, scope: str):
+        # 快速路径：无人排队且当前可放行
+        if not self._waiters and self._acquire()[0]:
+            self.admitted += 1
+            return
+        if self.depth >= max_depth:
+            self.rejected += 1
+            metrics.admission_rejected.inc(scope, "queue_full")
+            raise AdmissionRejected(scope, self.retry_after(), f"Too many queued requests ({self.name})")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._ensure_pump()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=max(0.0, deadline - time.time()))
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                return  # 超时的同时恰好被放行
+            waiter.cancel()
+            self.timed_out += 1
+            metrics.admission_rejected.inc(scope, "timeout")
+            raise AdmissionRejected(scope, self.retry_after(), f"Rate limit queue timeout ({self.name})")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()  # 已被放行并预占了额度，调用方却被取消
+            waiter.cancel()
+            raise
+
+    def _ensure_pump(self):
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        """按限速节奏依次放行队首"""
+        while self._waiters:
+            waiter = self._waiters[0]
+            if waiter.done():
+                self._waiters.popleft()  # 已超时或已取消
+                continue
+            can, wait, _ = self._acquire()
+            if can:
+                self._waiters.popleft()
+                self.admitted += 1
+                waiter.set_result(None)
+                continue
+            await asyncio.sleep(max(wait, 0.01))
+
+
+class AdmissionController:
+    """每账号队列 + 全局队列的两级准入"""
+
+    WAIT_SAMPLES = 1000
+
+    def __init__(self, limiter: RateLimiter = None):
+        self.limiter = limiter or get_rate_limiter()
+        self._accounts: Dict[str, AdmissionQueue] = {}
+        self._global = AdmissionQueue(
+            "global",
+            self.limiter.acquire_global,
+            self.limiter.release_global,
+            self.limiter.global_interval,
+        )
+        self._waits: Deque[float] = deque(maxlen=self.WAIT_SAMPLES)
+
+    def _account_queue(self, account_id: str) -> AdmissionQueue:
+        queue = self._accounts.get(account_id)
+        if queue is None:
+            queue = self._accounts[account_id] = AdmissionQueue(
+                f"account {account_id}",
+                lambda: self.limiter.acquire_account(account_id),
+                lambda: self.limiter.release_account(account_id),
+                self.limiter.account_interval,
+            )
+        return queue
+
+    async def admit(self, account_id: str) -> float:
+        """等待准入，返回排队耗时（秒）；被拒绝时抛出 AdmissionRejected"""
+        config = self.limiter.config
+        start = time.time()
+        deadline = start + config.max_queue_wait
+        await self._account_queue(account_id).acquire(deadline, config.max_queue_depth, "account")
+        try:
+            await self._global.acquire(deadline, config.global_max_queue_depth, "global")
+        except (AdmissionRejected, asyncio.CancelledError):
+            # 全局队列没放行，退还已预占的账号额度
+            self.limiter.release_account(account_id)
+            raise
+        waited = time.time() - start
+        self._waits.append(waited)
+        metrics.admission_wait.observe(waited)
+        return waited
+
+    def drop_account(self, account_id: str):
+        self._accounts.pop(account_id, None)
+
+    def queue_depths(self) -> Tuple[int, int]:
+        """(全局队列深度, 各账号队列深度之和)"""
+        return self._global.depth, sum(q.depth for q in self._accounts.values())
+
+    def get_stats(self) -> dict:
+        """队列深度与等待时间"""
+        waits = sorted(self._waits)
+        queues = list(self._accounts.values())
+        return {
+            "global_depth": self._global.depth,
+            "account_depths": {
+                aid: q.depth for aid, q in self._accounts.items() if q.depth
+            },
+            "admitted": self._global.admitted,
+            "rejected": self._global.rejected + sum(q.rejected for q in queues),
+            "timed_out": self._global.timed_out + sum(q.timed_out for q in queues),
+            "wait_avg_ms": round(sum(waits) / len(waits) * 1000, 1) if waits else 0,
+            "wait_p95_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else 0,
+            "wait_max_ms": round(waits[-1] * 1000, 1) if waits else 0,
+        }
+
+
+# 全局实例
+admission = AdmissionController()
+
+
+def get_admission() -> AdmissionController:
+    """获取准入控制器实例"""
+    return admission
@@ -0,0 +1,581 @@
+"""协调存储 - 多进程 / 多节点共享同一账号池
+
+需要跨进程一致的状态都经由 CoordinationStore：
+- 配额冷却（quota_manager）
+- 限速 GCRA 状态（rate_limiter）
+- 会话粘性（session_router）
+- 各账号在途流数（account_registry）
+- Token 刷新租约（account.refresh_token）
+
+MemoryStore 为默认实现（单进程，行为与之前一致）；SQLiteStore 使用 WAL 模式
+的本地数据库文件，同一台机器上的多个 worker 共用。
+后端由 config.json 的 "coordination" 或环境变量 KIRO_PROXY_COORDINATION 指定：
+    "memory" | "sqlite" | "sqlite:/path/to/coordination.db"
+共享后端下，冷却和在途数由后台任务每秒同步到本地索引。
+
+SQLite 后端不让请求路径等锁：
+- busy_timeout 只有几毫秒，拿不到锁时放行（fail open：限速放行、会话查询视为未命中）
+- 在途数增量和会话绑定先记在内存里，由后台同步任务批量写入；
+  同步任务的数据库 I/O 在线程池中执行（使用独立连接）
+- 限速检查与记录在一个 BEGIN IMMEDIATE 事务中完成（gcra_acquire），多个 worker 不会同时放行
+"""
+import asyncio
+import os
+import socket
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+ENV_VAR = "KIRO_PROXY_COORDINATION"
+
+
+# (key, 发射间隔, 突发容差)
+GcraLimit = Tuple[str, float, float]
+
+
+def _gcra_wait(tat: float, now: float, tolerance: float) -> float:
+    return max(0.0, tat - tolerance - now)
+
+
+class CoordinationStore:
+    """协调存储接口（内存实现）"""
+
+    shared = False
+    INFLIGHT_STALE_SECONDS = 60
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._cooldowns: Dict[str, Tuple[float, str]] = {}
+        self._tats: Dict[str, float] = {}
+        self._sessions: Dict[str, Tuple[str, float]] = {}
+        self._inflight: Dict[str, int] = {}
+        self._leases: Dict[str, Tuple[str, float]] = {}
+
+    @property
+    def name(self) -> str:
+        return "memory"
+
+    # ==================== 配额冷却 ====================
+
+    def set_cooldown(self, account_id: str, until: float, reason: str = ""):
+        self._cooldowns[account_id] = (until, reason)
+
+    def clear_cooldown(self, account_id: str):
+        self._cooldowns.pop(account_id, None)
+
+    def get_cooldowns(self) -> Dict[str, Tuple[float, str]]:
+        """未过期的冷却 {account_id: (until, reason)}"""
+        now = time.time()
+        return {aid: v for aid, v in self._cooldowns.items() if v[0] > now}
+
+    def unsynced_cooldowns(self) -> Dict[str, Tuple[float, str]]:
+        """写入失败、等待下次同步重试的冷却（共享后端用）"""
+        return {}
+
+    # ==================== 限速（GCRA） ====================
+
+    def gcra_wait(self, key: str, now: float, tolerance: float = 0.0) -> float:
+        return _gcra_wait(self._tats.get(key, 0.0), now, tolerance)
+
+    def gcra_record(self, key: str, now: float, interval: float):
+        self._tats[key] = max(self._tats.get(key, 0.0), now) + interval
+
+    def gcra_acquire(self, limits: Sequence[GcraLimit], now: float) -> List[float]:
+        """检查多个限额，全部可放行时一并记录；返回各限额的等待秒数（全为 0 表示已放行）"""
+        waits = [_gcra_wait(self._tats.get(key, 0.0), now, tolerance) for key, _, tolerance in limits]
+        if not any(waits):
+            for key, interval, _ in limits:
+                self.gcra_record(key, now, interval)
+        return waits
+
+    def gcra_release(self, limits: Sequence[GcraLimit]):
+        """退还 gcra_acquire 预占的额度（请求最终没有发出时）"""
+        for key, interval, _ in limits:
+            if key in self._tats:
+                self._tats[key] -= interval
+
+    # ==================== 会话粘性 ====================
+
+    def get_session(self, session_id: str) -> Optional[str]:
+        entry = self._sessions.get(session_id)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def set_session(self, session_id: str, account_id: str, ttl: float):
+        self._sessions[session_id] = (account_id, time.time() + ttl)
+
+    # ==================== 在途流数 ====================
+
+    def add_inflight(self, account_id: str, delta: int):
+        self._inflight[account_id] = max(0, self._inflight.get(account_id, 0) + delta)
+
+    def get_remote_inflight(self) -> Dict[str, int]:
+        """其他 worker 的在途流数（本进程的计数由 AccountRegistry 自己维护）"""
+        return {}
+
+    # ==================== 租约 ====================
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        """获取租约；已被其他持有者持有且未过期时返回 False"""
+        now = time.time()
+        holder = self._leases.get(name)
+        if holder and holder[0] != self.worker_id and holder[1] > now:
+            return False
+        self._leases[name] = (self.worker_id, now + ttl)
+        return True
+
+    def release_lease(self, name: str):
+        holder = self._leases.get(name)
+        if holder and holder[0] == self.worker_id:
+            del self._leases[name]
+
+    def lease_held(self, name: str) -> bool:
+        """租约是否被（任意持有者）持有"""
+        holder = self._leases.get(name)
+        return bool(holder and holder[1] > time.time())
+
+    # ==================== 维护 ====================
+
+    def heartbeat(self):
+        """刷新本 worker 的存活时间（共享后端用）"""
+
+    def take_pending(self) -> Optional[dict]:
+        """取出尚未写入的批量更新（共享后端用）"""
+        return None
+
+    def exchange(self, pending: Optional[dict]) -> Optional[Tuple[Dict[str, Tuple[float, str]], Dict[str, int]]]:
+        """写入批量更新并读取 (冷却, 其他 worker 在途数)；可在线程中调用（共享后端用）"""
+        return None
+
+    def requeue(self, pending: Optional[dict]):
+        """exchange 失败时放回批量更新"""
+
+    def cleanup(self):
+        now = time.time()
+        for key in [k for k, v in self._sessions.items() if v[1] <= now]:
+            del self._sessions[key]
+        for key in [k for k, v in self._cooldowns.items() if v[0] <= now]:
+            del self._cooldowns[key]
+
+    def close(self):
+        pass
+
+
+# 内存实现即默认接口实现
+MemoryStore = CoordinationStore
+
+
+class SQLiteStore(CoordinationStore):
+    """基于 SQLite WAL 文件的共享存储（同机多 worker）"""
+
+    shared = True
+    BUSY_TIMEOUT_MS = 5   # 请求路径上等锁的上限，超时即放行
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS cooldowns (account_id TEXT PRIMARY KEY, until REAL, reason TEXT);
+    CREATE TABLE IF NOT EXISTS gcra (key TEXT PRIMARY KEY, tat REAL);
+    CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, account_id TEXT, expires REAL);
+    CREATE TABLE IF NOT EXISTS inflight (
+        account_id TEXT, worker TEXT, count INTEGER, updated REAL,
+        PRIMARY KEY (account_id, worker)
+    );
+    CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL);
+    """
+
+    def __init__(self, path: Path):
+        super().__init__()
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # 建表允许等待较长时间（启动时其他 worker 可能正在建表）
+        setup = self._connect(5000)
+        setup.execute("PRAGMA journal_mode=WAL")
+        setup.executescript(self.SCHEMA)
+        setup.close()
+        # 请求路径（事件循环线程）使用的连接
+        self._conn = self._connect(self.BUSY_TIMEOUT_MS)
+        # 后台同步（线程池）使用的连接，可以等得久一些
+        self._bg = self._connect(1000)
+        self._pending_inflight: Dict[str, int] = {}
+        self._pending_sessions: Dict[str, Tuple[str, float]] = {}
+        self._pending_cooldowns: Dict[str, Tuple[float, str]] = {}
+        self.busy = 0
+
+    def _connect(self, busy_timeout_ms: int) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            str(self.path), timeout=busy_timeout_ms / 1000, isolation_level=None, check_same_thread=False
+        )
+        conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def name(self) -> str:
+        return f"sqlite:{self.path}"
+
+    def _tx(self, conn: Optional[sqlite3.Connection] = None):
+        """写事务（BEGIN IMMEDIATE 保证读-改-写原子）"""
+        return _Transaction(conn or self._conn)
+
+    def _busy(self, op: str, e: sqlite3.Error):
+        self.busy += 1
+        if self.busy % 100 == 1:
+            print(f"[Coordination] {op} 未拿到数据库锁，已放行（累计 {self.busy} 次）: {e}")
+
+    # ==================== 配额冷却 ====================
+
+    def set_cooldown(self, account_id: str, until: float, reason: str = ""):
+        try:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cooldowns (account_id, until, reason) VALUES (?, ?, ?)",
+                (account_id, until, reason),
+            )
+            self._pending_cooldowns.pop(account_id, None)
+        except sqlite3.OperationalError as e:
+            self._busy("写入冷却", e)
+            # 留到后台同步时重试，在此之前同步也不会丢掉本地的这条冷却
+            self._pending_cooldowns[account_id] = (until, reason)
+
+    def clear_cooldown(self, account_id: str):
+        self._pending_cooldowns.pop(account_id, None)
+        try:
+            self._conn.execute("DELETE FROM cooldowns WHERE account_id = ?", (account_id,))
+        except sqlite3.OperationalError as e:
+            self._busy("清除冷却", e)
+
+    def get_cooldowns(self) -> Dict[str, Tuple[float, str]]:
+        return self._read_cooldowns(self._conn)
+
+    @staticmethod
+    def _read_cooldowns(conn: sqlite3.Connection) -> Dict[str, Tuple[float, str]]:
+        rows = conn.execute(
+            "SELECT account_id, until, reason FROM cooldowns WHERE until > ?", (time.time(),)
+        ).fetchall()
+        return {aid: (until, reason or "") for aid, until, reason in rows}
+
+    # ==================== 限速（GCRA） ====================
+
+    def gcra_wait(self, key: str, now: float, tolerance: float = 0.0) -> float:
+        try:
+            row = self._conn.execute("SELECT tat FROM gcra WHERE key = ?", (key,)).fetchone()
+        except sqlite3.OperationalError as e:
+            self._busy("限速检查", e)
+            return 0.0
+        return _gcra_wait(row[0] if row else 0.0, now, tolerance)
+
+    def gcra_record(self, key: str, now: float, interval: float):
+        self.gcra_acquire([(key, interval, float("inf"))], now)
+
+    def gcra_acquire(self, limits: Sequence[GcraLimit], now: float) -> List[float]:
+        try:
+            with self._tx():
+                waits = []
+                for key, _, tolerance in limits:
+                    row = self._conn.execute("SELECT tat FROM gcra WHERE key = ?", (key,)).fetchone()
+                    waits.append(_gcra_wait(row[0] if row else 0.0, now, tolerance))
+                if not any(waits):
+                    for key, interval, _ in limits:
+                        self._conn.execute(
+                            "INSERT INTO gcra (key, tat) VALUES (?, ?) "
+                            "ON CONFLICT(key) DO UPDATE SET tat = MAX(tat, ?) + ?",
+                            (key, now + interval, now, interval),
+                        )
+                return waits
+        except sqlite3.OperationalError as e:
+            self._busy("限速", e)
+            return [0.0] * len(limits)
+
+    def gcra_release(self, limits: Sequence[GcraLimit]):
+        try:
+            with self._tx():
+                for key, interval, _ in limits:
+                    self._conn.execute("UPDATE gcra SET tat = tat - ? WHERE key = ?", (interval, key))
+        except sqlite3.OperationalError as e:
+            self._busy("退还限速额度", e)
+
+    # ==================== 会话粘性 ====================
+
+    def get_session(self, session_id: str) -> Optional[str]:
+        try:
+            row = self._conn.execute(
+                "SELECT account_id FROM sessions WHERE session_id = ? AND expires > ?",
+                (session_id, time.time()),
+            ).fetchone()
+        except sqlite3.OperationalError as e:
+            self._busy("读取会话", e)
+            return None
+        return row[0] if row else None
+
+    def set_session(self, session_id: str, account_id: str, ttl: float):
+        """记入批量更新，由后台同步写入"""
+        self._pending_sessions[session_id] = (account_id, time.time() + ttl)
+
+    # ==================== 在途流数 ====================
+
+    def add_inflight(self, account_id: str, delta: int):
+        """记入批量更新，由后台同步写入"""
+        self._pending_inflight[account_id] = self._pending_inflight.get(account_id, 0) + delta
+
+    def get_remote_inflight(self) -> Dict[str, int]:
+        return self._read_remote_inflight(self._conn)
+
+    def _read_remote_inflight(self, conn: sqlite3.Connection) -> Dict[str, int]:
+        rows = conn.execute(
+            "SELECT account_id, SUM(count) FROM inflight WHERE worker != ? AND updated > ? GROUP BY account_id",
+            (self.worker_id, time.time() - self.INFLIGHT_STALE_SECONDS),
+        ).fetchall()
+        return {aid: int(total or 0) for aid, total in rows}
+
+    # ==================== 租约 ====================
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        now = time.time()
+        try:
+            with self._tx():
+                row = self._conn.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+                if row and row[0] != self.worker_id and row[1] > now:
+                    return False
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)",
+                    (name, self.worker_id, now + ttl),
+                )
+                return True
+        except sqlite3.OperationalError as e:
+            self._busy("获取租约", e)
+            return True
+
+    def release_lease(self, name: str):
+        try:
+            self._conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.worker_id))
+        except sqlite3.OperationalError as e:
+            self._busy("释放租约", e)  # 租约到期后自然失效
+
+    def lease_held(self, name: str) -> bool:
+        try:
+            row = self._conn.execute(
+                "SELECT 1 FROM leases WHERE name = ? AND expires > ?", (name, time.time())
+            ).fetchone()
+        except sqlite3.OperationalError as e:
+            self._busy("查询租约", e)
+            return False
+        return row is not None
+
+    # ==================== 批量同步 ====================
+
+    def unsynced_cooldowns(self) -> Dict[str, Tuple[float, str]]:
+        now = time.time()
+        return {aid: v for aid, v in self._pending_cooldowns.items() if v[0] > now}
+
+    def take_pending(self) -> dict:
+        pending = {
+            "inflight": self._pending_inflight,
+            "sessions": self._pending_sessions,
+            "cooldowns": self._pending_cooldowns,
+        }
+        self._pending_inflight = {}
+        self._pending_sessions = {}
+        self._pending_cooldowns = {}
+        return pending
+
+    def requeue(self, pending: Optional[dict]):
+        if not pending:
+            return
+        for account_id, delta in pending["inflight"].items():
+            self.add_inflight(account_id, delta)
+        for session_id, entry in pending["sessions"].items():
+            self._pending_sessions.setdefault(session_id, entry)
+        for account_id, entry in pending.get("cooldowns", {}).items():
+            self._pending_cooldowns.setdefault(account_id, entry)
+
+    def _write_pending(self, conn: sqlite3.Connection, pending: Optional[dict]):
+        now = time.time()
+        for account_id, delta in (pending or {}).get("inflight", {}).items():
+            conn.execute(
+                "INSERT INTO inflight (account_id, worker, count, updated) VALUES (?, ?, MAX(0, ?), ?) "
+                "ON CONFLICT(account_id, worker) DO UPDATE SET count = MAX(0, count + ?), updated = ?",
+                (account_id, self.worker_id, delta, now, delta, now),
+            )
+        sessions = (pending or {}).get("sessions", {})
+        if sessions:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sessions (session_id, account_id, expires) VALUES (?, ?, ?)",
+                [(sid, aid, expires) for sid, (aid, expires) in sessions.items()],
+            )
+        cooldowns = [
+            (aid, until, reason)
+            for aid, (until, reason) in (pending or {}).get("cooldowns", {}).items() if until > now
+        ]
+        if cooldowns:
+            conn.executemany(
+                "INSERT OR REPLACE INTO cooldowns (account_id, until, reason) VALUES (?, ?, ?)", cooldowns
+            )
+        # 心跳：本 worker 的在途记录保持新鲜
+        conn.execute("UPDATE inflight SET updated = ? WHERE worker = ?", (now, self.worker_id))
+
+    def exchange(self, pending: Optional[dict]):
+        with self._tx(self._bg):
+            self._write_pending(self._bg, pending)
+        return self._read_cooldowns(self._bg), self._read_remote_inflight(self._bg)
+
+    # ==================== 维护 ====================
+
+    def heartbeat(self):
+        self._conn.execute("UPDATE inflight SET updated = ? WHERE worker = ?", (time.time(), self.worker_id))
+
+    def cleanup(self):
+        now = time.time()
+        with self._tx(self._bg):
+            self._bg.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+            self._bg.execute("DELETE FROM cooldowns WHERE until <= ?", (now,))
+            self._bg.execute("DELETE FROM leases WHERE expires <= ?", (now,))
+            self._bg.execute(
+                "DELETE FROM inflight WHERE updated <= ?", (now - self.INFLIGHT_STALE_SECONDS,)
+            )
+
+    def close(self):
+        try:
+            with self._tx(self._bg):
+                self._write_pending(self._bg, self.take_pending())
+                self._bg.execute("DELETE FROM inflight WHERE worker = ?", (self.worker_id,))
+        except sqlite3.Error:
+            pass
+        for conn in (self._conn, self._bg):
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+
+class _Transaction:
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+# ==================== 全局实例与同步 ====================
+
+_store: CoordinationStore = MemoryStore()
+_sync_task: Optional[asyncio.Task] = None
+
+
+def get_store() -> CoordinationStore:
+    """获取当前协调存储"""
+    return _store
+
+
+def create_store(spec: str) -> CoordinationStore:
+    """按配置串创建存储："memory" / "sqlite" / "sqlite:<path>" """
+    spec = (spec or "memory").strip()
+    if spec == "memory":
+        return MemoryStore()
+    if spec == "sqlite" or spec.startswith("sqlite:"):
+        from .persistence import CONFIG_DIR
+        path = spec[len("sqlite:"):] if spec.startswith("sqlite:") else ""
+        return SQLiteStore(Path(path) if path else CONFIG_DIR / "coordination.db")
+    raise ValueError(f"未知的协调存储后端: {spec}")
+
+
+def configure(spec: Optional[str] = None) -> CoordinationStore:
+    """初始化协调存储；spec 为空时依次读取环境变量和 config.json"""
+    global _store
+    if spec is None:
+        spec = os.environ.get(ENV_VAR)
+    if spec is None:
+        from .persistence import load_config
+        spec = load_config().get("coordination", "memory")
+    store = create_store(spec)
+    if _store is not store:
+        _store.close()
+    _store = store
+    print(f"[Coordination] 使用存储后端: {store.name}")
+    return store
+
+
+def get_stats() -> dict:
+    """获取统计信息"""
+    return {
+        "backend": _store.name,
+        "shared": _store.shared,
+        "worker_id": _store.worker_id,
+        "busy_fail_open": getattr(_store, "busy", 0),
+    }
+
+
+def _apply_sync(store: CoordinationStore, result):
+    from ..credential import quota_manager
+    from .state import state
+
+    remote_cooldowns, remote_inflight = result
+    # 写入失败的本地冷却还不在快照里，合并进来，不当作已被其他 worker 恢复
+    changed = quota_manager.sync_from({**remote_cooldowns, **store.unsynced_cooldowns()})
+    for account_id in changed:
+        account = state.registry.get(account_id)
+        if account is not None:
+            state.registry.update(account)
+    state.registry.set_remote_inflight(remote_inflight)
+
+
+def sync_once():
+    """写入本地的批量更新，并把共享存储中的冷却和其他 worker 的在途数同步到本地"""
+    store = _store
+    if not store.shared:
+        return
+    pending = store.take_pending()
+    try:
+        result = store.exchange(pending)
+    except Exception:
+        store.requeue(pending)
+        raise
+    _apply_sync(store, result)
+
+
+async def _sync(store: CoordinationStore):
+    """同 sync_once，数据库 I/O 在线程池中执行"""
+    pending = store.take_pending()
+    try:
+        result = await asyncio.to_thread(store.exchange, pending)
+    except Exception:
+        store.requeue(pending)
+        raise
+    _apply_sync(store, result)
+
+
+async def _sync_loop(interval: float):
+    tick = 0
+    while True:
+        store = _store
+        try:
+            await _sync(store)
+            tick += 1
+            if tick % 60 == 0:
+                await asyncio.to_thread(store.cleanup)
+        except Exception as e:
+            print(f"[Coordination] 同步失败: {e}")
+        await asyncio.sleep(interval)
+
+
+def start(interval: float = 1.0):
+    """共享后端下启动后台同步任务"""
+    global _sync_task
+    if _store.shared and (_sync_task is None or _sync_task.done()):
+        _sync_task = asyncio.create_task(_sync_loop(interval))
+
+
+async def stop():
+    global _sync_task
+    if _sync_task is not None:
+        _sync_task.cancel()
+        try:
+            await _sync_task
+        except asyncio.CancelledError:
+            pass
+        _sync_task = None
+    _store.close()
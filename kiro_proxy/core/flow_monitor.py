@@ -1,15 +1,36 @@
 """Flow Monitor - LLM 流量监控
 
 记录完整的请求/响应数据，支持查询、过滤、导出。
+
+内存占用有上限：
+- 流式响应块只暂存到完成时，拼接一次后只保留最后几块
+- 完成的 Flow 把请求体 / 响应内容压缩成一个数据块，列表只需要摘要字段
+- 压缩数据总量超过字节预算时，最旧的数据块转存到磁盘（SQLite），查看详情时再按需读取
+
+查询走 SQLite 索引（过滤字段的二级索引 + FTS5 全文索引），不再逐条解压 / 序列化。
+
+采集不占用请求路径：
+- 请求路径只把参数引用放入有界队列，由独立的记录线程解析、压缩、写入存储，
+  不占用事件循环；存储的读写由一把锁串行化
+- 支持按比例采样；未采样的请求出错时补录（只保留请求摘要，不暂存请求体），
+  书签 Flow 所在会话总是记录
 """
+import asyncio
 import json
+import os
+import queue
+import random
+import sqlite3
+import tempfile
+import threading
 import time
 import uuid
+import zlib
 from pathlib import Path
-from dataclasses import dataclass, field, asdict
-from typing import Optional, List, Dict, Any
+from dataclasses import dataclass, field, asdict, replace
+from typing import Optional, List, Dict, Any, Tuple
 from datetime import datetime, timezone
-from collections import deque
+from collections import deque, OrderedDict
 from enum import Enum
 
 
@@ -59,6 +80,11 @@ class FlowRequest:
     stream: bool = False
     max_tokens: int = 0
     temperature: float = 1.0
+    
+    # 摘要（请求体压缩后列表仍可显示）
+    message_count: int = 0
+    has_tools: bool = False
+    has_system: bool = False
 
 
 @dataclass
@@ -74,9 +100,15 @@ class FlowResponse:
     stop_reason: str = ""
     usage: TokenUsage = field(default_factory=TokenUsage)
     
-    # 流式响应
+    # 流式响应（完成后只保留最后几块）
     chunks: List[str] = field(default_factory=list)
     chunk_count: int = 0
+    content_length: int = 0
+    
+    @property
+    def text(self) -> str:
+        """响应文本（流式进行中时拼接已收到的块）"""
+        return self.content or "".join(self.chunks)
 
 
 @dataclass
@@ -120,6 +152,7 @@ class LLMFlow:
     protocol: str  # anthropic, openai, gemini
     account_id: Optional[str] = None
     account_name: Optional[str] = None
+    session_id: Optional[str] = None
     
     # 请求/响应
     request: Optional[FlowRequest] = None
@@ -138,6 +171,15 @@ class LLMFlow:
     retry_count: int = 0
     parent_flow_id: Optional[str] = None
     
+    # 存储：压缩后的请求体 / 响应内容（_spilled 表示已转存到磁盘），_size 为计入预算的字节数
+    _payload: Optional[bytes] = field(default=None, repr=False, compare=False)
+    _spilled: bool = field(default=False, repr=False, compare=False)
+    _size: int = field(default=0, repr=False, compare=False)
+    
+    @property
+    def compacted(self) -> bool:
+        return self._payload is not None or self._spilled
+    
     def to_dict(self) -> dict:
         """转换为字典"""
         d = {
@@ -146,6 +188,7 @@ class LLMFlow:
             "protocol": self.protocol,
             "account_id": self.account_id,
             "account_name": self.account_name,
+            "session_id": self.session_id,
             "timing": {
                 "created_at": self.timing.created_at,
                 "first_byte_at": self.timing.first_byte_at,
@@ -165,15 +208,15 @@ class LLMFlow:
                 "path": self.request.path,
                 "model": self.request.model,
                 "stream": self.request.stream,
-                "message_count": len(self.request.messages),
-                "has_tools": bool(self.request.tools),
-                "has_system": bool(self.request.system),
+                "message_count": self.request.message_count,
+                "has_tools": self.request.has_tools,
+                "has_system": self.request.has_system,
             }
         
         if self.response:
             d["response"] = {
                 "status_code": self.response.status_code,
-                "content_length": len(self.response.content),
+                "content_length": self.response.content_length if self.compacted else len(self.response.text),
                 "has_tool_calls": bool(self.response.tool_calls),
                 "stop_reason": self.response.stop_reason,
                 "chunk_count": self.response.chunk_count,
@@ -199,41 +242,323 @@ class LLMFlow:
         if self.response:
             d["response"]["headers"] = self.response.headers
             d["response"]["body"] = self.response.body
-            d["response"]["content"] = self.response.content
+            d["response"]["content"] = self.response.text
             d["response"]["tool_calls"] = self.response.tool_calls
             d["response"]["chunks"] = self.response.chunks[-10:]  # 只保留最后10个chunk
         
         return d
 
 
+def _build_request(method: str, path: str, headers: Dict[str, str], body: Dict[str, Any]) -> FlowRequest:
+    """解析请求体"""
+    request = FlowRequest(
+        method=method,
+        path=path,
+        headers={k: v for k, v in headers.items() if k.lower() not in ["authorization"]},
+        body=body,
+        model=body.get("model", ""),
+        stream=body.get("stream", False),
+        system=body.get("system", ""),
+        tools=body.get("tools", []),
+        max_tokens=body.get("max_tokens", 0),
+        temperature=body.get("temperature", 1.0),
+    )
+    
+    # 解析消息
+    messages = body.get("messages", [])
+    for msg in messages:
+        request.messages.append(Message(
+            role=msg.get("role", "user"),
+            content=msg.get("content", ""),
+            name=msg.get("name"),
+            tool_call_id=msg.get("tool_call_id"),
+        ))
+    
+    request.message_count = len(request.messages)
+    request.has_tools = bool(request.tools)
+    request.has_system = bool(request.system)
+    return request
+
+
+class FlowSegment:
+    """磁盘段 - 存放转存出内存的压缩 Flow 数据以及 Flow 索引（SQLite）
+    
+    未指定目录时使用临时文件，关闭时删除；内容只是缓存，不需要在重启后保留。
+    """
+    
+    def __init__(self, directory: Optional[Path] = None):
+        self.directory = directory
+        self.path: Optional[Path] = None
+        self._db: Optional[sqlite3.Connection] = None
+        self._temporary = False
+    
+    def connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            if self.directory is not None:
+                Path(self.directory).mkdir(parents=True, exist_ok=True)
+                self.path = Path(self.directory) / f"flows-{os.getpid()}.db"
+                if self.path.exists():
+                    self.path.unlink()
+            else:
+                fd, name = tempfile.mkstemp(prefix="kiro-flows-", suffix=".db")
+                os.close(fd)
+                self.path = Path(name)
+                self._temporary = True
+            self._db = sqlite3.connect(str(self.path), isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=MEMORY")
+            self._db.execute("PRAGMA synchronous=OFF")
+            self._db.execute("CREATE TABLE IF NOT EXISTS blobs (id TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        return self._db
+    
+    def put(self, flow_id: str, data: bytes):
+        self.connection().execute("INSERT OR REPLACE INTO blobs (id, data) VALUES (?, ?)", (flow_id, data))
+    
+    def get(self, flow_id: str) -> Optional[bytes]:
+        row = self.connection().execute("SELECT data FROM blobs WHERE id = ?", (flow_id,)).fetchone()
+        return row[0] if row else None
+    
+    def delete(self, flow_id: str):
+        if self._db is not None:
+            self._db.execute("DELETE FROM blobs WHERE id = ?", (flow_id,))
+    
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            if self.path is not None:
+                try:
+                    self.path.unlink()
+                except OSError:
+                    pass
+
+
+class FlowIndex:
+    """Flow 二级索引（与磁盘段共用一个 SQLite 库）
+    
+    - flows 表存放过滤字段（模型、账号、状态、时间、耗时等），各列建索引
+    - flow_text 为 FTS5 全文索引（trigram 分词，支持任意子串、不区分大小写），
+      每个 Flow 两行：创建时写入请求文本（rowid = seq*2），结束时写入响应文本（seq*2+1），
+      结束时不必重新分词请求文本
+    - SQLite 不支持 FTS5 / trigram 时退化为普通表上的 LIKE 查询
+    任何 SQLite 错误都会停用索引，查询退回逐条扫描。
+    """
+    
+    TEXT_LIMIT = 64 * 1024   # 每段文本索引的最大字符数（超出时保留末尾，即最新的消息；
+                             # 多轮会话的早期消息已在之前的 Flow 中索引过）
+    
+    def __init__(self, segment: FlowSegment):
+        self.segment = segment
+        self.available = True
+        self.fts = False
+        self._ready: Optional[sqlite3.Connection] = None
+        self._seqs: Dict[str, int] = {}
+    
+    def _db(self) -> sqlite3.Connection:
+        db = self.segment.connection()
+        if db is not self._ready:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS flows (
+                    seq INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    protocol TEXT,
+                    model TEXT,
+                    account_id TEXT,
+                    state TEXT,
+                    has_error INTEGER NOT NULL DEFAULT 0,
+                    bookmarked INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL,
+                    duration_ms REAL
+                );
+                CREATE INDEX IF NOT EXISTS flows_model ON flows (model);
+                CREATE INDEX IF NOT EXISTS flows_account ON flows (account_id);
+                CREATE INDEX IF NOT EXISTS flows_state ON flows (state);
+                CREATE INDEX IF NOT EXISTS flows_created ON flows (created_at);
+                CREATE INDEX IF NOT EXISTS flows_duration ON flows (duration_ms);
+            """)
+            try:
+                db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS flow_text USING fts5(text, tokenize='trigram')")
+                self.fts = True
+            except sqlite3.OperationalError:
+                db.execute("CREATE TABLE IF NOT EXISTS flow_text (rowid INTEGER PRIMARY KEY, text TEXT)")
+            self._ready = db
+        return db
+    
+    def _run(self, action: str, fn):
+        if not self.available:
+            return None
+        try:
+            return fn(self._db())
+        except sqlite3.Error as e:
+            print(f"[FlowMonitor] 索引{action}失败，改为逐条扫描: {e}")
+            self.available = False
+            return None
+    
+    @classmethod
+    def _clip(cls, text: str) -> str:
+        return text if len(text) <= cls.TEXT_LIMIT else text[-cls.TEXT_LIMIT:]
+    
+    @staticmethod
+    def _fields(flow: LLMFlow) -> tuple:
+        return (
+            flow.state.value,
+            int(flow.error is not None),
+            int(flow.bookmarked),
+            flow.timing.duration_ms,
+        )
+    
+    def add(self, flow: LLMFlow):
+        """创建 Flow 时写入过滤字段和请求文本"""
+        request = flow.request
+        model = request.model if request else None
+        text = json.dumps(request.body, ensure_ascii=False, default=str) if request else ""
+        
+        def insert(db):
+            cur = db.execute(
+                "INSERT INTO flows (id, protocol, model, account_id, created_at, state, has_error, bookmarked, duration_ms)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (flow.id, flow.protocol, model, flow.account_id, flow.timing.created_at, *self._fields(flow)),
+            )
+            seq = self._seqs[flow.id] = cur.lastrowid
+            db.execute("INSERT INTO flow_text (rowid, text) VALUES (?, ?)", (seq * 2, self._clip(text)))
+        
+        self._run("写入", insert)
+    
+    def update(self, flow: LLMFlow, response_text: Optional[str] = None):
+        """状态 / 书签变化时更新过滤字段；Flow 结束时补上响应文本"""
+        seq = self._seqs.get(flow.id)
+        if seq is None:
+            return
+        
+        def update(db):
+            db.execute(
+                "UPDATE flows SET state = ?, has_error = ?, bookmarked = ?, duration_ms = ? WHERE seq = ?",
+                (*self._fields(flow), seq),
+            )
+            if response_text:
+                db.execute(
+                    "INSERT OR REPLACE INTO flow_text (rowid, text) VALUES (?, ?)",
+                    (seq * 2 + 1, self._clip(response_text)),
+                )
+        
+        self._run("更新", update)
+    
+    def delete(self, flow_id: str):
+        seq = self._seqs.pop(flow_id, None)
+        if seq is None:
+            return
+        
+        def delete(db):
+            db.execute("DELETE FROM flows WHERE seq = ?", (seq,))
+            db.execute("DELETE FROM flow_text WHERE rowid IN (?, ?)", (seq * 2, seq * 2 + 1))
+        
+        self._run("删除", delete)
+    
+    def query(self, filters: Dict[str, Any], search: Optional[str], limit: int, offset: int) -> Optional[Tuple[List[str], int]]:
+        """按条件查询，返回 (本页 Flow id（最新在前）, 匹配总数)；索引不可用时返回 None"""
+        where, params = [], []
+        for column in ("protocol", "model", "account_id", "state"):
+            if filters.get(column):
+                where.append(f"{column} = ?")
+                params.append(filters[column])
+        for column in ("has_error", "bookmarked"):
+            if filters.get(column) is not None:
+                where.append(f"{column} = ?")
+                params.append(int(filters[column]))
+        # 没有耗时（未结束）的 Flow 不按耗时过滤
+        if filters.get("min_duration_ms"):
+            where.append("(duration_ms IS NULL OR duration_ms >= ?)")
+            params.append(filters["min_duration_ms"])
+        if filters.get("max_duration_ms"):
+            where.append("(duration_ms IS NULL OR duration_ms <= ?)")
+            params.append(filters["max_duration_ms"])
+        if filters.get("start_time"):
+            where.append("created_at >= ?")
+            params.append(filters["start_time"])
+        if filters.get("end_time"):
+            where.append("created_at <= ?")
+            params.append(filters["end_time"])
+        if search:
+            if self.fts and len(search) >= 3:
+                where.append("seq IN (SELECT rowid / 2 FROM flow_text WHERE flow_text MATCH ?)")
+                params.append('"' + search.replace('"', '""') + '"')
+            else:
+                pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                where.append("seq IN (SELECT rowid / 2 FROM flow_text WHERE text LIKE ? ESCAPE '\\')")
+                params.append(pattern)
+        clause = f" WHERE {' AND '.join(where)}" if where else ""
+        
+        def select(db):
+            total = db.execute(f"SELECT COUNT(*) FROM flows{clause}", params).fetchone()[0]
+            rows = db.execute(
+                f"SELECT id FROM flows{clause} ORDER BY seq DESC LIMIT ? OFFSET ?",
+                (*params, limit, offset),
+            ).fetchall()
+            return [row[0] for row in rows], total
+        
+        return self._run("查询", select)
+
+
 class FlowStore:
-    """Flow 存储"""
+    """Flow 存储
+    
+    max_bytes 限制内存中 Flow 数据（压缩数据块 + 进行中 Flow 的请求体估算）的总量，
+    超出时把最旧的压缩数据块转存到磁盘段。
+    """
+    
+    COMPRESS_LEVEL = 1      # 压缩级别（速度优先）
+    FLOW_OVERHEAD = 1024    # 每个 Flow 摘要字段的估算字节数
+    KEEP_CHUNKS = 10        # 完成后保留的最后几个流式块
     
-    def __init__(self, max_flows: int = 500, persist_dir: Optional[Path] = None):
+    def __init__(self, max_flows: int = 500, persist_dir: Optional[Path] = None, max_bytes: int = 64 * 1024 * 1024):
         self.flows: deque[LLMFlow] = deque(maxlen=max_flows)
         self.flow_map: Dict[str, LLMFlow] = {}
         self.persist_dir = persist_dir
         self.max_flows = max_flows
+        self.max_bytes = max_bytes
+        self.segment = FlowSegment(persist_dir)
+        self.index = FlowIndex(self.segment)
+        
+        # 内存中持有压缩数据块的 Flow（按完成顺序，转存时从最旧的开始）
+        self._resident: "OrderedDict[str, LLMFlow]" = OrderedDict()
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self.spilled_flows = 0
         
         # 统计
         self.total_flows = 0
         self.total_tokens_in = 0
         self.total_tokens_out = 0
     
-    def add(self, flow: LLMFlow):
-        """添加 Flow"""
+    def add(self, flow: LLMFlow, size_hint: int = 0):
+        """添加 Flow（size_hint 为请求体大小估算，计入字节预算）"""
         # 如果队列满了，移除最旧的
         if len(self.flows) >= self.max_flows:
-            old = self.flows[0]
-            if old.id in self.flow_map:
-                del self.flow_map[old.id]
+            self._discard(self.flows[0])
         
         self.flows.append(flow)
         self.flow_map[flow.id] = flow
+        self.index.add(flow)
         self.total_flows += 1
+        flow._size = self.FLOW_OVERHEAD + size_hint
+        self.memory_bytes += flow._size
+        self._enforce_budget()
+    
+    def _discard(self, flow: LLMFlow):
+        """移除 Flow 并释放其占用"""
+        if self.flow_map.get(flow.id) is flow:
+            del self.flow_map[flow.id]
+        self._resident.pop(flow.id, None)
+        self.index.delete(flow.id)
+        if flow._spilled:
+            self.segment.delete(flow.id)
+            self.spilled_bytes -= flow._size
+            self.spilled_flows -= 1
+        else:
+            self.memory_bytes -= flow._size
+        flow._size = 0
     
     def get(self, flow_id: str) -> Optional[LLMFlow]:
-        """获取 Flow"""
+        """获取 Flow（可能是压缩后的摘要，需要完整内容时用 load）"""
         return self.flow_map.get(flow_id)
     
     def update(self, flow_id: str, **kwargs):
@@ -243,8 +568,107 @@ class FlowStore:
             for k, v in kwargs.items():
                 if hasattr(flow, k):
                     setattr(flow, k, v)
+            self.index.update(flow)
+    
+    def reindex(self, flow: LLMFlow):
+        """状态 / 书签变化后更新索引"""
+        if self.flow_map.get(flow.id) is flow:
+            self.index.update(flow)
+    
+    # ==================== 压缩 / 转存 ====================
+    
+    def seal(self, flow: LLMFlow):
+        """Flow 结束时调用：拼接流式块，请求体和响应内容压缩为一个数据块"""
+        if flow.compacted or self.flow_map.get(flow.id) is not flow:
+            return
+        response = flow.response
+        if response is not None:
+            response.content = response.text
+            response.content_length = len(response.content)
+            response.chunks = response.chunks[-self.KEEP_CHUNKS:]
+        self.index.update(flow, response.content if response else None)
+        request = flow.request
+        payload = {
+            "body": request.body if request else None,
+            "response": {
+                "content": response.content,
+                "tool_calls": response.tool_calls,
+                "body": response.body,
+            } if response else None,
+        }
+        data = zlib.compress(
+            json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8"),
+            self.COMPRESS_LEVEL,
+        )
+        if request is not None:
+            request.body = {}
+            request.messages = []
+            request.system = ""
+            request.tools = []
+        if response is not None:
+            response.content = ""
+            response.tool_calls = []
+            response.body = None
+        flow._payload = data
+        self.memory_bytes -= flow._size
+        flow._size = self.FLOW_OVERHEAD + len(data)
+        self.memory_bytes += flow._size
+        self._resident[flow.id] = flow
+        self._enforce_budget()
+    
+    def _enforce_budget(self):
+        """超出字节预算时把最旧的压缩数据块转存到磁盘段"""
+        while self.memory_bytes > self.max_bytes and self._resident:
+            flow_id, flow = next(iter(self._resident.items()))
+            try:
+                self.segment.put(flow_id, flow._payload)
+            except sqlite3.Error as e:
+                print(f"[FlowMonitor] 转存到磁盘失败: {e}")
+                return
+            del self._resident[flow_id]
+            self.memory_bytes -= flow._size
+            self.spilled_bytes += flow._size
+            self.spilled_flows += 1
+            flow._payload = None
+            flow._spilled = True
+    
+    def _read_payload(self, flow: LLMFlow) -> Optional[dict]:
+        data = flow._payload
+        if data is None and flow._spilled:
+            try:
+                data = self.segment.get(flow.id)
+            except sqlite3.Error as e:
+                print(f"[FlowMonitor] 读取磁盘数据失败: {e}")
+        if data is None:
+            return None
+        return json.loads(zlib.decompress(data).decode("utf-8"))
     
-    def query(
+    def load(self, flow: LLMFlow) -> LLMFlow:
+        """返回包含完整请求体 / 响应内容的 Flow（压缩过的 Flow 解压为副本，存储中仍是压缩形式）"""
+        if not flow.compacted:
+            return flow
+        payload = self._read_payload(flow)
+        if payload is None:
+            return flow
+        request = flow.request
+        if request is not None and payload.get("body") is not None:
+            request = _build_request(request.method, request.path, request.headers, payload["body"])
+        response = flow.response
+        if response is not None and payload.get("response") is not None:
+            data = payload["response"]
+            response = replace(
+                response,
+                content=data.get("content", ""),
+                tool_calls=data.get("tool_calls") or [],
+                body=data.get("body"),
+            )
+        return replace(flow, request=request, response=response, _payload=None, _spilled=False, _size=0)
+    
+    def query(self, **kwargs) -> List[LLMFlow]:
+        """查询 Flows（最新在前）"""
+        return self.query_page(**kwargs)[0]
+    
+    def query_page(
         self,
         protocol: Optional[str] = None,
         model: Optional[str] = None,
@@ -259,48 +683,87 @@ class FlowStore:
         search: Optional[str] = None,
         limit: int = 100,
         offset: int = 0,
-    ) -> List[LLMFlow]:
-        """查询 Flows"""
+    ) -> Tuple[List[LLMFlow], int]:
+        """分页查询，返回 (本页 Flows, 匹配总数)；优先走索引，索引不可用时逐条扫描"""
+        filters = {
+            "protocol": protocol,
+            "model": model,
+            "account_id": account_id,
+            "state": state.value if state else None,
+            "has_error": has_error,
+            "bookmarked": bookmarked,
+            "min_duration_ms": min_duration_ms,
+            "max_duration_ms": max_duration_ms,
+            "start_time": start_time,
+            "end_time": end_time,
+        }
+        limit, offset = max(0, limit), max(0, offset)
+        result = self.index.query(filters, search, limit, offset)
+        if result is not None:
+            ids, total = result
+            return [self.flow_map[fid] for fid in ids if fid in self.flow_map], total
+        return self._scan(filters, search, limit, offset)
+    
+    def _scan(self, filters: Dict[str, Any], search: Optional[str], limit: int, offset: int) -> Tuple[List[LLMFlow], int]:
+        """逐条扫描（索引不可用时）"""
         results = []
+        search = search.lower() if search else None
         
         for flow in reversed(self.flows):
             # 过滤条件
-            if protocol and flow.protocol != protocol:
+            if filters["protocol"] and flow.protocol != filters["protocol"]:
                 continue
-            if model and flow.request and flow.request.model != model:
+            if filters["model"] and flow.request and flow.request.model != filters["model"]:
                 continue
-            if account_id and flow.account_id != account_id:
+            if filters["account_id"] and flow.account_id != filters["account_id"]:
                 continue
-            if state and flow.state != state:
+            if filters["state"] and flow.state.value != filters["state"]:
                 continue
-            if has_error is not None:
-                if has_error and not flow.error:
-                    continue
-                if not has_error and flow.error:
-                    continue
-            if bookmarked is not None and flow.bookmarked != bookmarked:
+            if filters["has_error"] is not None and bool(flow.error) != filters["has_error"]:
                 continue
-            if min_duration_ms and flow.timing.duration_ms and flow.timing.duration_ms < min_duration_ms:
+            if filters["bookmarked"] is not None and flow.bookmarked != filters["bookmarked"]:
                 continue
-            if max_duration_ms and flow.timing.duration_ms and flow.timing.duration_ms > max_duration_ms:
+            duration = flow.timing.duration_ms
+            if filters["min_duration_ms"] and duration and duration < filters["min_duration_ms"]:
                 continue
-            if start_time and flow.timing.created_at < start_time:
+            if filters["max_duration_ms"] and duration and duration > filters["max_duration_ms"]:
                 continue
-            if end_time and flow.timing.created_at > end_time:
+            if filters["start_time"] and flow.timing.created_at < filters["start_time"]:
+                continue
+            if filters["end_time"] and flow.timing.created_at > filters["end_time"]:
                 continue
             if search:
-                # 简单搜索：在内容中查找
+                # 在内容中查找（压缩过的 Flow 需要解压）
+                full = self.load(flow)
                 found = False
-                if flow.request and search.lower() in json.dumps(flow.request.body).lower():
+                if full.request and search in json.dumps(full.request.body, ensure_ascii=False, default=str).lower():
                     found = True
-                if flow.response and search.lower() in flow.response.content.lower():
+                if full.response and search in full.response.text.lower():
                     found = True
                 if not found:
                     continue
             
             results.append(flow)
         
-        return results[offset:offset + limit]
+        return results[offset:offset + limit], len(results)
+    
+    def get_storage_stats(self) -> dict:
+        """内存 / 磁盘占用"""
+        return {
+            "max_bytes": self.max_bytes,
+            "memory_bytes": self.memory_bytes,
+            "spilled_bytes": self.spilled_bytes,
+            "spilled_flows": self.spilled_flows,
+            "segment": str(self.segment.path) if self.segment.path else None,
+            "index": {
+                "available": self.index.available,
+                "fts": self.index.fts,
+                "rows": len(self.index._seqs),
+            },
+        }
+    
+    def close(self):
+        self.segment.close()
     
     def get_stats(self) -> dict:
         """获取统计信息"""
@@ -335,6 +798,7 @@ class FlowStore:
             "total_tokens_in": self.total_tokens_in,
             "total_tokens_out": self.total_tokens_out,
             "by_model": model_stats,
+            "storage": self.get_storage_stats(),
         }
     
     def export_jsonl(self, flows: List[LLMFlow]) -> str:
@@ -403,11 +867,128 @@ class FlowStore:
         return "\n".join(lines)
 
 
+@dataclass
+class CaptureConfig:
+    """Flow 采集策略"""
+    # 采样比例（百分比，0-100）
+    sample_rate: float = 100.0
+    
+    # 未采样的请求出错时仍然记录
+    always_on_error: bool = True
+    
+    # 书签 Flow 所在会话的后续请求总是记录
+    always_bookmarked_sessions: bool = True
+    
+    # 记录队列长度上限，队列满时丢弃事件
+    queue_size: int = 10000
+
+
 class FlowMonitor:
-    """Flow 监控器"""
+    """Flow 监控器
     
-    def __init__(self, max_flows: int = 500):
-        self.store = FlowStore(max_flows=max_flows)
+    请求路径上只把参数引用放入有界队列（O(1)），解析请求体、压缩、转存都由记录线程完成；
+    未被采样的请求不入队。记录线程未启动时（CLI、测试）直接同步写入。
+    """
+    
+    # 未采样请求为"出错时补录"暂存参数的条数上限
+    MAX_DEFERRED = 1000
+    # 补录时保留的请求体字段（只留摘要，暂存的参数不随请求体大小增长）
+    DEFERRED_BODY_FIELDS = ("model", "stream", "max_tokens", "temperature")
+    
+    def __init__(self, max_flows: int = 500, max_bytes: int = 64 * 1024 * 1024, persist_dir: Optional[Path] = None):
+        self.store = FlowStore(max_flows=max_flows, persist_dir=persist_dir, max_bytes=max_bytes)
+        self.capture = CaptureConfig()
+        self._bookmarked_sessions: set = set()
+        # flow_id -> [create 参数, created_at, first_byte_at]
+        self._deferred: "OrderedDict[str, list]" = OrderedDict()
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.RLock()
+        self.sampled_out = 0
+        self.error_captures = 0
+        self.dropped = 0
+    
+    def configure(self, max_flows: int = None, max_memory_mb: float = None, spill_dir: str = None):
+        """按参数或 config.json 的 "flow_monitor" 配置重建存储、设置采集策略（启动时调用）"""
+        from .persistence import load_config
+        config = load_config().get("flow_monitor", {})
+        self.update_config(**config.get("capture", {}))
+        max_flows = max_flows or config.get("max_flows", self.store.max_flows)
+        max_memory_mb = max_memory_mb or config.get("max_memory_mb", self.store.max_bytes / 1024 / 1024)
+        spill_dir = spill_dir or config.get("spill_dir")
+        store = self.store
+        if (max_flows, int(max_memory_mb * 1024 * 1024), spill_dir) == (store.max_flows, store.max_bytes, store.persist_dir):
+            return
+        store.close()
+        self.store = FlowStore(
+            max_flows=max_flows,
+            persist_dir=Path(spill_dir) if spill_dir else None,
+            max_bytes=int(max_memory_mb * 1024 * 1024),
+        )
+    
+    def get_config(self) -> dict:
+        return asdict(self.capture)
+    
+    def update_config(self, **kwargs):
+        """更新采集策略"""
+        for key, value in kwargs.items():
+            if hasattr(self.capture, key):
+                setattr(self.capture, key, value)
+        self.capture.sample_rate = min(100.0, max(0.0, float(self.capture.sample_rate)))
+    
+    # ==================== 后台记录 ====================
+    
+    def start(self):
+        """启动记录线程（在应用 lifespan 中调用）"""
+        if self._thread is None or not self._thread.is_alive():
+            self._queue = queue.Queue(maxsize=self.capture.queue_size)
+            self._thread = threading.Thread(
+                target=self._record_loop, args=(self._queue,), name="flow-recorder", daemon=True,
+            )
+            self._thread.start()
+    
+    async def stop(self):
+        """停止记录线程，等待队列中剩余的事件写入"""
+        events, self._queue = self._queue, None
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            await asyncio.to_thread(events.put, None)
+            await asyncio.to_thread(thread.join)
+    
+    def _record_loop(self, events: queue.Queue):
+        """记录线程：逐个写入事件，收到 None 时退出"""
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            self._apply(*event)
+    
+    def _emit(self, op: str, *args):
+        events = self._queue
+        if events is None:
+            self._apply(op, *args)
+            return
+        try:
+            events.put_nowait((op, *args))
+        except queue.Full:
+            self.dropped += 1
+    
+    def _apply(self, op: str, *args):
+        try:
+            with self._lock:
+                getattr(self, f"_record_{op}")(*args)
+        except Exception as e:
+            print(f"[FlowMonitor] 记录 {op} 失败: {e}")
+    
+    # ==================== 请求路径（只入队） ====================
+    
+    def _sampled(self, session_id: Optional[str]) -> bool:
+        capture = self.capture
+        if capture.sample_rate >= 100:
+            return True
+        if session_id and capture.always_bookmarked_sessions and session_id in self._bookmarked_sessions:
+            return True
+        return capture.sample_rate > 0 and random.random() * 100 < capture.sample_rate
     
     def create_flow(
         self,
@@ -418,33 +999,78 @@ class FlowMonitor:
         body: Dict[str, Any],
         account_id: Optional[str] = None,
         account_name: Optional[str] = None,
-    ) -> str:
-        """创建新的 Flow"""
-        flow_id = uuid.uuid4().hex[:12]
+        session_id: Optional[str] = None,
+    ) -> Optional[str]:
+        """创建新的 Flow，未被采样且无需出错补录时返回 None"""
+        sampled = self._sampled(session_id)
+        if not sampled and not self.capture.always_on_error:
+            self.sampled_out += 1
+            return None
         
-        # 解析请求
-        request = FlowRequest(
-            method=method,
-            path=path,
-            headers={k: v for k, v in headers.items() if k.lower() not in ["authorization"]},
-            body=body,
-            model=body.get("model", ""),
-            stream=body.get("stream", False),
-            system=body.get("system", ""),
-            tools=body.get("tools", []),
-            max_tokens=body.get("max_tokens", 0),
-            temperature=body.get("temperature", 1.0),
-        )
-        
-        # 解析消息
-        messages = body.get("messages", [])
-        for msg in messages:
-            request.messages.append(Message(
-                role=msg.get("role", "user"),
-                content=msg.get("content", ""),
-                name=msg.get("name"),
-                tool_call_id=msg.get("tool_call_id"),
-            ))
+        flow_id = uuid.uuid4().hex[:12]
+        if sampled:
+            args = (flow_id, protocol, method, path, headers, body, account_id, account_name, session_id)
+            self._emit("create", args, time.time())
+        else:
+            summary = {k: body[k] for k in self.DEFERRED_BODY_FIELDS if k in body}
+            args = (flow_id, protocol, method, path, headers, summary, account_id, account_name, session_id)
+            deferred = self._deferred
+            deferred[flow_id] = [args, time.time(), None]
+            if len(deferred) > self.MAX_DEFERRED:
+                deferred.popitem(last=False)
+        return flow_id
+    
+    def start_streaming(self, flow_id: str):
+        """标记开始流式传输"""
+        if not flow_id:
+            return
+        deferred = self._deferred.get(flow_id)
+        if deferred is not None:
+            deferred[2] = time.time()
+            return
+        self._emit("start_streaming", flow_id, time.time())
+    
+    def add_chunk(self, flow_id: str, chunk: str):
+        """添加流式响应块"""
+        if flow_id and flow_id not in self._deferred:
+            self._emit("chunk", flow_id, chunk)
+    
+    def complete_flow(
+        self,
+        flow_id: str,
+        status_code: int,
+        content: str = "",
+        tool_calls: List[Dict] = None,
+        stop_reason: str = "",
+        usage: Optional[TokenUsage] = None,
+        headers: Dict[str, str] = None,
+    ):
+        """完成 Flow"""
+        if not flow_id:
+            return
+        if self._deferred.pop(flow_id, None) is not None:
+            self.sampled_out += 1
+            return
+        self._emit("complete", flow_id, time.time(), status_code, content, tool_calls, stop_reason, usage, headers)
+    
+    def fail_flow(self, flow_id: str, error_type: str, message: str, status_code: int = 0, raw: str = ""):
+        """标记 Flow 失败（未采样的请求在此补录）"""
+        if not flow_id:
+            return
+        deferred = self._deferred.pop(flow_id, None)
+        if deferred is not None:
+            args, created_at, first_byte_at = deferred
+            self.error_captures += 1
+            self._emit("create", args, created_at)
+            if first_byte_at is not None:
+                self._emit("start_streaming", flow_id, first_byte_at)
+        self._emit("fail", flow_id, time.time(), error_type, message, status_code, raw)
+    
+    # ==================== 写入存储（记录任务中执行） ====================
+    
+    def _record_create(self, args: tuple, created_at: float):
+        flow_id, protocol, method, path, headers, body, account_id, account_name, session_id = args
+        request = _build_request(method, path, headers, body)
         
         flow = LLMFlow(
             id=flow_id,
@@ -452,120 +1078,149 @@ class FlowMonitor:
             protocol=protocol,
             account_id=account_id,
             account_name=account_name,
+            session_id=session_id,
             request=request,
-            timing=FlowTiming(created_at=time.time()),
+            timing=FlowTiming(created_at=created_at),
         )
         
-        self.store.add(flow)
-        return flow_id
+        # 请求体大小按 Content-Length 估算，不为此序列化
+        try:
+            size_hint = int(request.headers.get("content-length", 0))
+        except (TypeError, ValueError):
+            size_hint = 0
+        self.store.add(flow, size_hint)
     
-    def start_streaming(self, flow_id: str):
-        """标记开始流式传输"""
+    def _record_start_streaming(self, flow_id: str, at: float):
         flow = self.store.get(flow_id)
         if flow:
             flow.state = FlowState.STREAMING
-            flow.timing.first_byte_at = time.time()
+            flow.timing.first_byte_at = at
             if not flow.response:
                 flow.response = FlowResponse(status_code=200)
+            self.store.reindex(flow)
     
-    def add_chunk(self, flow_id: str, chunk: str):
-        """添加流式响应块"""
+    def _record_chunk(self, flow_id: str, chunk: str):
         flow = self.store.get(flow_id)
         if flow and flow.response:
             flow.response.chunks.append(chunk)
             flow.response.chunk_count += 1
-            flow.response.content += chunk
     
-    def complete_flow(
-        self,
-        flow_id: str,
-        status_code: int,
-        content: str = "",
-        tool_calls: List[Dict] = None,
-        stop_reason: str = "",
-        usage: Optional[TokenUsage] = None,
-        headers: Dict[str, str] = None,
-    ):
-        """完成 Flow"""
+    def _record_complete(self, flow_id, at, status_code, content, tool_calls, stop_reason, usage, headers):
         flow = self.store.get(flow_id)
         if not flow:
             return
         
         flow.state = FlowState.COMPLETED
-        flow.timing.completed_at = time.time()
+        flow.timing.completed_at = at
         
         if not flow.response:
             flow.response = FlowResponse(status_code=status_code)
         
         flow.response.status_code = status_code
-        flow.response.content = content or flow.response.content
+        flow.response.content = content or flow.response.text
         flow.response.tool_calls = tool_calls or []
         flow.response.stop_reason = stop_reason
-        flow.response.headers = headers or {}
+        flow.response.headers = dict(headers or {})
         
         if usage:
             flow.response.usage = usage
             self.store.total_tokens_in += usage.input_tokens
             self.store.total_tokens_out += usage.output_tokens
+        
+        self.store.seal(flow)
     
-    def fail_flow(self, flow_id: str, error_type: str, message: str, status_code: int = 0, raw: str = ""):
-        """标记 Flow 失败"""
+    def _record_fail(self, flow_id, at, error_type, message, status_code, raw):
         flow = self.store.get(flow_id)
         if not flow:
             return
         
         flow.state = FlowState.ERROR
-        flow.timing.completed_at = time.time()
+        flow.timing.completed_at = at
         flow.error = FlowError(
             type=error_type,
             message=message,
             status_code=status_code,
             raw=raw[:1000],  # 限制长度
         )
+        self.store.seal(flow)
+    
+    # ==================== 管理 ====================
     
     def bookmark_flow(self, flow_id: str, bookmarked: bool = True):
-        """书签 Flow"""
-        flow = self.store.get(flow_id)
-        if flow:
-            flow.bookmarked = bookmarked
+        """书签 Flow（同一会话的后续请求总是记录）"""
+        with self._lock:
+            flow = self.store.get(flow_id)
+            if flow:
+                flow.bookmarked = bookmarked
+                self.store.reindex(flow)
+                if flow.session_id:
+                    if bookmarked:
+                        self._bookmarked_sessions.add(flow.session_id)
+                    elif not any(f.bookmarked and f.session_id == flow.session_id for f in self.store.flows):
+                        self._bookmarked_sessions.discard(flow.session_id)
     
     def add_note(self, flow_id: str, note: str):
         """添加备注"""
-        flow = self.store.get(flow_id)
-        if flow:
-            flow.notes = note
+        with self._lock:
+            flow = self.store.get(flow_id)
+            if flow:
+                flow.notes = note
     
     def add_tag(self, flow_id: str, tag: str):
         """添加标签"""
-        flow = self.store.get(flow_id)
-        if flow and tag not in flow.tags:
-            flow.tags.append(tag)
+        with self._lock:
+            flow = self.store.get(flow_id)
+            if flow and tag not in flow.tags:
+                flow.tags.append(tag)
     
     def get_flow(self, flow_id: str) -> Optional[LLMFlow]:
-        """获取 Flow"""
-        return self.store.get(flow_id)
+        """获取 Flow（含完整请求体 / 响应内容）"""
+        with self._lock:
+            flow = self.store.get(flow_id)
+            return self.store.load(flow) if flow else None
     
     def query(self, **kwargs) -> List[LLMFlow]:
         """查询 Flows"""
-        return self.store.query(**kwargs)
+        with self._lock:
+            return self.store.query(**kwargs)
+    
+    def query_page(self, **kwargs) -> Tuple[List[LLMFlow], int]:
+        """分页查询 Flows，返回 (本页 Flows, 匹配总数)"""
+        with self._lock:
+            return self.store.query_page(**kwargs)
     
     def get_stats(self) -> dict:
         """获取统计"""
-        return self.store.get_stats()
+        with self._lock:
+            stats = self.store.get_stats()
+            stats["capture"] = {
+                "sample_rate": self.capture.sample_rate,
+                "queued": self._queue.qsize() if self._queue is not None else 0,
+                "dropped": self.dropped,
+                "sampled_out": self.sampled_out,
+                "error_captures": self.error_captures,
+                "deferred": len(self._deferred),
+                "bookmarked_sessions": len(self._bookmarked_sessions),
+            }
+            return stats
     
     def export(self, flow_ids: List[str] = None, format: str = "jsonl") -> str:
         """导出 Flows"""
-        if flow_ids:
-            flows = [self.store.get(fid) for fid in flow_ids if self.store.get(fid)]
-        else:
-            flows = list(self.store.flows)
-        
-        if format == "jsonl":
-            return self.store.export_jsonl(flows)
-        elif format == "markdown" and len(flows) == 1:
-            return self.store.export_markdown(flows[0])
-        else:
-            return json.dumps([f.to_dict() for f in flows], ensure_ascii=False, indent=2)
+        with self._lock:
+            if flow_ids:
+                flows = [self.store.get(fid) for fid in flow_ids if self.store.get(fid)]
+            else:
+                flows = list(self.store.flows)
+            
+            if format == "jsonl" or (format == "markdown" and len(flows) == 1):
+                flows = [self.store.load(f) for f in flows]
+            
+            if format == "jsonl":
+                return self.store.export_jsonl(flows)
+            elif format == "markdown" and len(flows) == 1:
+                return self.store.export_markdown(flows[0])
+            else:
+                return json.dumps([f.to_dict() for f in flows], ensure_ascii=False, indent=2)
 
 
 # 全局实例
@@ -0,0 +1,145 @@
+"""对冲请求 - 降低首字节长尾延迟
+
+流式请求在截止时间内没有收到首个数据帧时，用另一个账号发出同样的
+Kiro 请求，先出数据的一方胜出，另一方立即取消：
+- 截止时间：固定值，或近期请求的 p95 TTFB（取自 stats_manager 的 TTFB 直方图，
+  与 P95_WINDOW_SECONDS 前的快照相减得到近期分布）
+- 全局对冲比例上限，避免配额消耗翻倍；请求很少时每分钟至少允许一次对冲
+- 默认关闭，需在 /api/settings/hedge 中启用
+"""
+import time
+from dataclasses import dataclass, asdict
+from typing import Optional
+from collections import deque
+
+from .stats import LatencyHistogram, stats_manager
+
+
+@dataclass
+class HedgeConfig:
+    """对冲配置"""
+    # 是否启用对冲
+    enabled: bool = False
+
+    # 固定截止时间（毫秒），use_p95 关闭或样本不足时使用
+    delay_ms: float = 3000
+
+    # 使用近期 p95 TTFB 作为截止时间
+    use_p95: bool = True
+
+    # p95 截止时间的上下限（毫秒）
+    min_delay_ms: float = 1000
+    max_delay_ms: float = 15000
+
+    # 计算 p95 所需的最少样本数
+    min_samples: int = 20
+
+    # 每分钟对冲请求数占请求总数的比例上限
+    max_hedge_ratio: float = 0.1
+
+
+class HedgePolicy:
+    """对冲决策：截止时间与全局对冲比例"""
+
+    P95_CACHE_SECONDS = 5
+    P95_WINDOW_SECONDS = 300   # 近期窗口：统计最近 5~10 分钟的样本
+
+    def __init__(self, config: HedgeConfig = None):
+        self.config = config or HedgeConfig()
+        self._requests: deque = deque()
+        self._hedges: deque = deque()
+        self._p95_ms: Optional[float] = None
+        self._p95_at: float = 0
+        self._ttfb_base: Optional[LatencyHistogram] = None  # 窗口起点的直方图快照
+        self._ttfb_next: Optional[LatencyHistogram] = None  # 下一个窗口起点
+        self._ttfb_rotated_at: float = 0
+        self.hedges_total = 0
+        self.hedge_wins = 0
+
+    def _ttfb_p95(self) -> Optional[float]:
+        """近期请求的 p95 TTFB（毫秒），短时间缓存"""
+        now = time.time()
+        if now - self._p95_at < self.P95_CACHE_SECONDS:
+            return self._p95_ms
+        ttfb = stats_manager.ttfb
+        if self._ttfb_next is None or now - self._ttfb_rotated_at >= self.P95_WINDOW_SECONDS:
+            self._ttfb_base, self._ttfb_next = self._ttfb_next, ttfb.copy()
+            self._ttfb_rotated_at = now
+        recent = ttfb.since(self._ttfb_base) if self._ttfb_base is not None else ttfb
+        self._p95_at = now
+        if recent.count < self.config.min_samples:
+            self._p95_ms = None
+        else:
+            self._p95_ms = recent.percentile(95)
+        return self._p95_ms
+
+    @staticmethod
+    def _prune(times: deque, cutoff: float) -> int:
+        """从左侧丢弃窗口外的时间戳，返回窗口内的个数"""
+        while times and times[0] <= cutoff:
+            times.popleft()
+        return len(times)
+
+    def delay_seconds(self) -> Optional[float]:
+        """本次请求的对冲截止时间（秒），未启用时返回 None"""
+        if not self.config.enabled:
+            return None
+        delay_ms = self.config.delay_ms
+        if self.config.use_p95:
+            p95 = self._ttfb_p95()
+            if p95 is not None:
+                delay_ms = min(max(p95, self.config.min_delay_ms), self.config.max_delay_ms)
+        return delay_ms / 1000
+
+    def record_request(self):
+        """记录一次可对冲的请求"""
+        now = time.time()
+        self._prune(self._requests, now - 60)
+        self._requests.append(now)
+
+    def try_acquire(self) -> bool:
+        """检查全局对冲比例，允许时记录一次对冲"""
+        now = time.time()
+        requests = self._prune(self._requests, now - 60)
+        hedges = self._prune(self._hedges, now - 60)
+        if hedges + 1 > max(1, requests * self.config.max_hedge_ratio):
+            return False
+        self._hedges.append(now)
+        self.hedges_total += 1
+        return True
+
+    def record_win(self):
+        """对冲请求先于原请求出数据"""
+        self.hedge_wins += 1
+
+    def get_stats(self) -> dict:
+        """获取统计信息"""
+        cutoff = time.time() - 60
+        return {
+            "enabled": self.config.enabled,
+            "delay_ms": round(self.delay_seconds() * 1000) if self.config.enabled else None,
+            "ttfb_p95_ms": self._ttfb_p95(),
+            "requests_per_minute": self._prune(self._requests, cutoff),
+            "hedges_per_minute": self._prune(self._hedges, cutoff),
+            "hedges_total": self.hedges_total,
+            "hedge_wins": self.hedge_wins,
+        }
+
+    def get_config(self) -> dict:
+        return asdict(self.config)
+
+    def update_config(self, **kwargs):
+        """更新配置"""
+        for key, value in kwargs.items():
+            if hasattr(self.config, key):
+                setattr(self.config, key, value)
+        self._p95_at = 0
+
+
+# 全局实例
+hedge_policy = HedgePolicy()
+
+
+def get_hedge_policy() -> HedgePolicy:
+    """获取对冲策略实例"""
+    return hedge_policy
@@ -14,6 +14,8 @@ from dataclasses import dataclass, field
 from collections import OrderedDict
 from enum import Enum
 
+from . import metrics
+
 
 @dataclass
 class SummaryCacheEntry:
@@ -55,6 +57,7 @@ class SummaryCache:
             return None
 
         self._entries.move_to_end(key)
+        metrics.history_summaries.inc("cached")
         return entry.summary
 
     def set(
@@ -220,6 +223,7 @@ class HistoryManager:
         original_count = len(history)
         truncated = history[-max_count:]
         self._truncated = True
+        metrics.history_truncations.inc("count")
         self._truncate_info = f"按数量截断: {original_count} -> {len(truncated)} 条消息"
         return truncated
     
@@ -243,6 +247,7 @@ class HistoryManager:
         
         if len(result) < original_count:
             self._truncated = True
+            metrics.history_truncations.inc("chars")
             self._truncate_info = f"按字符数截断: {original_count} -> {len(result)} 条消息 ({total_chars} -> {current_chars} 字符)"
         
         return result
@@ -477,9 +482,11 @@ class HistoryManager:
             summary = await api_caller(prompt)
             if summary and len(summary) > self.config.summary_max_length:
                 summary = summary[:self.config.summary_max_length] + "..."
+            metrics.history_summaries.inc("ok" if summary else "failed")
             return summary
         except Exception as e:
             print(f"[HistoryManager] 生成摘要失败: {e}")
+            metrics.history_summaries.inc("failed")
             return None
     
     async def compress_with_summary(
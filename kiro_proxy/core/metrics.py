@@ -0,0 +1,351 @@
+"""Prometheus 指标
+
+- GET /metrics 输出 Prometheus 文本格式（0.0.4），不依赖 prometheus_client
+- 记录点只是字典 / 列表上的自增，都在事件循环线程中执行，不加锁
+- 队列深度、账号状态等瞬时值在抓取时通过回调采集
+- 后台任务测量事件循环延迟
+- prefork 模式下每个 worker 各自计数，所有序列带 worker 标签
+- kiro_requests_total 的 account 标签有上限（超出后记为 other），
+  设置 KIRO_PROXY_METRICS_ACCOUNT_LABEL=0 可整体关闭（记为 all）
+"""
+import asyncio
+import math
+import os
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+# 请求耗时类的默认分桶（秒）
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# 事件循环延迟的分桶（秒）
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+ACCOUNT_LABEL_ENV = "KIRO_PROXY_METRICS_ACCOUNT_LABEL"
+MAX_ACCOUNT_LABELS = 50   # account 标签最多取值数，防止序列数随账号增长失控
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """指标基类"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def samples(self) -> Iterable[Tuple[str, Sequence[str], LabelValues, float]]:
+        """(指标名, 标签名, 标签值, 数值)"""
+        return ()
+
+    def render(self, const: Tuple[Tuple[str, str], ...] = ()) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        const_names = tuple(n for n, _ in const)
+        const_values = tuple(v for _, v in const)
+        for name, label_names, values, value in self.samples():
+            labels = _format_labels(const_names + tuple(label_names), const_values + tuple(values))
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """单调递增计数器"""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self):
+        for labels, value in list(self._values.items()):
+            yield self.name, self.labels, labels, value
+
+
+class Gauge(Metric):
+    """瞬时值；指定 collect 时在抓取时调用，返回 {标签值: 数值} 或单个数值"""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        collect: Optional[Callable[[], object]] = None,
+    ):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._collect = collect
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def samples(self):
+        values = self._values
+        if self._collect is not None:
+            try:
+                collected = self._collect()
+            except Exception as e:
+                print(f"[Metrics] 采集 {self.name} 失败: {e}")
+                return
+            values = collected if isinstance(collected, dict) else {(): collected}
+        for labels, value in list(values.items()):
+            yield self.name, self.labels, labels, value
+
+
+class Histogram(Metric):
+    """固定分桶直方图，observe 为一次二分查找加自增"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各桶计数..., +Inf 桶计数, sum]
+        self._series: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        bucket_labels = self.labels + ("le",)
+        for labels, series in list(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), series):
+                cumulative += n
+                yield f"{self.name}_bucket", bucket_labels, labels + (_format_value(bound),), cumulative
+            yield f"{self.name}_sum", self.labels, labels, series[-1]
+            yield f"{self.name}_count", self.labels, labels, cumulative
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"重复注册指标: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = (), collect: Callable = None) -> Gauge:
+        return self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        from ..prefork import worker_info
+        info = worker_info()
+        const = (("worker", str(info[0])),) if info else ()
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render(const))
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+# ==================== 请求 ====================
+
+requests_total = registry.counter(
+    "kiro_requests_total", "Requests handled, by protocol, model, account and HTTP status",
+    ("protocol", "model", "account", "status"),
+)
+request_duration = registry.histogram(
+    "kiro_request_duration_seconds", "End-to-end request duration", ("protocol",),
+)
+
+
+_account_labels: set = set()
+_account_label_enabled = os.environ.get(ACCOUNT_LABEL_ENV, "1").lower() not in ("0", "false", "no", "off")
+
+
+def _account_label(account_id: Optional[str]) -> str:
+    if not _account_label_enabled:
+        return "all"
+    if not account_id:
+        return "none"
+    if account_id not in _account_labels:
+        if len(_account_labels) >= MAX_ACCOUNT_LABELS:
+            return "other"
+        _account_labels.add(account_id)
+    return account_id
+
+
+def observe_request(protocol: str, model: str, account_id: Optional[str], status: int, seconds: float):
+    """请求结束时调用"""
+    requests_total.inc(protocol, model or "unknown", _account_label(account_id), str(status))
+    request_duration.observe(seconds, protocol)
+
+
+# ==================== 上游 ====================
+
+upstream_ttfb = registry.histogram(
+    "kiro_upstream_ttfb_seconds", "Time from sending the upstream request to its first byte",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 30.0, 60.0),
+)
+upstream_stream_duration = registry.histogram(
+    "kiro_upstream_stream_duration_seconds", "Time from first byte to end of the upstream stream",
+)
+http_pool_wait = registry.histogram(
+    "kiro_http_pool_wait_seconds", "Time spent waiting for an upstream HTTP connection (pool / concurrency limit)",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+upstream_retries = registry.counter(
+    "kiro_upstream_retries_total", "Upstream retries after backoff", ("protocol",),
+)
+account_switches = registry.counter(
+    "kiro_account_switches_total", "Failovers to another account", ("protocol",),
+)
+stream_resumes = registry.counter(
+    "kiro_stream_resumes_total", "Interrupted streams continued on another request", ("protocol",),
+)
+
+# ==================== 历史消息 ====================
+
+history_truncations = registry.counter(
+    "kiro_history_truncations_total", "History truncations, by kind (count / chars)", ("kind",),
+)
+history_summaries = registry.counter(
+    "kiro_history_summaries_total", "History summaries, by result (ok / failed / cached)", ("result",),
+)
+
+# ==================== 准入 / 限速 ====================
+
+admission_wait = registry.histogram(
+    "kiro_admission_wait_seconds", "Time spent queued for an account / global rate-limit slot (excludes HTTP pool wait)",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+admission_rejected = registry.counter(
+    "kiro_admission_rejected_total", "Requests rejected by admission control", ("scope", "reason"),
+)
+
+
+def _queue_depths():
+    from .admission import admission
+    depths = admission.queue_depths()
+    return {("global",): depths[0], ("account",): depths[1]}
+
+
+registry.gauge(
+    "kiro_rate_limit_queue_depth", "Requests waiting in rate-limit queues", ("scope",), collect=_queue_depths,
+)
+
+# ==================== Token ====================
+
+token_refreshes = registry.counter(
+    "kiro_token_refreshes_total", "Upstream token refreshes, by result (success / failure)", ("result",),
+)
+token_refresh_coalesced = registry.counter(
+    "kiro_token_refresh_coalesced_total", "Refresh calls that joined an in-flight refresh",
+)
+
+# ==================== 账号 ====================
+
+
+def _account_states():
+    from .state import state
+    counts: Dict[LabelValues, int] = {}
+    for acc in state.managed_accounts:
+        key = (acc.status.value if acc.enabled else "disabled",)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def _inflight():
+    from .state import state
+    return sum(state.registry.load(acc.id).inflight for acc in state.managed_accounts)
+
+
+registry.gauge("kiro_accounts", "Accounts managed by this process, by status", ("status",), collect=_account_states)
+registry.gauge("kiro_inflight_requests", "Upstream requests in flight", collect=_inflight)
+
+# ==================== 事件循环延迟 ====================
+
+event_loop_lag = registry.histogram(
+    "kiro_event_loop_lag_seconds", "How late the event loop woke up a periodic timer", buckets=LAG_BUCKETS,
+)
+event_loop_lag_last = registry.gauge(
+    "kiro_event_loop_lag_last_seconds", "Most recent event loop lag sample",
+)
+
+
+class LoopLagMonitor:
+    """定时 sleep，实际醒来时间与预期之差即事件循环延迟"""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            event_loop_lag.observe(lag)
+            event_loop_lag_last.set(lag)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+loop_monitor = LoopLagMonitor()
+
+
+def render() -> str:
+    """生成 /metrics 响应体"""
+    return registry.render()
+
+
+def get_registry() -> MetricsRegistry:
+    """获取指标注册表"""
+    return registry
+
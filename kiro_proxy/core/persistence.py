@@ -1,7 +1,19 @@
-"""配置持久化"""
+"""配置持久化
+
+- 原子写入：临时文件 + fsync + rename，进程中途崩溃不会留下半截文件
+- 延迟合并写入（write-behind）：短时间内对同一文件的多次保存合并为一次，
+  文件 I/O 在线程池中执行，不阻塞事件循环；没有事件循环时（CLI）直接同步写入
+- 配置缓存：load_config 按 mtime 复用已解析的配置，不再每次读盘
+- 文件监视：按 mtime 轮询 token 文件，Kiro IDE 等外部程序更新凭证后自动重新加载
+"""
+import asyncio
+import copy
 import json
+import os
+import stat
+import tempfile
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 
 # 配置文件路径
 CONFIG_DIR = Path.home() / ".kiro-proxy"
@@ -13,18 +25,179 @@ def ensure_config_dir():
     CONFIG_DIR.mkdir(parents=True, exist_ok=True)
 
 
+# ==================== 原子写入 ====================
+
+def atomic_write_json(path, data: Any, indent: int = 2):
+    """原子写入 JSON：写临时文件并 fsync 后 rename 覆盖
+
+    临时文件名唯一（并发写入同一文件互不干扰），创建时权限为 0600，
+    目标文件已存在时沿用其权限（凭证文件不会因此变得其他用户可读）。
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = None
+    fd, name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    tmp = Path(name)
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            if mode is not None:
+                os.chmod(tmp, mode)
+            json.dump(data, f, indent=indent, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        raise
+    if hasattr(os, "O_DIRECTORY"):
+        # 确保 rename 本身落盘
+        try:
+            fd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+
+def _merge_json(path: Path, updates: Dict[str, Any]):
+    """读取现有 JSON，合并 updates 后原子写回"""
+    existing = {}
+    if path.exists():
+        try:
+            with open(path, encoding="utf-8") as f:
+                existing = json.load(f)
+        except Exception:
+            pass
+    existing.update(updates)
+    atomic_write_json(path, existing)
+
+
+# ==================== 延迟合并写入 ====================
+
+class WriteBehind:
+    """按文件合并的延迟写入队列"""
+
+    def __init__(self, delay: float = 0.5):
+        self.delay = delay
+        # path -> ("replace", data) / ("merge", updates)
+        self._pending: Dict[Path, Tuple[str, Dict[str, Any]]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self.writes = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def is_pending(self, path) -> bool:
+        return Path(path) in self._pending
+
+    def write(self, path, data: Dict[str, Any]):
+        """整体替换文件内容"""
+        self._enqueue(Path(path), "replace", copy.deepcopy(data))
+
+    def merge(self, path, updates: Dict[str, Any]):
+        """把 updates 合并进文件现有内容"""
+        path = Path(path)
+        updates = copy.deepcopy(updates)
+        pending = self._pending.get(path)
+        if pending is not None:
+            pending[1].update(updates)
+            self.coalesced += 1
+            return
+        self._enqueue(path, "merge", updates)
+
+    def _enqueue(self, path: Path, mode: str, data: Dict[str, Any]):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 没有事件循环（CLI 等），直接同步写入
+            self._pending.pop(path, None)
+            self._apply([(path, (mode, data))])
+            return
+        if path in self._pending:
+            self.coalesced += 1
+        self._pending[path] = (mode, data)
+        if self._timer is None:
+            self._timer = loop.call_later(self.delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.create_task(self.flush())
+
+    def _take(self, path: Optional[Path] = None) -> List[Tuple[Path, Tuple[str, Dict[str, Any]]]]:
+        if path is None:
+            items = list(self._pending.items())
+            self._pending.clear()
+            return items
+        op = self._pending.pop(path, None)
+        return [(path, op)] if op is not None else []
+
+    def _apply(self, items):
+        for path, (mode, data) in items:
+            try:
+                if mode == "merge":
+                    _merge_json(path, data)
+                else:
+                    atomic_write_json(path, data)
+                self.writes += 1
+            except Exception as e:
+                self.errors += 1
+                print(f"[Persistence] 写入失败 {path}: {e}")
+
+    async def flush(self, path=None):
+        """立即写入（指定文件或全部），在线程池中执行"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # 串行执行，保证同一文件的写入顺序
+        async with self._lock:
+            items = self._take(Path(path) if path is not None else None)
+            if items:
+                await asyncio.get_running_loop().run_in_executor(None, self._apply, items)
+
+    def flush_sync(self):
+        """同步写入全部（关闭时调用）"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._apply(self._take())
+
+    def get_stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "writes": self.writes,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+        }
+
+
+write_behind = WriteBehind()
+
+
+# ==================== 配置 ====================
+
+_config_cache: Optional[Dict[str, Any]] = None
+_config_mtime: Optional[float] = None
+
+
+def _config_file_mtime() -> Optional[float]:
+    try:
+        return CONFIG_FILE.stat().st_mtime
+    except OSError:
+        return None
+
+
 def save_accounts(accounts: List[Dict[str, Any]]) -> bool:
     """保存账号配置"""
-    try:
-        ensure_config_dir()
-        config = load_config()
-        config["accounts"] = accounts
-        with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-            json.dump(config, f, indent=2, ensure_ascii=False)
-        return True
-    except Exception as e:
-        print(f"[Persistence] 保存配置失败: {e}")
-        return False
+    config = load_config()
+    config["accounts"] = accounts
+    return save_config(config)
 
 
 def load_accounts() -> List[Dict[str, Any]]:
@@ -34,22 +207,30 @@ def load_accounts() -> List[Dict[str, Any]]:
 
 
 def load_config() -> Dict[str, Any]:
-    """加载完整配置"""
-    try:
-        if CONFIG_FILE.exists():
-            with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-    except Exception as e:
-        print(f"[Persistence] 加载配置失败: {e}")
-    return {}
+    """加载完整配置（返回副本，可随意修改）"""
+    global _config_cache, _config_mtime
+    mtime = _config_file_mtime()
+    # 有未落盘的写入时缓存比文件新；否则文件被外部修改过才重新读取
+    if _config_cache is None or (mtime != _config_mtime and not write_behind.is_pending(CONFIG_FILE)):
+        config = {}
+        try:
+            if mtime is not None:
+                with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+                    config = json.load(f)
+        except Exception as e:
+            print(f"[Persistence] 加载配置失败: {e}")
+        _config_cache = config
+        _config_mtime = mtime
+    return copy.deepcopy(_config_cache)
 
 
 def save_config(config: Dict[str, Any]) -> bool:
-    """保存完整配置"""
+    """保存完整配置（延迟合并写入）"""
+    global _config_cache
     try:
         ensure_config_dir()
-        with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-            json.dump(config, f, indent=2, ensure_ascii=False)
+        _config_cache = copy.deepcopy(config)
+        write_behind.write(CONFIG_FILE, config)
         return True
     except Exception as e:
         print(f"[Persistence] 保存配置失败: {e}")
@@ -64,3 +245,69 @@ def export_config() -> Dict[str, Any]:
 def import_config(config: Dict[str, Any]) -> bool:
     """导入配置（用于恢复）"""
     return save_config(config)
+
+
+# ==================== 文件监视 ====================
+
+class MtimeWatcher:
+    """按 mtime 轮询文件变化（stat 在线程池中执行）"""
+
+    def __init__(self, interval: float = 2.0):
+        self.interval = interval
+        self._mtimes: Dict[str, Optional[float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.reloads = 0
+
+    @staticmethod
+    def _stat_all(paths: List[str]) -> Dict[str, Optional[float]]:
+        result = {}
+        for path in paths:
+            try:
+                result[path] = os.stat(path).st_mtime
+            except OSError:
+                result[path] = None
+        return result
+
+    async def check(self, paths: Iterable[str]) -> List[str]:
+        """返回自上次检查以来 mtime 变化的文件（首次见到的文件只记录不触发）"""
+        paths = list(dict.fromkeys(paths))
+        mtimes = await asyncio.get_running_loop().run_in_executor(None, self._stat_all, paths)
+        changed = [
+            path for path, mtime in mtimes.items()
+            if path in self._mtimes and mtime is not None and mtime != self._mtimes[path]
+        ]
+        self._mtimes = mtimes
+        return changed
+
+    def start(self, paths: Callable[[], Iterable[str]], on_change: Callable[[str], Awaitable[None]]):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop(paths, on_change))
+
+    async def _loop(self, paths, on_change):
+        while True:
+            try:
+                for path in await self.check(paths()):
+                    self.reloads += 1
+                    await on_change(path)
+            except Exception as e:
+                print(f"[Persistence] 文件监视出错: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+token_watcher = MtimeWatcher()
+
+
+def get_persistence_stats() -> dict:
+    """获取统计信息"""
+    stats = write_behind.get_stats()
+    stats["token_reloads"] = token_watcher.reloads
+    return stats
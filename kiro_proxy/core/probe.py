@@ -0,0 +1,256 @@
+"""账号探测引擎 - 健康检查与批量刷新
+
+- 并发受限（信号量），200 个账号的一轮检查只需数秒
+- 每个账号独立的定时器，带随机抖动，避免所有账号同一时刻被探测
+- 探测结果缓存，管理接口直接返回缓存，不必每次重新探测
+- 手动全量检查 / 刷新可通过 SSE 实时查看进度
+"""
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, asdict
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from ..config import MODELS_URL
+from ..credential import CredentialStatus
+from .http_pool import http_pool
+
+if TYPE_CHECKING:
+    from .account import Account
+
+
+@dataclass
+class ProbeResult:
+    """单个账号的健康检查结果"""
+    id: str
+    name: str
+    status: str            # healthy / auth_failed / rate_limited / no_token / disabled / error / error_<code>
+    healthy: bool
+    latency_ms: Optional[float] = None
+    error: Optional[str] = None
+    checked_at: float = 0
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        return {k: v for k, v in data.items() if v is not None}
+
+
+class ProbeEngine:
+    """健康探测与批量刷新"""
+
+    CONCURRENCY = 16
+    HEALTH_INTERVAL = 600   # 每个账号的健康检查周期（秒）
+    JITTER = 0.2            # 周期的随机抖动比例（±20%）
+    CACHE_TTL = 60          # 手动检查时，结果在该时间内直接返回缓存（秒）
+
+    def __init__(self):
+        self._results: Dict[str, ProbeResult] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks: set = set()
+        self._probing: set = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._running = False
+        self.probes = 0
+        self.last_full_run: Optional[float] = None
+
+    def _sem(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.CONCURRENCY)
+        return self._semaphore
+
+    # ==================== 单账号探测 ====================
+
+    async def probe(self, account: "Account") -> ProbeResult:
+        """探测账号健康状态并更新账号状态"""
+        if not account.enabled:
+            result = ProbeResult(account.id, account.name, "disabled", False)
+        else:
+            async with self._sem():
+                result = await self._probe(account)
+        result.checked_at = time.time()
+        self._results[account.id] = result
+        self.probes += 1
+        return result
+
+    async def _probe(self, account: "Account") -> ProbeResult:
+        try:
+            token = account.get_token()
+            if not token:
+                account.status = CredentialStatus.UNHEALTHY
+                return ProbeResult(account.id, account.name, "no_token", False)
+
+            headers = {
+                "Authorization": f"Bearer {token}",
+                "content-type": "application/json"
+            }
+            start = time.time()
+            resp = await http_pool.model_client.get(MODELS_URL, headers=headers, params={"origin": "AI_EDITOR"})
+            latency_ms = round((time.time() - start) * 1000, 1)
+
+            if resp.status_code == 200:
+                if account.status == CredentialStatus.UNHEALTHY:
+                    account.status = CredentialStatus.ACTIVE
+                    print(f"[HealthCheck] 账号恢复健康: {account.name}")
+                return ProbeResult(account.id, account.name, "healthy", True, latency_ms)
+            if resp.status_code == 401:
+                account.status = CredentialStatus.UNHEALTHY
+                print(f"[HealthCheck] 账号认证失败: {account.name}")
+                return ProbeResult(account.id, account.name, "auth_failed", False, latency_ms)
+            if resp.status_code == 429:
+                # 配额超限，不改变状态，也不代表不健康
+                return ProbeResult(account.id, account.name, "rate_limited", True, latency_ms)
+            return ProbeResult(account.id, account.name, f"error_{resp.status_code}", False, latency_ms)
+        except Exception as e:
+            print(f"[HealthCheck] 检查失败 {account.name}: {e}")
+            return ProbeResult(account.id, account.name, "error", False, error=str(e))
+
+    async def refresh(self, account: "Account") -> dict:
+        """刷新账号 token（经 TokenManager 合并并发刷新）"""
+        from .token_manager import token_manager
+        async with self._sem():
+            success, message = await token_manager.refresh(account)
+        return {"account_id": account.id, "success": success, "message": message}
+
+    # ==================== 批量执行 ====================
+
+    async def _run(self, accounts: List["Account"], worker: Callable[["Account"], Awaitable]) -> AsyncIterator:
+        """并发执行，按完成顺序产出结果"""
+        tasks = [asyncio.create_task(worker(acc)) for acc in accounts]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield await future
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def check_all(self, accounts: Iterable["Account"]) -> List[ProbeResult]:
+        """对所有账号做一轮健康检查"""
+        results = [r async for r in self._run(list(accounts), self.probe)]
+        self.last_full_run = time.time()
+        return results
+
+    async def refresh_all(self, accounts: Iterable["Account"], minutes: int = 10) -> List[dict]:
+        """并发刷新即将过期的 token"""
+        targets = [acc for acc in accounts if acc.enabled and acc.is_token_expiring_soon(minutes)]
+        return [r async for r in self._run(targets, self.refresh)]
+
+    def cached_results(self, accounts: Iterable["Account"], max_age: float = None) -> Optional[List[ProbeResult]]:
+        """所有账号都有足够新的结果时返回缓存，否则返回 None"""
+        max_age = self.CACHE_TTL if max_age is None else max_age
+        now = time.time()
+        results = []
+        for acc in accounts:
+            result = self._results.get(acc.id)
+            if result is None or now - result.checked_at > max_age:
+                return None
+            results.append(result)
+        return results
+
+    def get_result(self, account_id: str) -> Optional[ProbeResult]:
+        return self._results.get(account_id)
+
+    async def stream(self, accounts: Iterable["Account"], kind: str = "health") -> AsyncIterator[str]:
+        """手动全量执行，以 SSE 事件输出进度"""
+        accounts = list(accounts)
+        if kind == "refresh":
+            accounts = [acc for acc in accounts if acc.enabled and acc.is_token_expiring_soon(10)]
+            worker = self.refresh
+        else:
+            worker = self.probe
+        total = len(accounts)
+        yield _sse({"type": "start", "kind": kind, "total": total})
+
+        done = ok = 0
+        async for result in self._run(accounts, worker):
+            done += 1
+            if isinstance(result, ProbeResult):
+                ok += result.healthy
+                payload = result.to_dict()
+            else:
+                ok += result["success"]
+                payload = result
+            yield _sse({"type": "progress", "done": done, "total": total, "result": payload})
+
+        if kind == "health":
+            self.last_full_run = time.time()
+        yield _sse({"type": "done", "kind": kind, "total": total, "ok": ok, "failed": total - ok})
+
+    # ==================== 定时探测 ====================
+
+    def _next_delay(self) -> float:
+        return self.HEALTH_INTERVAL * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+
+    def start(self, accounts: Iterable["Account"]):
+        """为每个账号安排健康检查，首轮在一个周期内随机分散"""
+        self._running = True
+        self.ensure_scheduled(accounts, first=True)
+
+    def ensure_scheduled(self, accounts: Iterable["Account"], first: bool = False):
+        """为尚未安排定时器的账号（如新添加的账号）补上定时器"""
+        if not self._running:
+            return
+        loop = asyncio.get_running_loop()
+        for acc in accounts:
+            if acc.id in self._timers or acc.id in self._probing:
+                continue
+            delay = random.uniform(0, self.HEALTH_INTERVAL) if first else self._next_delay()
+            self._timers[acc.id] = loop.call_later(delay, self._on_timer, acc.id)
+
+    def _on_timer(self, account_id: str):
+        from .state import state
+        self._timers.pop(account_id, None)
+        account = state.get_account(account_id)
+        if not self._running or account is None or not state.registry.manages(account_id):
+            return
+        task = asyncio.create_task(self._scheduled_probe(account))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _scheduled_probe(self, account: "Account"):
+        self._probing.add(account.id)
+        try:
+            if account.enabled:
+                await self.probe(account)
+        finally:
+            self._probing.discard(account.id)
+        if self._running:
+            self._timers[account.id] = asyncio.get_running_loop().call_later(
+                self._next_delay(), self._on_timer, account.id
+            )
+
+    async def stop(self):
+        self._running = False
+        for handle in self._timers.values():
+            handle.cancel()
+        self._timers.clear()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_stats(self) -> dict:
+        """获取统计信息"""
+        results = list(self._results.values())
+        return {
+            "scheduled": len(self._timers),
+            "probes": self.probes,
+            "cached": len(results),
+            "healthy": sum(1 for r in results if r.healthy),
+            "unhealthy": sum(1 for r in results if not r.healthy),
+            "last_full_run": self.last_full_run,
+        }
+
+
+def _sse(data: dict) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# 全局实例
+probe_engine = ProbeEngine()
+
+
+def get_probe_engine() -> ProbeEngine:
+    """获取探测引擎实例"""
+    return probe_engine
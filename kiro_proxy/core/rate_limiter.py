@@ -5,11 +5,17 @@
 - 全局请求限制
 - 突发请求检测
 - 配额超限冷却控制
+
+限速基于 GCRA（通用信元速率算法），检查和记录都是 O(1)：
+- 最小请求间隔：发射间隔 = min_request_interval，不允许突发
+- 每分钟请求数：发射间隔 = 60 / rpm，允许一分钟内的突发（与滑动窗口语义一致）
+统计用的 RPM 由按分钟滚动的计数器给出，不再遍历时间戳。
+使用共享协调存储（coordination）时，GCRA 的 TAT 保存在存储中，多个 worker 共用同一额度；
+准入时用 acquire_account / acquire_global 在一个事务里完成检查和预占，不会有两个 worker 同时放行。
 """
 import time
 from dataclasses import dataclass, field
-from typing import Dict, Optional
-from collections import deque
+from typing import Dict, List, Sequence, Tuple
 
 
 @dataclass
@@ -29,19 +35,78 @@ class RateLimitConfig:
     
     # 配额超限冷却时间（秒）- 只在 enabled=True 时生效
     quota_cooldown_seconds: int = 30
+    
+    # 每账号排队上限，超过后直接返回 429
+    max_queue_depth: int = 20
+    
+    # 全局排队上限，超过后直接返回 429/529
+    global_max_queue_depth: int = 200
+    
+    # 排队最长等待时间（秒）
+    max_queue_wait: float = 30.0
+
+
+class GCRA:
+    """通用信元速率算法（虚拟调度）
+
+    tat 为理论到达时间；请求在 now >= tat - tolerance 时放行，
+    放行后 tat 推进一个发射间隔。
+    """
+    
+    __slots__ = ("tat",)
+    
+    def __init__(self):
+        self.tat = 0.0
+    
+    def wait_time(self, now: float, tolerance: float = 0.0) -> float:
+        """距离可以放行还需等待的秒数（0 表示可以立即放行）"""
+        return max(0.0, self.tat - tolerance - now)
+    
+    def record(self, now: float, interval: float):
+        self.tat = max(self.tat, now) + interval
+    
+    def release(self, interval: float):
+        """退还一次记录"""
+        self.tat -= interval
+
+
+@dataclass
+class RateCounter:
+    """按分钟滚动的请求计数，估算最近 60 秒的请求数"""
+    minute: int = 0
+    current: int = 0
+    previous: int = 0
+    
+    def _roll(self, now: float):
+        minute = int(now // 60)
+        if minute != self.minute:
+            self.previous = self.current if minute == self.minute + 1 else 0
+            self.current = 0
+            self.minute = minute
+    
+    def add(self, now: float):
+        self._roll(now)
+        self.current += 1
+    
+    def discard(self, now: float):
+        """撤销一次 add"""
+        self._roll(now)
+        self.current = max(0, self.current - 1)
+    
+    def rpm(self, now: float) -> int:
+        """滑动窗口近似：上一分钟按剩余比例加权"""
+        self._roll(now)
+        elapsed = (now % 60) / 60
+        return int(self.current + self.previous * (1 - elapsed))
 
 
 @dataclass
 class AccountRateState:
     """账号限速状态"""
     last_request_time: float = 0
-    request_times: deque = field(default_factory=lambda: deque(maxlen=100))
-    
-    def get_requests_in_window(self, window_seconds: int = 60) -> int:
-        """获取时间窗口内的请求数"""
-        now = time.time()
-        cutoff = now - window_seconds
-        return sum(1 for t in self.request_times if t > cutoff)
+    interval: GCRA = field(default_factory=GCRA)   # 最小请求间隔
+    rate: GCRA = field(default_factory=GCRA)       # 每分钟请求数
+    counter: RateCounter = field(default_factory=RateCounter)
 
 
 class RateLimiter:
@@ -50,7 +115,8 @@ class RateLimiter:
     def __init__(self, config: RateLimitConfig = None):
         self.config = config or RateLimitConfig()
         self._account_states: Dict[str, AccountRateState] = {}
-        self._global_requests: deque = deque(maxlen=1000)
+        self._global_rate = GCRA()
+        self._global_counter = RateCounter()
     
     def _get_account_state(self, account_id: str) -> AccountRateState:
         """获取账号状态"""
@@ -58,12 +124,113 @@ class RateLimiter:
             self._account_states[account_id] = AccountRateState()
         return self._account_states[account_id]
     
+    @staticmethod
+    def _rpm_params(rpm: int) -> Tuple[float, float]:
+        """每分钟限额对应的 (发射间隔, 突发容差)"""
+        interval = 60 / max(1, rpm)
+        return interval, 60 - interval
+    
+    @staticmethod
+    def _wait(key: str, gcra: GCRA, now: float, tolerance: float = 0.0) -> float:
+        from .coordination import get_store
+        store = get_store()
+        if store.shared:
+            return store.gcra_wait(key, now, tolerance)
+        return gcra.wait_time(now, tolerance)
+    
+    @staticmethod
+    def _record(key: str, gcra: GCRA, now: float, interval: float):
+        from .coordination import get_store
+        store = get_store()
+        if store.shared:
+            store.gcra_record(key, now, interval)
+        else:
+            gcra.record(now, interval)
+    
+    @staticmethod
+    def _acquire(limits: Sequence[Tuple[str, float, float]], gcras: Sequence[GCRA], now: float) -> List[float]:
+        """检查全部限额，都可放行时一并记录；返回各限额的等待秒数"""
+        from .coordination import get_store
+        store = get_store()
+        if store.shared:
+            return store.gcra_acquire(limits, now)
+        waits = [gcra.wait_time(now, tolerance) for gcra, (_, _, tolerance) in zip(gcras, limits)]
+        if not any(waits):
+            for gcra, (_, interval, _) in zip(gcras, limits):
+                gcra.record(now, interval)
+        return waits
+    
+    @staticmethod
+    def _release(limits: Sequence[Tuple[str, float, float]], gcras: Sequence[GCRA]):
+        """退还 _acquire 预占的额度"""
+        from .coordination import get_store
+        store = get_store()
+        if store.shared:
+            store.gcra_release(limits)
+            return
+        for gcra, (_, interval, _) in zip(gcras, limits):
+            gcra.release(interval)
+    
+    def _account_limits(self, account_id: str) -> List[Tuple[str, float, float]]:
+        interval, tolerance = self._rpm_params(self.config.max_requests_per_minute)
+        return [
+            (f"rate:acct:{account_id}:interval", self.config.min_request_interval, 0.0),
+            (f"rate:acct:{account_id}:rpm", interval, tolerance),
+        ]
+    
+    def _global_limits(self) -> List[Tuple[str, float, float]]:
+        return [("rate:global", *self._rpm_params(self.config.global_max_requests_per_minute))]
+    
+    def acquire_account(self, account_id: str) -> tuple:
+        """检查每账号限制，可放行时同时预占额度，返回 (can_request, wait_seconds, reason)"""
+        now = time.time()
+        state = self._get_account_state(account_id)
+        if self.config.enabled:
+            waits = self._acquire(self._account_limits(account_id), (state.interval, state.rate), now)
+            if waits[0] > 0:
+                return False, waits[0], f"请求过快，请等待 {waits[0]:.1f} 秒"
+            if waits[1] > 0:
+                return False, waits[1], f"账号请求过于频繁 ({self.config.max_requests_per_minute}/分钟)"
+        state.last_request_time = now
+        state.counter.add(now)
+        return True, 0, None
+    
+    def release_account(self, account_id: str):
+        """退还 acquire_account 预占的额度（请求最终没有被放行时）"""
+        state = self._get_account_state(account_id)
+        if self.config.enabled:
+            self._release(self._account_limits(account_id), (state.interval, state.rate))
+        state.counter.discard(time.time())
+    
+    def acquire_global(self) -> tuple:
+        """检查全局限制，可放行时同时预占额度，返回 (can_request, wait_seconds, reason)"""
+        now = time.time()
+        if self.config.enabled:
+            wait = self._acquire(self._global_limits(), (self._global_rate,), now)[0]
+            if wait > 0:
+                return False, wait, f"全局请求过于频繁 ({self.config.global_max_requests_per_minute}/分钟)"
+        self._global_counter.add(now)
+        return True, 0, None
+    
+    def release_global(self):
+        """退还 acquire_global 预占的额度"""
+        if self.config.enabled:
+            self._release(self._global_limits(), (self._global_rate,))
+        self._global_counter.discard(time.time())
+    
     def can_request(self, account_id: str) -> tuple:
         """检查是否可以发送请求
         
         Returns:
             (can_request, wait_seconds, reason)
         """
+        can, wait, reason = self.check_account(account_id)
+        if not can:
+            return can, wait, reason
+        return self.check_global()
+    
+    def check_account(self, account_id: str) -> tuple:
+        """只检查每账号限制，返回 (can_request, wait_seconds, reason)"""
         if not self.config.enabled:
             return True, 0, None
         
@@ -71,30 +238,57 @@ class RateLimiter:
         state = self._get_account_state(account_id)
         
         # 检查最小请求间隔
-        time_since_last = now - state.last_request_time
-        if time_since_last < self.config.min_request_interval:
-            wait = self.config.min_request_interval - time_since_last
+        wait = self._wait(f"rate:acct:{account_id}:interval", state.interval, now)
+        if wait > 0:
             return False, wait, f"请求过快，请等待 {wait:.1f} 秒"
         
         # 检查每账号每分钟限制
-        account_rpm = state.get_requests_in_window(60)
-        if account_rpm >= self.config.max_requests_per_minute:
-            return False, 2, f"账号请求过于频繁 ({account_rpm}/分钟)"
+        _, tolerance = self._rpm_params(self.config.max_requests_per_minute)
+        wait = self._wait(f"rate:acct:{account_id}:rpm", state.rate, now, tolerance)
+        if wait > 0:
+            return False, wait, f"账号请求过于频繁 ({self.config.max_requests_per_minute}/分钟)"
         
-        # 检查全局每分钟限制
-        global_rpm = sum(1 for t in self._global_requests if t > now - 60)
-        if global_rpm >= self.config.global_max_requests_per_minute:
-            return False, 1, f"全局请求过于频繁 ({global_rpm}/分钟)"
+        return True, 0, None
+    
+    def check_global(self) -> tuple:
+        """只检查全局限制，返回 (can_request, wait_seconds, reason)"""
+        if not self.config.enabled:
+            return True, 0, None
+        
+        _, tolerance = self._rpm_params(self.config.global_max_requests_per_minute)
+        wait = self._wait("rate:global", self._global_rate, time.time(), tolerance)
+        if wait > 0:
+            return False, wait, f"全局请求过于频繁 ({self.config.global_max_requests_per_minute}/分钟)"
         
         return True, 0, None
     
-    def record_request(self, account_id: str):
-        """记录请求"""
+    def record_account(self, account_id: str):
+        """记录每账号请求"""
         now = time.time()
         state = self._get_account_state(account_id)
         state.last_request_time = now
-        state.request_times.append(now)
-        self._global_requests.append(now)
+        self._record(f"rate:acct:{account_id}:interval", state.interval, now, self.config.min_request_interval)
+        self._record(f"rate:acct:{account_id}:rpm", state.rate, now, self._rpm_params(self.config.max_requests_per_minute)[0])
+        state.counter.add(now)
+    
+    def record_global(self):
+        """记录全局请求"""
+        now = time.time()
+        self._record("rate:global", self._global_rate, now, self._rpm_params(self.config.global_max_requests_per_minute)[0])
+        self._global_counter.add(now)
+    
+    def record_request(self, account_id: str):
+        """记录请求"""
+        self.record_account(account_id)
+        self.record_global()
+    
+    def account_interval(self) -> float:
+        """每账号稳定状态下的请求间隔（秒），用于估算 Retry-After"""
+        return max(self.config.min_request_interval, 60 / max(1, self.config.max_requests_per_minute))
+    
+    def global_interval(self) -> float:
+        """全局稳定状态下的请求间隔（秒）"""
+        return 60 / max(1, self.config.global_max_requests_per_minute)
     
     def should_apply_quota_cooldown(self) -> bool:
         """是否应该应用配额冷却（只在限速启用时）"""
@@ -109,11 +303,11 @@ class RateLimiter:
         now = time.time()
         return {
             "enabled": self.config.enabled,
-            "global_rpm": sum(1 for t in self._global_requests if t > now - 60),
+            "global_rpm": self._global_counter.rpm(now),
             "quota_cooldown_seconds": self.config.quota_cooldown_seconds,
             "accounts": {
                 aid: {
-                    "rpm": state.get_requests_in_window(60),
+                    "rpm": state.counter.rpm(now),
                     "last_request": now - state.last_request_time if state.last_request_time else None
                 }
                 for aid, state in self._account_states.items()
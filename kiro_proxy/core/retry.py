@@ -48,6 +48,12 @@ def is_retryable_error(status_code: Optional[int], error: Optional[Exception] =
     return False
 
 
+def backoff_delay(attempt: int, base_delay: float = 0.5, max_delay: float = 5.0) -> float:
+    """第 attempt 次重试（从 0 开始）的退避时间：指数退避 + 随机抖动（防雪崩）"""
+    delay = min(base_delay * (2 ** attempt), max_delay)
+    return delay + random.uniform(0, delay * 0.3)
+
+
 def is_non_retryable_error(status_code: Optional[int]) -> bool:
     """判断是否为不可重试的错误"""
     return status_code in NON_RETRYABLE_STATUS_CODES if status_code else False
@@ -84,10 +90,7 @@ async def retry_async(
                 raise
             
             if attempt < max_retries and is_retryable_error(status_code, e):
-                # 指数退避 + 随机抖动（防雪崩）
-                delay = min(base_delay * (2 ** attempt), max_delay)
-                jitter = random.uniform(0, delay * 0.3)
-                delay += jitter
+                delay = backoff_delay(attempt, base_delay, max_delay)
                 
                 if on_retry:
                     on_retry(attempt + 1, e)
@@ -125,8 +128,6 @@ class RetryableRequest:
     
     async def wait(self):
         """等待重试延迟（含随机抖动防雪崩）"""
-        delay = min(self.base_delay * (2 ** (self.attempt - 1)), 5.0)
-        jitter = random.uniform(0, delay * 0.3)
-        delay += jitter
+        delay = backoff_delay(self.attempt - 1, self.base_delay)
         print(f"[Retry] 第 {self.attempt} 次重试，延迟 {delay:.1f}s")
         await asyncio.sleep(delay)
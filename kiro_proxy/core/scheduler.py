@@ -2,7 +2,7 @@
 import asyncio
 from typing import Optional
 from datetime import datetime
-from .http_pool import http_pool
+from .probe import probe_engine
 
 
 class BackgroundScheduler:
@@ -18,8 +18,6 @@ class BackgroundScheduler:
         self._task: Optional[asyncio.Task] = None
         self._running = False
         self._refresh_interval = 300  # 5 分钟检查一次
-        self._health_check_interval = 600  # 10 分钟健康检查
-        self._last_health_check = 0
     
     async def start(self):
         """启动后台任务"""
@@ -38,23 +36,23 @@ class BackgroundScheduler:
                 await self._task
             except asyncio.CancelledError:
                 pass
+        await probe_engine.stop()
         print("[Scheduler] 后台任务已停止")
     
     async def _run(self):
         """主循环"""
         from . import state
-        import time
+        
+        # 健康检查由探测引擎按账号分散执行
+        probe_engine.start(state.managed_accounts)
         
         while self._running:
             try:
-                # Token 预刷新
+                # Token 预刷新（TokenManager 已按账号定时刷新，这里兜底）
                 await self._refresh_expiring_tokens(state)
                 
-                # 健康检查
-                now = time.time()
-                if now - self._last_health_check > self._health_check_interval:
-                    await self._health_check(state)
-                    self._last_health_check = now
+                # 新添加的账号补上健康检查定时器
+                probe_engine.ensure_scheduled(state.managed_accounts)
                 
                 await asyncio.sleep(self._refresh_interval)
                 
@@ -65,60 +63,12 @@ class BackgroundScheduler:
                 await asyncio.sleep(60)
     
     async def _refresh_expiring_tokens(self, state):
-        """刷新即将过期的 Token"""
-        for acc in state.accounts:
-            if not acc.enabled:
-                continue
-            
-            # 提前 15 分钟刷新
-            if acc.is_token_expiring_soon(15):
-                print(f"[Scheduler] Token 即将过期，预刷新: {acc.name}")
-                success, msg = await acc.refresh_token()
-                if success:
-                    print(f"[Scheduler] Token 刷新成功: {acc.name}")
-                else:
-                    print(f"[Scheduler] Token 刷新失败: {acc.name} - {msg}")
-    
-    async def _health_check(self, state):
-        """健康检查"""
-        import httpx
-        from ..config import MODELS_URL
-        from ..credential import CredentialStatus
-        
-        for acc in state.accounts:
-            if not acc.enabled:
-                continue
-            
-            try:
-                token = acc.get_token()
-                if not token:
-                    acc.status = CredentialStatus.UNHEALTHY
-                    continue
-                
-                headers = {
-                    "Authorization": f"Bearer {token}",
-                    "content-type": "application/json"
-                }
-                
-                resp = await http_pool.model_client.get(
-                    MODELS_URL, 
-                    headers=headers,
-                    params={"origin": "AI_EDITOR"}
-                )
-                
-                if resp.status_code == 200:
-                    if acc.status == CredentialStatus.UNHEALTHY:
-                        acc.status = CredentialStatus.ACTIVE
-                        print(f"[HealthCheck] 账号恢复健康: {acc.name}")
-                elif resp.status_code == 401:
-                    acc.status = CredentialStatus.UNHEALTHY
-                    print(f"[HealthCheck] 账号认证失败: {acc.name}")
-                elif resp.status_code == 429:
-                    # 配额超限，不改变状态
-                    pass
-                    
-            except Exception as e:
-                print(f"[HealthCheck] 检查失败 {acc.name}: {e}")
+        """并发刷新即将过期的 Token（提前 15 分钟）"""
+        for result in await probe_engine.refresh_all(state.managed_accounts, minutes=15):
+            if result["success"]:
+                print(f"[Scheduler] Token 刷新成功: {result['account_id']}")
+            else:
+                print(f"[Scheduler] Token 刷新失败: {result['account_id']} - {result['message']}")
 
 
 # 全局调度器实例
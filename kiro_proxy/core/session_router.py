@@ -0,0 +1,240 @@
+"""会话路由 - 有界的会话粘性表 + 一致性哈希回退
+
+同一对话尽量落在同一账号上，以便上游复用上下文：
+- LRU + 滑动 TTL 的会话表，条目数有上限，长期运行内存不增长
+- 粘性时长可配置（/api/settings/session-affinity）
+- 表满、粘性账号不可用或在途流过多时，按会话 id 做一致性哈希选账号
+- 共享协调存储下，会话绑定写入存储，本地未命中时从存储中查找
+- prefork 模式下会话表按 worker 独立，未配置共享协调存储时粘性只在单个 worker 内成立
+"""
+import bisect
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from .account import Account
+    from .account_registry import AccountRegistry
+
+
+@dataclass
+class SessionAffinityConfig:
+    """会话粘性配置"""
+    # 会话粘性时长（秒），每次命中后顺延
+    affinity_seconds: int = 1800
+
+    # 会话表最大条目数
+    max_sessions: int = 10000
+
+    # 粘性账号在途流达到该数量时视为饱和，改走一致性哈希
+    saturation_inflight: int = 8
+
+    # 一致性哈希环上每个账号的虚拟节点数
+    virtual_nodes: int = 64
+
+
+@dataclass
+class _Session:
+    account_id: str
+    touched_at: float
+    shared_at: float = 0.0  # 最近一次写入共享存储的时间
+
+
+def _hash(key: str) -> int:
+    """跨进程稳定的哈希（不受 PYTHONHASHSEED 影响）"""
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class SessionRouter:
+    """会话 -> 账号路由表"""
+
+    def __init__(self, registry: "AccountRegistry", config: SessionAffinityConfig = None):
+        self.registry = registry
+        self.config = config or SessionAffinityConfig()
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._ring: List[Tuple[int, str]] = []
+        self._ring_keys: List[int] = []
+        self._ring_version = -1
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    # ==================== 会话表 ====================
+
+    def _expire(self, now: float):
+        """淘汰过期条目（按最近使用排序，过期的都在表头）"""
+        cutoff = now - self.config.affinity_seconds
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.touched_at >= cutoff:
+                break
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def _bind(self, session_id: str, account_id: str, now: float):
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = _Session(account_id, now)
+        else:
+            if session.account_id != account_id:
+                session.shared_at = 0.0
+            session.account_id = account_id
+            session.touched_at = now
+            self._sessions.move_to_end(session_id)
+        self._share(session_id, session, now)
+
+    def _share(self, session_id: str, session: _Session, now: float):
+        """写入共享存储；命中时每 1/10 个粘性时长最多续期一次"""
+        from .coordination import get_store
+        store = get_store()
+        if not store.shared or now - session.shared_at < self.config.affinity_seconds / 10:
+            return
+        try:
+            store.set_session(session_id, session.account_id, self.config.affinity_seconds)
+            session.shared_at = now
+        except Exception as e:
+            print(f"[SessionRouter] 写入共享会话失败: {e}")
+
+    def _shared_lookup(self, session_id: str) -> Optional[str]:
+        """本地未命中时查询其他 worker 记录的会话绑定"""
+        from .coordination import get_store
+        store = get_store()
+        if not store.shared:
+            return None
+        try:
+            return store.get_session(session_id)
+        except Exception as e:
+            print(f"[SessionRouter] 读取共享会话失败: {e}")
+            return None
+
+    def _schedulable(self, account: Optional["Account"]) -> bool:
+        return account is not None and self.registry.owns(account.id) and account.is_available()
+
+    def _usable(self, account: Optional["Account"]) -> bool:
+        if not self._schedulable(account):
+            return False
+        return self.registry.load(account.id).total_inflight < self.config.saturation_inflight
+
+    def route(self, session_id: str) -> Optional["Account"]:
+        """为会话选择账号，返回 None 表示没有可用账号"""
+        now = time.time()
+        self._expire(now)
+
+        session = self._sessions.get(session_id)
+        if session is not None:
+            account = self.registry.get(session.account_id)
+            if self._usable(account):
+                self.hits += 1
+                self._bind(session_id, account.id, now)
+                return account
+            # 粘性账号不可用或已饱和：一致性哈希到另一个账号
+            fallback = self._ring_lookup(session_id, exclude_id=session.account_id)
+            if fallback:
+                self.fallbacks += 1
+                self._bind(session_id, fallback.id, now)
+                return fallback
+            if self._schedulable(account):
+                # 没有其他可用账号：饱和的粘性账号仍可调度，继续使用而不是返回 503
+                self.hits += 1
+                self._bind(session_id, account.id, now)
+                return account
+            return None
+
+        if len(self._sessions) >= self.config.max_sessions:
+            # 表满：不再记录新会话，一致性哈希同样能让同一会话落在同一账号
+            self.misses += 1
+            self.fallbacks += 1
+            return self._ring_lookup(session_id)
+
+        shared_id = self._shared_lookup(session_id)
+        if shared_id is not None:
+            account = self.registry.get(shared_id)
+            if self._usable(account):
+                self.hits += 1
+                self._bind(session_id, account.id, now)
+                return account
+
+        self.misses += 1
+
+        account = self.registry.pick()
+        if account:
+            self._bind(session_id, account.id, now)
+        return account
+
+    def forget(self, account_id: str):
+        """账号被删除时清理指向它的会话"""
+        for session_id in [sid for sid, s in self._sessions.items() if s.account_id == account_id]:
+            del self._sessions[session_id]
+
+    # ==================== 一致性哈希 ====================
+
+    def _rebuild_ring(self):
+        ring = []
+        for account in self.registry.values():
+            if not self.registry.owns(account.id):
+                continue
+            for i in range(self.config.virtual_nodes):
+                ring.append((_hash(f"{account.id}#{i}"), account.id))
+        ring.sort()
+        self._ring = ring
+        self._ring_keys = [h for h, _ in ring]
+        self._ring_version = self.registry.version
+
+    def _ring_lookup(self, session_id: str, exclude_id: Optional[str] = None) -> Optional["Account"]:
+        """沿哈希环顺时针找第一个可用且未饱和的账号；都饱和时退回第一个可用账号"""
+        if self._ring_version != self.registry.version:
+            self._rebuild_ring()
+        if not self._ring:
+            return None
+        start = bisect.bisect(self._ring_keys, _hash(session_id))
+        seen = set()
+        fallback = None
+        for i in range(len(self._ring)):
+            account_id = self._ring[(start + i) % len(self._ring)][1]
+            if account_id in seen or account_id == exclude_id:
+                continue
+            seen.add(account_id)
+            account = self.registry.get(account_id)
+            if not self._schedulable(account):
+                continue
+            if self._usable(account):
+                return account
+            if fallback is None:
+                fallback = account
+            if len(seen) >= len(self.registry):
+                break
+        return fallback
+
+    # ==================== 配置与统计 ====================
+
+    def get_config(self) -> dict:
+        return asdict(self.config)
+
+    def update_config(self, **kwargs):
+        """更新配置"""
+        for key, value in kwargs.items():
+            if hasattr(self.config, key):
+                setattr(self.config, key, value)
+        self._ring_version = -1
+        while len(self._sessions) > self.config.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def get_stats(self) -> dict:
+        """获取统计信息"""
+        self._expire(time.time())
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self.config.max_sessions,
+            "affinity_seconds": self.config.affinity_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "fallbacks": self.fallbacks,
+            "evictions": self.evictions,
+        }
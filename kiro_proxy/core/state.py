@@ -2,12 +2,14 @@
 import time
 from collections import deque
 from dataclasses import dataclass
-from typing import Optional, List, Dict
+from typing import Optional, List, Tuple
 from pathlib import Path
 
 from ..config import TOKEN_PATH
-from ..credential import quota_manager, CredentialStatus
+from ..credential import CredentialStatus
 from .account import Account
+from .account_registry import AccountRegistry
+from .session_router import SessionRouter
 from .persistence import load_accounts, save_accounts
 
 
@@ -31,12 +33,11 @@ class ProxyState:
     """全局状态管理"""
     
     def __init__(self):
-        self.accounts: List[Account] = []
+        self.registry = AccountRegistry()
         self.request_logs: deque = deque(maxlen=1000)
         self.total_requests: int = 0
         self.total_errors: int = 0
-        self.session_locks: Dict[str, str] = {}
-        self.session_timestamps: Dict[str, float] = {}
+        self.sessions = SessionRouter(self.registry)
         self.start_time: float = time.time()
         self.current_port: int = 8080  # 当前运行端口
         self._load_accounts()
@@ -48,7 +49,7 @@ class ProxyState:
             for acc_data in saved:
                 # 验证 token 文件存在
                 if Path(acc_data.get("token_path", "")).exists():
-                    self.accounts.append(Account(
+                    self.registry.add(Account(
                         id=acc_data["id"],
                         name=acc_data["name"],
                         token_path=acc_data["token_path"],
@@ -58,13 +59,36 @@ class ProxyState:
         
         # 如果没有账号，尝试添加默认账号
         if not self.accounts and TOKEN_PATH.exists():
-            self.accounts.append(Account(
+            self.registry.add(Account(
                 id="default",
                 name="默认账号",
                 token_path=str(TOKEN_PATH)
             ))
             self._save_accounts()
     
+    @property
+    def accounts(self) -> List[Account]:
+        """所有账号（按添加顺序的快照）"""
+        return self.registry.values()
+    
+    @property
+    def managed_accounts(self) -> List[Account]:
+        """由本进程负责后台维护的账号（prefork 模式下为本 worker 的分区）"""
+        return [acc for acc in self.registry.values() if self.registry.manages(acc.id)]
+    
+    def get_account(self, account_id: str) -> Optional[Account]:
+        """按 id 查找账号"""
+        return self.registry.get(account_id)
+    
+    def add_account(self, account: Account):
+        """添加账号（同 id 替换）"""
+        self.registry.add(account)
+    
+    def remove_account(self, account_id: str) -> Optional[Account]:
+        """移除账号，返回被移除的账号"""
+        self.sessions.forget(account_id)
+        return self.registry.remove(account_id)
+    
     def _save_accounts(self):
         """保存账号到配置文件"""
         accounts_data = [
@@ -78,81 +102,83 @@ class ProxyState:
         ]
         save_accounts(accounts_data)
     
+    def reload_accounts(self) -> Tuple[List[str], List[Account]]:
+        """按配置文件同步账号列表（prefork 模式下其他 worker 修改了账号），返回 (移除的 id, 新增的账号)"""
+        saved = {
+            acc_data["id"]: acc_data for acc_data in load_accounts()
+            if Path(acc_data.get("token_path", "")).exists()
+        }
+        removed = [acc.id for acc in self.accounts if acc.id not in saved]
+        for account_id in removed:
+            self.remove_account(account_id)
+        added = []
+        for account_id, acc_data in saved.items():
+            acc = self.get_account(account_id)
+            if acc is None or acc.token_path != acc_data["token_path"]:
+                acc = Account(
+                    id=account_id,
+                    name=acc_data["name"],
+                    token_path=acc_data["token_path"],
+                    enabled=acc_data.get("enabled", True)
+                )
+                acc.load_credentials()
+                self.add_account(acc)
+                added.append(acc)
+                continue
+            acc.name = acc_data["name"]
+            acc.enabled = acc_data.get("enabled", True)
+        return removed, added
+    
+    async def reload_token_file(self, path: str):
+        """token 文件被外部修改（如 Kiro IDE 刷新了 token）后重新加载对应账号"""
+        for acc in self.accounts:
+            if acc.token_path == path and await acc.reload_credentials():
+                print(f"[State] 检测到凭证文件更新，已重新加载: {acc.name}")
+    
     def get_available_account(self, session_id: Optional[str] = None) -> Optional[Account]:
         """获取可用账号（支持会话粘性）"""
-        quota_manager.cleanup_expired()
-        
-        # 会话粘性
-        if session_id and session_id in self.session_locks:
-            account_id = self.session_locks[session_id]
-            ts = self.session_timestamps.get(session_id, 0)
-            if time.time() - ts < 60:
-                for acc in self.accounts:
-                    if acc.id == account_id and acc.is_available():
-                        self.session_timestamps[session_id] = time.time()
-                        return acc
-        
-        available = [a for a in self.accounts if a.is_available()]
-        if not available:
+        account = self._route(session_id)
+        if not account:
             # 自动恢复：当所有账号都不可用时，重置 COOLDOWN 状态的账号
-            cooldown_accounts = [a for a in self.accounts if a.enabled and a.status == CredentialStatus.COOLDOWN]
-            if cooldown_accounts:
-                print(f"[State] 所有账号不可用，自动恢复 {len(cooldown_accounts)} 个 COOLDOWN 账号")
-                for acc in cooldown_accounts:
-                    acc.status = CredentialStatus.ACTIVE
-                    quota_manager.restore(acc.id)
-                available = [a for a in self.accounts if a.is_available()]
-            if not available:
-                return None
-        
-        account = min(available, key=lambda a: a.request_count)
-        
-        if session_id:
-            self.session_locks[session_id] = account.id
-            self.session_timestamps[session_id] = time.time()
-        
+            restored = self.registry.restore_cooldown()
+            if restored:
+                print(f"[State] 所有账号不可用，自动恢复 {restored} 个 COOLDOWN 账号")
+                account = self._route(session_id)
         return account
     
+    def _route(self, session_id: Optional[str]) -> Optional[Account]:
+        if session_id:
+            return self.sessions.route(session_id)
+        return self.registry.pick()
+    
     def get_next_available_account(self, exclude_id: str) -> Optional[Account]:
         """获取下一个可用账号（排除指定账号）"""
-        available = [a for a in self.accounts if a.is_available() and a.id != exclude_id]
-        if not available:
-            return None
-        return min(available, key=lambda a: a.request_count)
+        return self.registry.pick(exclude_id)
     
     def mark_rate_limited(self, account_id: str, duration_seconds: int = 60):
         """标记账号限流"""
-        for acc in self.accounts:
-            if acc.id == account_id:
-                acc.mark_quota_exceeded("Rate limited")
-                break
+        acc = self.registry.get(account_id)
+        if acc:
+            acc.mark_quota_exceeded("Rate limited")
     
     def mark_quota_exceeded(self, account_id: str, reason: str = "Quota exceeded"):
         """标记账号配额超限"""
-        for acc in self.accounts:
-            if acc.id == account_id:
-                acc.mark_quota_exceeded(reason)
-                break
+        acc = self.registry.get(account_id)
+        if acc:
+            acc.mark_quota_exceeded(reason)
     
     async def refresh_account_token(self, account_id: str) -> tuple:
         """刷新指定账号的 token"""
-        for acc in self.accounts:
-            if acc.id == account_id:
-                return await acc.refresh_token()
+        from .token_manager import token_manager
+        acc = self.registry.get(account_id)
+        if acc:
+            return await token_manager.refresh(acc)
         return False, "账号不存在"
     
     async def refresh_expiring_tokens(self) -> List[dict]:
         """刷新所有即将过期的 token"""
-        results = []
-        for acc in self.accounts:
-            if acc.enabled and acc.is_token_expiring_soon(10):
-                success, msg = await acc.refresh_token()
-                results.append({
-                    "account_id": acc.id,
-                    "success": success,
-                    "message": msg
-                })
-        return results
+        from .probe import probe_engine
+        return await probe_engine.refresh_all(self.managed_accounts)
     
     def add_log(self, log: RequestLog):
         """添加请求日志"""
@@ -169,8 +195,8 @@ class ProxyState:
             "total_requests": self.total_requests,
             "total_errors": self.total_errors,
             "error_rate": f"{(self.total_errors / max(1, self.total_requests) * 100):.1f}%",
-            "accounts_total": len(self.accounts),
-            "accounts_available": len([a for a in self.accounts if a.is_available()]),
+            "accounts_total": len(self.registry),
+            "accounts_available": self.registry.available_count,
             "accounts_cooldown": len([a for a in self.accounts if a.status == CredentialStatus.COOLDOWN]),
             "recent_logs": len(self.request_logs)
         }
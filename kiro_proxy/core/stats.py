@@ -1,11 +1,197 @@
-"""请求统计增强 - 含 JSON 持久化"""
+"""请求统计增强 - 含 JSON 持久化
+
+- 按分钟的环形缓冲区：每个账号 / 模型固定大小，记录 O(1)，过期分钟自动覆盖
+- HDR 风格的延迟直方图（对数分段，约 6% 相对误差）：总耗时、TTFB、上游耗时的 p50/p95/p99
+- 请求路径只更新内存；后台任务定期生成快照，在线程池中写盘
+"""
+import asyncio
 import json
+from array import array
 from collections import defaultdict
 from dataclasses import dataclass, field
-from typing import Dict, List
+from typing import Dict, List, Optional
 from pathlib import Path
 import time
 
+from .persistence import atomic_write_json
+
+
+class LatencyHistogram:
+    """对数分段的延迟直方图（毫秒）
+    
+    小于 SUB_COUNT 的值每毫秒一个桶；之后每个 2 的幂区间再均分为 SUB_COUNT 个桶，
+    桶数固定，记录和合并都与样本数无关。
+    """
+    
+    SUB_BITS = 4
+    SUB_COUNT = 1 << SUB_BITS
+    MAX_VALUE = (1 << 24) - 1  # 约 4.6 小时，超出的值计入最后一个桶
+    BUCKETS = (MAX_VALUE.bit_length() - SUB_BITS + 1) * SUB_COUNT
+    
+    __slots__ = ("counts", "count", "sum", "max")
+    
+    def __init__(self):
+        self.counts = array("q", bytes(8 * self.BUCKETS))
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+    
+    @classmethod
+    def _index(cls, value: int) -> int:
+        if value < cls.SUB_COUNT:
+            return value
+        shift = value.bit_length() - cls.SUB_BITS - 1
+        return (shift + 1) * cls.SUB_COUNT + (value >> shift) - cls.SUB_COUNT
+    
+    @classmethod
+    def _bucket_value(cls, index: int) -> float:
+        """桶的代表值（区间中点）"""
+        if index < cls.SUB_COUNT:
+            return float(index)
+        shift = index // cls.SUB_COUNT - 1
+        lower = (index % cls.SUB_COUNT + cls.SUB_COUNT) << shift
+        return lower + ((1 << shift) - 1) / 2
+    
+    def record(self, value_ms: float):
+        if value_ms is None or value_ms < 0:
+            return
+        self.counts[self._index(min(int(value_ms), self.MAX_VALUE))] += 1
+        self.count += 1
+        self.sum += value_ms
+        if value_ms > self.max:
+            self.max = value_ms
+    
+    def percentile(self, p: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        target = max(1, round(self.count * p / 100))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            if n:
+                seen += n
+                if seen >= target:
+                    return min(self._bucket_value(index), self.max)
+        return self.max
+    
+    def merge(self, other: "LatencyHistogram"):
+        """把另一个直方图的样本并入本直方图"""
+        for index, n in enumerate(other.counts):
+            if n:
+                self.counts[index] += n
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+    
+    def copy(self) -> "LatencyHistogram":
+        hist = LatencyHistogram()
+        hist.counts = array("q", self.counts)
+        hist.count = self.count
+        hist.sum = self.sum
+        hist.max = self.max
+        return hist
+    
+    def since(self, base: "LatencyHistogram") -> "LatencyHistogram":
+        """base 之后新增的样本（base 为本直方图较早的 copy；max 取整体最大值）"""
+        hist = LatencyHistogram()
+        hist.counts = array("q", (a - b for a, b in zip(self.counts, base.counts)))
+        hist.count = self.count - base.count
+        hist.sum = self.sum - base.sum
+        hist.max = self.max
+        return hist
+    
+    def summary(self) -> dict:
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "avg": round(self.sum / self.count, 1),
+            "p50": round(self.percentile(50), 1),
+            "p95": round(self.percentile(95), 1),
+            "p99": round(self.percentile(99), 1),
+            "max": round(self.max, 1),
+        }
+    
+    def to_dict(self) -> dict:
+        """稀疏序列化（只保存非空桶）"""
+        return {
+            "buckets": {str(i): n for i, n in enumerate(self.counts) if n},
+            "sum": self.sum,
+            "max": self.max,
+        }
+    
+    @classmethod
+    def from_dict(cls, data: dict) -> "LatencyHistogram":
+        hist = cls()
+        for index, n in data.get("buckets", {}).items():
+            index = int(index)
+            if 0 <= index < cls.BUCKETS:
+                hist.counts[index] = n
+                hist.count += n
+        hist.sum = data.get("sum", 0.0)
+        hist.max = data.get("max", 0.0)
+        return hist
+
+
+class MinuteRing:
+    """按分钟分桶的环形缓冲区：请求数 / 错误数 / token 数"""
+    
+    __slots__ = ("size", "minutes", "requests", "errors", "tokens_in", "tokens_out")
+    
+    def __init__(self, size: int = 60):
+        self.size = size
+        self.minutes = array("q", [-1]) * size
+        self.requests = array("q", bytes(8 * size))
+        self.errors = array("q", bytes(8 * size))
+        self.tokens_in = array("q", bytes(8 * size))
+        self.tokens_out = array("q", bytes(8 * size))
+    
+    def _slot(self, minute: int) -> int:
+        i = minute % self.size
+        if self.minutes[i] != minute:
+            # 该槽位属于更早的一轮，复用前清零
+            self.minutes[i] = minute
+            self.requests[i] = self.errors[i] = self.tokens_in[i] = self.tokens_out[i] = 0
+        return i
+    
+    def record(self, now: float, success: bool, tokens_in: int = 0, tokens_out: int = 0, count: int = 1):
+        i = self._slot(int(now // 60))
+        self.requests[i] += count
+        if not success:
+            self.errors[i] += count
+        self.tokens_in[i] += tokens_in
+        self.tokens_out[i] += tokens_out
+    
+    def series(self, now: float, minutes: int = 60) -> List[int]:
+        """最近 minutes 分钟的每分钟请求数（旧 -> 新）"""
+        current = int(now // 60)
+        result = []
+        for minute in range(current - min(minutes, self.size) + 1, current + 1):
+            i = minute % self.size
+            result.append(self.requests[i] if self.minutes[i] == minute else 0)
+        return result
+    
+    def totals(self, now: float, minutes: int = 60) -> dict:
+        """最近 minutes 分钟的汇总"""
+        cutoff = int(now // 60) - min(minutes, self.size)
+        requests = errors = tokens_in = tokens_out = 0
+        for i in range(self.size):
+            if self.minutes[i] > cutoff:
+                requests += self.requests[i]
+                errors += self.errors[i]
+                tokens_in += self.tokens_in[i]
+                tokens_out += self.tokens_out[i]
+        return {"requests": requests, "errors": errors, "tokens_in": tokens_in, "tokens_out": tokens_out}
+    
+    def by_hour(self, now: float) -> Dict[int, int]:
+        """按小时汇总请求数（hour -> count）"""
+        cutoff = int(now // 60) - self.size
+        hourly: Dict[int, int] = defaultdict(int)
+        for i in range(self.size):
+            minute = self.minutes[i]
+            if minute > cutoff and self.requests[i]:
+                hourly[minute // 60] += self.requests[i]
+        return dict(hourly)
+
 
 @dataclass
 class AccountStats:
@@ -15,14 +201,17 @@ class AccountStats:
     total_tokens_in: int = 0
     total_tokens_out: int = 0
     last_request_time: float = 0
+    recent: MinuteRing = field(default_factory=MinuteRing)
     
-    def record(self, success: bool, tokens_in: int = 0, tokens_out: int = 0):
+    def record(self, success: bool, tokens_in: int = 0, tokens_out: int = 0, now: float = None):
+        now = now or time.time()
         self.total_requests += 1
         if not success:
             self.total_errors += 1
         self.total_tokens_in += tokens_in
         self.total_tokens_out += tokens_out
-        self.last_request_time = time.time()
+        self.last_request_time = now
+        self.recent.record(now, success, tokens_in, tokens_out)
     
     @property
     def error_rate(self) -> float:
@@ -37,12 +226,32 @@ class ModelStats:
     total_requests: int = 0
     total_errors: int = 0
     total_latency_ms: float = 0
+    recent: MinuteRing = field(default_factory=MinuteRing)
+    latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+    ttfb: LatencyHistogram = field(default_factory=LatencyHistogram)
+    upstream: LatencyHistogram = field(default_factory=LatencyHistogram)
     
-    def record(self, success: bool, latency_ms: float):
+    def record(
+        self,
+        success: bool,
+        latency_ms: float,
+        ttfb_ms: float = None,
+        upstream_ms: float = None,
+        tokens_in: int = 0,
+        tokens_out: int = 0,
+        now: float = None,
+    ):
+        now = now or time.time()
         self.total_requests += 1
         if not success:
             self.total_errors += 1
         self.total_latency_ms += latency_ms
+        self.recent.record(now, success, tokens_in, tokens_out)
+        # 只统计成功请求的延迟分布，失败请求的耗时不具可比性
+        if success:
+            self.latency.record(latency_ms)
+            self.ttfb.record(ttfb_ms)
+            self.upstream.record(upstream_ms)
     
     @property
     def avg_latency_ms(self) -> float:
@@ -52,17 +261,30 @@ class ModelStats:
 
 
 class StatsManager:
-    """统计管理器 - 含 JSON 文件持久化"""
+    """统计管理器 - 含 JSON 文件持久化
+    
+    prefork 模式下每个 worker 写自己的 stats-{index}.json，互不覆盖；
+    加载时把不再有对应 worker 的文件（单进程的 stats.json、worker 数减少后多出的文件）
+    合并进来，第一次保存成功后删除这些文件，避免重复计数。
+    """
     
     PERSIST_PATH = Path.home() / ".kiro-proxy" / "stats.json"
-    SAVE_DEBOUNCE_SECONDS = 30  # 最小保存间隔
+    SAVE_DEBOUNCE_SECONDS = 30  # 后台快照间隔
+    HOURLY_WINDOW = 25 * 60     # 全局分钟环大小：当前小时 + 之前 24 小时
     
     def __init__(self):
         self.by_account: Dict[str, AccountStats] = defaultdict(AccountStats)
         self.by_model: Dict[str, ModelStats] = defaultdict(ModelStats)
-        self.hourly_requests: Dict[int, int] = defaultdict(int)  # hour -> count
+        self.timeline = MinuteRing(self.HOURLY_WINDOW)
+        self.latency = LatencyHistogram()
+        self.ttfb = LatencyHistogram()
+        self.upstream = LatencyHistogram()
         self._last_save_time: float = 0
         self._dirty: bool = False
+        self._task: Optional[asyncio.Task] = None
+        self._saving = False
+        self._persist_path = self._own_path()
+        self._absorbed: List[Path] = []  # 已合并、保存成功后删除的其他统计文件
         self._load_from_disk()
     
     def record_request(
@@ -72,93 +294,197 @@ class StatsManager:
         success: bool,
         latency_ms: float,
         tokens_in: int = 0,
-        tokens_out: int = 0
+        tokens_out: int = 0,
+        ttfb_ms: float = None,
+        upstream_ms: float = None,
     ):
-        """记录请求"""
+        """记录请求（只更新内存，持久化由后台任务完成）"""
+        now = time.time()
+        
         # 按账号统计
-        self.by_account[account_id].record(success, tokens_in, tokens_out)
+        self.by_account[account_id].record(success, tokens_in, tokens_out, now)
         
         # 按模型统计
-        self.by_model[model].record(success, latency_ms)
-        
-        # 按小时统计
-        hour = int(time.time() // 3600)
-        self.hourly_requests[hour] += 1
+        self.by_model[model].record(success, latency_ms, ttfb_ms, upstream_ms, tokens_in, tokens_out, now)
         
-        # 清理旧数据（保留 24 小时）
-        self._cleanup_hourly()
+        # 全局时间线与延迟分布
+        self.timeline.record(now, success, tokens_in, tokens_out)
+        if success:
+            self.latency.record(latency_ms)
+            self.ttfb.record(ttfb_ms)
+            self.upstream.record(upstream_ms)
         
-        # 带防抖的持久化
         self._dirty = True
-        now = time.time()
-        if now - self._last_save_time >= self.SAVE_DEBOUNCE_SECONDS:
-            self._save_to_disk()
     
-    def _cleanup_hourly(self):
-        """清理超过 24 小时的数据"""
-        current_hour = int(time.time() // 3600)
-        cutoff = current_hour - 24
-        self.hourly_requests = defaultdict(
-            int,
-            {h: c for h, c in self.hourly_requests.items() if h > cutoff}
-        )
+    @property
+    def hourly_requests(self) -> Dict[int, int]:
+        """最近 24 小时每小时的请求数（hour -> count）"""
+        cutoff = int(time.time() // 3600) - 24
+        return {h: c for h, c in self.timeline.by_hour(time.time()).items() if h > cutoff}
+    
+    @classmethod
+    def _own_path(cls) -> Path:
+        """本进程的统计文件（prefork worker 各用一个）"""
+        from ..prefork import worker_info
+        info = worker_info()
+        if info is None:
+            return cls.PERSIST_PATH
+        return cls.PERSIST_PATH.with_name(f"stats-{info[0]}.json")
+    
+    def _orphan_paths(self) -> List[Path]:
+        """没有对应 worker 写入、由本进程合并的统计文件"""
+        from ..prefork import worker_info
+        info = worker_info()
+        paths = []
+        for path in sorted(self.PERSIST_PATH.parent.glob("stats-*.json")):
+            if path == self._persist_path:
+                continue
+            try:
+                index = int(path.stem.split("-", 1)[1])
+            except ValueError:
+                continue
+            # 单进程模式合并全部 worker 文件；prefork 模式下多出的文件由 index % count 对应的 worker 合并
+            if info is None or (index >= info[1] and index % info[1] == info[0]):
+                paths.append(path)
+        if info is not None and info[0] == 0 and self.PERSIST_PATH.exists():
+            paths.append(self.PERSIST_PATH)
+        return paths
     
     def _load_from_disk(self):
         """从 JSON 文件恢复统计（重启后不丢失）"""
         try:
-            if self.PERSIST_PATH.exists():
-                data = json.loads(self.PERSIST_PATH.read_text())
-                for acc_id, acc_data in data.get("by_account", {}).items():
-                    s = AccountStats()
-                    s.total_requests = acc_data.get("total_requests", 0)
-                    s.total_errors = acc_data.get("total_errors", 0)
-                    s.total_tokens_in = acc_data.get("total_tokens_in", 0)
-                    s.total_tokens_out = acc_data.get("total_tokens_out", 0)
-                    s.last_request_time = acc_data.get("last_request_time", 0)
-                    self.by_account[acc_id] = s
-                for model, model_data in data.get("by_model", {}).items():
-                    m = ModelStats()
-                    m.total_requests = model_data.get("total_requests", 0)
-                    m.total_errors = model_data.get("total_errors", 0)
-                    m.total_latency_ms = model_data.get("total_latency_ms", 0)
-                    self.by_model[model] = m
-                for h, c in data.get("hourly_requests", {}).items():
-                    self.hourly_requests[int(h)] = c
+            if self._persist_path.exists():
+                self._merge(json.loads(self._persist_path.read_text()))
+            for path in self._orphan_paths():
+                self._merge(json.loads(path.read_text()))
+                self._absorbed.append(path)
+            if self.by_account or self.by_model:
                 print(f"[Stats] 从磁盘恢复统计: {len(self.by_account)} 账号, {len(self.by_model)} 模型")
+            if self._absorbed:
+                self._dirty = True  # 尽快写入本进程的文件，再删除已合并的文件
         except Exception as e:
             print(f"[Stats] 加载统计文件失败: {e}")
     
-    def _save_to_disk(self):
-        """持久化统计到 JSON 文件"""
+    def _merge(self, data: dict):
+        """把一份持久化的统计累加到内存中"""
+        for acc_id, acc_data in data.get("by_account", {}).items():
+            s = self.by_account[acc_id]
+            s.total_requests += acc_data.get("total_requests", 0)
+            s.total_errors += acc_data.get("total_errors", 0)
+            s.total_tokens_in += acc_data.get("total_tokens_in", 0)
+            s.total_tokens_out += acc_data.get("total_tokens_out", 0)
+            s.last_request_time = max(s.last_request_time, acc_data.get("last_request_time", 0))
+        for model, model_data in data.get("by_model", {}).items():
+            m = self.by_model[model]
+            m.total_requests += model_data.get("total_requests", 0)
+            m.total_errors += model_data.get("total_errors", 0)
+            m.total_latency_ms += model_data.get("total_latency_ms", 0)
+            histograms = model_data.get("histograms", {})
+            for name in ("latency", "ttfb", "upstream"):
+                if name in histograms:
+                    getattr(m, name).merge(LatencyHistogram.from_dict(histograms[name]))
+        for name, hist in data.get("histograms", {}).items():
+            if name in ("latency", "ttfb", "upstream"):
+                getattr(self, name).merge(LatencyHistogram.from_dict(hist))
+        # 小时粒度的历史计入该小时的第一分钟，按小时汇总时结果不变
+        cutoff = int(time.time() // 3600) - 24
+        for h, c in data.get("hourly_requests", {}).items():
+            if int(h) > cutoff:
+                self.timeline.record(int(h) * 3600, True, count=c)
+    
+    def _snapshot(self) -> dict:
+        """生成可写盘的快照（在事件循环中执行，只做内存拷贝）"""
+        return {
+            "by_account": {
+                acc_id: {
+                    "total_requests": s.total_requests,
+                    "total_errors": s.total_errors,
+                    "total_tokens_in": s.total_tokens_in,
+                    "total_tokens_out": s.total_tokens_out,
+                    "last_request_time": s.last_request_time,
+                }
+                for acc_id, s in self.by_account.items()
+            },
+            "by_model": {
+                model: {
+                    "total_requests": m.total_requests,
+                    "total_errors": m.total_errors,
+                    "total_latency_ms": m.total_latency_ms,
+                    "histograms": {
+                        "latency": m.latency.to_dict(),
+                        "ttfb": m.ttfb.to_dict(),
+                        "upstream": m.upstream.to_dict(),
+                    },
+                }
+                for model, m in self.by_model.items()
+            },
+            "histograms": {
+                "latency": self.latency.to_dict(),
+                "ttfb": self.ttfb.to_dict(),
+                "upstream": self.upstream.to_dict(),
+            },
+            "hourly_requests": self.hourly_requests,
+            "saved_at": time.time(),
+        }
+    
+    def _write(self, data: dict) -> bool:
         try:
-            self.PERSIST_PATH.parent.mkdir(parents=True, exist_ok=True)
-            data = {
-                "by_account": {
-                    acc_id: {
-                        "total_requests": s.total_requests,
-                        "total_errors": s.total_errors,
-                        "total_tokens_in": s.total_tokens_in,
-                        "total_tokens_out": s.total_tokens_out,
-                        "last_request_time": s.last_request_time,
-                    }
-                    for acc_id, s in self.by_account.items()
-                },
-                "by_model": {
-                    model: {
-                        "total_requests": m.total_requests,
-                        "total_errors": m.total_errors,
-                        "total_latency_ms": m.total_latency_ms,
-                    }
-                    for model, m in self.by_model.items()
-                },
-                "hourly_requests": dict(self.hourly_requests),
-                "saved_at": time.time(),
-            }
-            self.PERSIST_PATH.write_text(json.dumps(data, indent=2))
-            self._last_save_time = time.time()
-            self._dirty = False
+            atomic_write_json(self._persist_path, data)
         except Exception as e:
             print(f"[Stats] 保存统计文件失败: {e}")
+            return False
+        absorbed, self._absorbed = self._absorbed, []
+        for path in absorbed:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+        return True
+    
+    def _save_to_disk(self):
+        """同步持久化统计到 JSON 文件"""
+        self._dirty = False
+        if self._write(self._snapshot()):
+            self._last_save_time = time.time()
+        else:
+            self._dirty = True
+    
+    async def flush(self):
+        """生成快照并在线程池中写盘"""
+        if not self._dirty or self._saving:
+            return
+        self._saving = True
+        self._dirty = False
+        try:
+            data = self._snapshot()
+            ok = await asyncio.get_running_loop().run_in_executor(None, self._write, data)
+            if ok:
+                self._last_save_time = time.time()
+            else:
+                self._dirty = True
+        finally:
+            self._saving = False
+    
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.SAVE_DEBOUNCE_SECONDS)
+            await self.flush()
+    
+    def start(self):
+        """启动后台快照任务"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+    
+    async def stop(self):
+        """停止后台任务并写入最终快照"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.force_save()
     
     def force_save(self):
         """强制保存（关闭时调用）"""
@@ -174,7 +500,8 @@ class StatsManager:
             "error_rate": f"{stats.error_rate * 100:.1f}%",
             "total_tokens_in": stats.total_tokens_in,
             "total_tokens_out": stats.total_tokens_out,
-            "last_request": stats.last_request_time
+            "last_request": stats.last_request_time,
+            "last_hour": stats.recent.totals(time.time()),
         }
     
     def get_model_stats(self, model: str) -> dict:
@@ -183,11 +510,29 @@ class StatsManager:
         return {
             "total_requests": stats.total_requests,
             "total_errors": stats.total_errors,
-            "avg_latency_ms": round(stats.avg_latency_ms, 2)
+            "avg_latency_ms": round(stats.avg_latency_ms, 2),
+            "last_hour": stats.recent.totals(time.time()),
+            "latency_ms": {
+                "total": stats.latency.summary(),
+                "ttfb": stats.ttfb.summary(),
+                "upstream": stats.upstream.summary(),
+            },
         }
     
+    def get_timeseries(self, minutes: int = 60, account_id: str = None, model: str = None) -> List[int]:
+        """最近 minutes 分钟的每分钟请求数（可按账号或模型过滤）"""
+        now = time.time()
+        if account_id is not None:
+            stats = self.by_account.get(account_id)
+            return stats.recent.series(now, minutes) if stats else [0] * min(minutes, 60)
+        if model is not None:
+            stats = self.by_model.get(model)
+            return stats.recent.series(now, minutes) if stats else [0] * min(minutes, 60)
+        return self.timeline.series(now, minutes)
+    
     def get_all_stats(self) -> dict:
         """获取所有统计"""
+        hourly = self.hourly_requests
         return {
             "by_account": {
                 acc_id: self.get_account_stats(acc_id)
@@ -197,8 +542,14 @@ class StatsManager:
                 model: self.get_model_stats(model)
                 for model in self.by_model
             },
-            "hourly_requests": dict(self.hourly_requests),
-            "requests_last_24h": sum(self.hourly_requests.values())
+            "hourly_requests": hourly,
+            "requests_last_24h": sum(hourly.values()),
+            "requests_per_minute": self.get_timeseries(60),
+            "latency_ms": {
+                "total": self.latency.summary(),
+                "ttfb": self.ttfb.summary(),
+                "upstream": self.upstream.summary(),
+            },
         }
 
 
@@ -0,0 +1,212 @@
+"""Token 生命周期管理
+
+- 每账号 singleflight：同一账号并发的刷新请求共享同一次上游刷新
+- 按过期时间提前（带随机抖动）安排后台刷新，请求路径不再等待刷新
+- 启动时并发预刷新所有已过期 / 即将过期的账号
+- 请求路径上只有 token 剩余有效期不足 1 分钟时才会等待（共享进行中的刷新）
+"""
+import asyncio
+import random
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Tuple
+
+from . import metrics
+
+if TYPE_CHECKING:
+    from .account import Account
+
+
+class TokenManager:
+    """Token 刷新调度"""
+
+    # 在过期前多久刷新（秒），再减去 0 ~ REFRESH_JITTER 的随机抖动，错开各账号
+    REFRESH_LEAD = 15 * 60
+    REFRESH_JITTER = 5 * 60
+    # 请求路径上：剩余有效期低于该值才等待刷新，低于 BACKGROUND_LEAD 时后台刷新（秒）
+    BLOCKING_MARGIN = 60
+    BACKGROUND_LEAD = 5 * 60
+    # 刷新失败后的重试间隔（秒），期间请求路径不再触发刷新
+    RETRY_DELAY = 60
+    # 过期时间未知时的复查间隔 / 单次定时的最长间隔（秒）
+    UNKNOWN_EXPIRY_RECHECK = 30 * 60
+    MAX_TIMER_DELAY = 6 * 3600
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._timers: Dict[str, Tuple[float, asyncio.TimerHandle]] = {}
+        self._failed_at: Dict[str, float] = {}
+        self._running = False
+        self.refreshes = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.background = 0
+
+    # ==================== singleflight ====================
+
+    async def refresh(self, account: "Account") -> Tuple[bool, str]:
+        """刷新 token；同一账号已有刷新在进行时等待其结果"""
+        task = self._inflight.get(account.id)
+        if task is None:
+            task = asyncio.create_task(self._do_refresh(account))
+            self._inflight[account.id] = task
+        else:
+            self.coalesced += 1
+            metrics.token_refresh_coalesced.inc()
+        # shield：单个调用方被取消时不影响共享的刷新
+        return await asyncio.shield(task)
+
+    async def _do_refresh(self, account: "Account") -> Tuple[bool, str]:
+        try:
+            success, msg = await account.refresh_token()
+        except Exception as e:
+            success, msg = False, str(e)
+        finally:
+            self._inflight.pop(account.id, None)
+        self.refreshes += 1
+        metrics.token_refreshes.inc("success" if success else "failure")
+        if success:
+            self._failed_at.pop(account.id, None)
+            self.schedule(account)
+        else:
+            self.failures += 1
+            self._failed_at[account.id] = time.time()
+            self.schedule(account, delay=self.RETRY_DELAY)
+        return success, msg
+
+    def is_refreshing(self, account_id: str) -> bool:
+        return account_id in self._inflight
+
+    # ==================== 请求路径 ====================
+
+    def _backing_off(self, account_id: str) -> bool:
+        failed_at = self._failed_at.get(account_id)
+        return failed_at is not None and time.time() - failed_at < self.RETRY_DELAY
+
+    async def ensure_fresh(self, account: "Account", tag: str = "Token"):
+        """请求前调用：即将过期时只在后台触发刷新，确实过期才等待"""
+        creds = account.get_credentials()
+        if creds is None:
+            return
+        if account.id not in self._timers and self._running:
+            self.schedule(account)
+        epoch = creds.expires_epoch()
+        if epoch is None or not creds.refresh_token:
+            return
+        remaining = epoch - time.time()
+        if remaining >= self.BACKGROUND_LEAD:
+            return
+        if self.is_refreshing(account.id):
+            if remaining < self.BLOCKING_MARGIN:
+                await self.refresh(account)
+            return
+        if self._backing_off(account.id):
+            return
+        if remaining < self.BLOCKING_MARGIN:
+            print(f"[{tag}] Token 已过期，等待刷新: {account.id}")
+            success, msg = await self.refresh(account)
+            if not success:
+                print(f"[{tag}] Token 刷新失败: {msg}")
+        else:
+            print(f"[{tag}] Token 即将过期，后台刷新: {account.id}")
+            self._refresh_in_background(account)
+
+    def _refresh_in_background(self, account: "Account"):
+        if self.is_refreshing(account.id):
+            return
+        self.background += 1
+        self._inflight[account.id] = asyncio.create_task(self._do_refresh(account))
+
+    # ==================== 主动刷新调度 ====================
+
+    def _refresh_delay(self, account: "Account") -> float:
+        """距离计划刷新的秒数"""
+        creds = account.get_credentials()
+        epoch = creds.expires_epoch() if creds else None
+        if epoch is None:
+            return self.UNKNOWN_EXPIRY_RECHECK
+        lead = self.REFRESH_LEAD + random.uniform(0, self.REFRESH_JITTER)
+        return max(0.0, epoch - lead - time.time())
+
+    def schedule(self, account: "Account", delay: Optional[float] = None):
+        """（重新）安排账号的下一次主动刷新"""
+        if not self._running:
+            return
+        self.unschedule(account.id)
+        if delay is None:
+            delay = self._refresh_delay(account)
+        delay = min(delay, self.MAX_TIMER_DELAY)
+        loop = asyncio.get_running_loop()
+        handle = loop.call_later(delay, self._on_timer, account.id)
+        self._timers[account.id] = (time.time() + delay, handle)
+
+    def unschedule(self, account_id: str):
+        entry = self._timers.pop(account_id, None)
+        if entry is not None:
+            entry[1].cancel()
+
+    def _on_timer(self, account_id: str):
+        from .state import state
+        self._timers.pop(account_id, None)
+        account = state.get_account(account_id)
+        if account is None or not account.enabled or not state.registry.manages(account_id):
+            return
+        creds = account.get_credentials()
+        if creds is None or not creds.refresh_token:
+            return
+        if creds.is_expiring_soon(self.REFRESH_LEAD // 60):
+            self._refresh_in_background(account)
+        else:
+            # 凭证已被外部更新（如重新登录），按新的过期时间重新安排
+            self.schedule(account)
+
+    # ==================== 生命周期 ====================
+
+    def start(self, accounts: Iterable["Account"]):
+        """安排所有账号的主动刷新，已过期 / 即将过期的账号立即并发刷新"""
+        self._running = True
+        expired = 0
+        for account in accounts:
+            if not account.enabled:
+                continue
+            creds = account.get_credentials()
+            if creds and creds.refresh_token and creds.is_expiring_soon(self.REFRESH_LEAD // 60):
+                self._refresh_in_background(account)
+                expired += 1
+            else:
+                self.schedule(account)
+        if expired:
+            print(f"[TokenManager] 启动时预刷新 {expired} 个账号")
+
+    async def stop(self):
+        self._running = False
+        for account_id in list(self._timers):
+            self.unschedule(account_id)
+        tasks = list(self._inflight.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._inflight.clear()
+
+    def get_stats(self) -> dict:
+        """获取统计信息"""
+        now = time.time()
+        upcoming = sorted(at for at, _ in self._timers.values())
+        return {
+            "scheduled": len(self._timers),
+            "refreshing": len(self._inflight),
+            "next_refresh_in": round(upcoming[0] - now) if upcoming else None,
+            "refreshes": self.refreshes,
+            "coalesced": self.coalesced,
+            "background": self.background,
+            "failures": self.failures,
+        }
+
+
+# 全局实例
+token_manager = TokenManager()
+
+
+def get_token_manager() -> TokenManager:
+    """获取 Token 管理器实例"""
+    return token_manager
@@ -0,0 +1,589 @@
+"""上游执行引擎 - 统一的 Kiro API 调用、重试与故障转移
+
+四个协议处理器（Anthropic / OpenAI / Gemini / Responses）共用：
+- 账号切换（配额超限、封禁、连续网络错误），切换后按新账号重建请求头
+- 重试预算与带抖动的指数退避（core/retry.py）
+- 配额冷却标记、封禁账号禁用
+- CONTENT_TOO_LONG 时摘要/截断历史后重试
+- 网络错误重试耗尽后截断一次历史再试一轮
+- 读取中途断开时换账号续写（已输出的文本作为前缀），事件流对调用方连续
+- 流式请求可选对冲：首帧超时后用第二个账号并发请求（core/hedging.py）
+
+成功时返回已解码的事件流（UpstreamStream），协议处理器只负责编码输出。
+首字节之前的失败以 UpstreamError 抛出；之后的中断优先续写，无法续写时抛出原异常。
+"""
+import asyncio
+import time
+import httpx
+from dataclasses import dataclass
+from typing import Optional, List, AsyncIterator, Tuple
+
+from ..config import KIRO_API_URL
+from ..kiro_api import build_kiro_request, parse_event_stream, is_quota_exceeded_error
+from ..providers.kiro import EventStreamDecoder, KiroEvent
+from . import metrics
+from .error_handler import classify_error, ErrorType, KiroError, format_error_log
+from .hedging import get_hedge_policy
+from .history_manager import HistoryManager
+from .http_pool import http_pool
+from .rate_limiter import get_rate_limiter
+from .retry import is_retryable_error, backoff_delay
+from .token_manager import get_token_manager
+
+
+# 续写请求的用户消息（部分回复已作为 assistant 消息放入历史）
+CONTINUE_PROMPT = (
+    "Your previous response was interrupted. Continue exactly from where it stopped, "
+    "without repeating any of the text already written."
+)
+
+# KiroError 类型 -> (HTTP 状态码, 错误类型)
+ERROR_TYPE_MAP = {
+    ErrorType.ACCOUNT_SUSPENDED: (403, "authentication_error"),
+    ErrorType.RATE_LIMITED: (429, "rate_limit_error"),
+    ErrorType.CONTENT_TOO_LONG: (400, "invalid_request_error"),
+    ErrorType.AUTH_FAILED: (401, "authentication_error"),
+    ErrorType.SERVICE_UNAVAILABLE: (503, "api_error"),
+    ErrorType.MODEL_UNAVAILABLE: (503, "overloaded_error"),
+    ErrorType.UNKNOWN: (500, "api_error"),
+}
+
+
+class UpstreamError(Exception):
+    """上游调用最终失败（重试/切换账号均已用尽）
+
+    error_type 使用 Anthropic 风格的错误类型名（rate_limit_error、api_error、
+    timeout_error、connection_error 等），各协议按需映射。
+    """
+
+    def __init__(self, status_code: int, error_type: str, message: str, detail: str = "", error: Optional[KiroError] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.error_type = error_type
+        self.message = message
+        self.detail = detail
+        self.error = error
+
+
+@dataclass
+class UpstreamRequest:
+    """可重建的 Kiro 请求（截断历史后需要重新构建请求体）"""
+    user_content: str
+    model: str
+    history: Optional[List[dict]] = None
+    tools: Optional[List[dict]] = None
+    images: Optional[List[dict]] = None
+    tool_results: Optional[List[dict]] = None
+
+    def build(self) -> dict:
+        return build_kiro_request(
+            self.user_content, self.model, self.history,
+            tools=self.tools or None,
+            images=self.images or None,
+            tool_results=self.tool_results or None,
+        )
+
+    def continuation(self, partial_text: str) -> "UpstreamRequest":
+        """续写请求：原用户消息与已输出的部分回复移入历史"""
+        user_message = {
+            "content": self.user_content or "Continue",
+            "modelId": self.model,
+            "origin": "AI_EDITOR",
+        }
+        if self.tool_results:
+            user_message["userInputMessageContext"] = {"toolResults": self.tool_results}
+        history = list(self.history or []) + [
+            {"userInputMessage": user_message},
+            {"assistantResponseMessage": {"content": partial_text}},
+        ]
+        return UpstreamRequest(CONTINUE_PROMPT, self.model, history, self.tools)
+
+
+async def call_summary(account, prompt: str) -> str:
+    """用指定账号调用 Kiro API 生成摘要（历史压缩用）"""
+    kiro_request = build_kiro_request(prompt, "claude-haiku-4.5", [])  # 用快速模型生成摘要
+    try:
+        resp = await http_pool.api_client_for(account.id).post(
+            KIRO_API_URL, json=kiro_request, headers=account.get_headers(), timeout=60.0
+        )
+        if resp.status_code == 200:
+            return parse_event_stream(resp.content)
+    except Exception as e:
+        print(f"[Summary] API 调用失败: {e}")
+    return ""
+
+
+def _registry():
+    from .state import state
+    return state.registry
+
+
+def apply_error_to_account(error: KiroError, account, tag: str = "Upstream"):
+    """按错误类型处理账号状态：封禁则禁用，配额超限则标记冷却"""
+    if error.should_disable_account and account:
+        from ..credential import CredentialStatus
+        account.enabled = False
+        account.status = CredentialStatus.SUSPENDED
+        print(f"[{tag}] 账号 {account.id} 已被禁用 (封禁)")
+    elif error.type == ErrorType.RATE_LIMITED and account:
+        account.mark_quota_exceeded(error.message[:100])
+
+
+class UpstreamStream:
+    """一次成功（HTTP 200）的上游响应，按帧解码为 KiroEvent
+
+    关联了 executor 时，读取中途的网络中断会在另一个账号上续写，
+    新响应的事件接在同一个解码器后面，调用方看到的是一条连续的事件流。
+
+    打开期间计入账号的在途流数，并向 AccountRegistry 上报 TTFB 和吞吐。
+    """
+
+    def __init__(
+        self,
+        response: httpx.Response,
+        account,
+        executor: Optional["UpstreamExecutor"] = None,
+        sent_at: Optional[float] = None,
+    ):
+        self.response = response
+        self.account = account
+        self.executor = executor
+        self.decoder = EventStreamDecoder()
+        self._chunks = response.aiter_bytes()
+        self._first_chunk: Optional[bytes] = None
+        self._closed = False
+        self._sent_at = sent_at or time.time()
+        self._first_byte_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+        self._text_offset = 0  # 当前账号这一段输出在 decoder.text 中的起点
+        self._tracked = True
+        _registry().stream_started(account.id)
+
+    def _mark_first_byte(self):
+        if self._first_byte_at is None:
+            self._first_byte_at = time.time()
+            _registry().record_ttfb(self.account.id, (self._first_byte_at - self._sent_at) * 1000)
+            metrics.upstream_ttfb.observe(self._first_byte_at - self._sent_at)
+
+    def _release(self):
+        """结束当前账号的在途计数并上报吞吐"""
+        if self._tracked:
+            self._tracked = False
+            duration = time.time() - (self._first_byte_at or time.time())
+            _registry().stream_finished(self.account.id, len(self.decoder.text) - self._text_offset, duration)
+            if self._first_byte_at is not None:
+                metrics.upstream_stream_duration.observe(duration)
+
+    def timings(self, start_time: float) -> Tuple[Optional[float], Optional[float]]:
+        """(TTFB, 上游耗时)，单位毫秒
+
+        TTFB 从客户端请求开始算起（含重试 / 切换账号）；上游耗时是最后一次发出的请求
+        从发送到读完的时间。
+        """
+        ttfb_ms = (self._first_byte_at - start_time) * 1000 if self._first_byte_at else None
+        end = self._finished_at or time.time()
+        return ttfb_ms, (end - self._sent_at) * 1000
+
+    async def prime(self):
+        """预读首个数据块（对冲时以首帧到达作为胜出条件）"""
+        try:
+            self._first_chunk = await self._chunks.__anext__()
+            self._mark_first_byte()
+        except StopAsyncIteration:
+            self._first_chunk = b""
+
+    async def events(self) -> AsyncIterator[KiroEvent]:
+        """边读边解码；中断时尝试续写，结束时自动关闭连接"""
+        try:
+            while True:
+                try:
+                    if self._first_chunk:
+                        chunk, self._first_chunk = self._first_chunk, None
+                        for event in self.decoder.feed(chunk):
+                            yield event
+                    async for chunk in self._chunks:
+                        self._mark_first_byte()
+                        for event in self.decoder.feed(chunk):
+                            yield event
+                    return
+                except httpx.TransportError as e:
+                    if not self._can_resume():
+                        raise
+                    await self._resume(e)
+        finally:
+            await self.aclose()
+
+    def _can_resume(self) -> bool:
+        # 工具调用的参数无法从中间续写，只续写纯文本
+        return (
+            self.executor is not None
+            and self.executor.can_resume(self.decoder.text)
+            and not self.decoder.has_tool_uses
+        )
+
+    async def _resume(self, error: Exception):
+        """关闭中断的响应，改从续写请求读取后续内容"""
+        await self.response.aclose()
+        self._release()
+        self.decoder.discard_partial()
+        upstream = await self.executor.resume(self.decoder.text, error)
+        self.response = upstream.response
+        self.account = upstream.account
+        self._chunks = upstream._chunks
+        self._first_chunk = upstream._first_chunk
+        self._sent_at = upstream._sent_at
+        self._first_byte_at = upstream._first_byte_at
+        self._text_offset = len(self.decoder.text)
+        self._tracked, upstream._tracked = upstream._tracked, False
+
+    async def read_all(self) -> dict:
+        """读完整个响应并返回解码结果（非流式）"""
+        async for _ in self.events():
+            pass
+        return self.decoder.result()
+
+    def result(self) -> dict:
+        return self.decoder.result()
+
+    @property
+    def text(self) -> str:
+        return self.decoder.text
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._finished_at = time.time()
+            self._release()
+            await self.response.aclose()
+
+
+class UpstreamExecutor:
+    """带重试和故障转移的 Kiro API 调用
+
+    用法：
+        executor = UpstreamExecutor(account, UpstreamRequest(...), history_manager, tag="OpenAI")
+        upstream = await executor.open()     # 流式：首字节前完成所有重试
+        async for event in upstream.events(): ...
+        result, _ = await executor.fetch()   # 非流式：读取中断也会重试
+
+    executor.account 始终是当前（最后一次尝试）使用的账号。
+    """
+
+    def __init__(
+        self,
+        account,
+        request: UpstreamRequest,
+        history_manager: Optional[HistoryManager] = None,
+        tag: str = "Upstream",
+        max_retries: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 10.0,
+        max_resumes: int = 2,
+        admitted: bool = False,
+    ):
+        self.account = account
+        self.request = request
+        self.history_manager = history_manager
+        self.tag = tag
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_resumes = max_resumes
+        self.kiro_request = request.build()
+        self.retries = 0
+        self.resumes = 0
+        self._base_request = request
+        # 已通过准入控制的账号在准入时预占了限速额度，成功时不再重复记录
+        self._admitted_id = account.id if admitted else None
+        self._length_retries = 0
+        self._network_errors = 0  # 连续网络错误计数
+        self._truncated_for_network = False
+
+    # ==================== 重试辅助 ====================
+
+    def _can_retry(self) -> bool:
+        return self.retries < self.max_retries
+
+    async def _backoff(self, reason: str):
+        delay = backoff_delay(self.retries, self.base_delay, self.max_delay)
+        self.retries += 1
+        metrics.upstream_retries.inc(self.tag.lower())
+        print(f"[{self.tag}] {reason}，重试 {self.retries}/{self.max_retries}，延迟 {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    async def _switch_account(self, reason: str) -> bool:
+        """切换到下一个可用账号，成功返回 True（消耗一次重试预算）"""
+        from .state import state
+        next_account = state.get_next_available_account(self.account.id)
+        if not next_account:
+            return False
+        print(f"[{self.tag}] {reason}，切换账号: {self.account.id} -> {next_account.id}")
+        metrics.account_switches.inc(self.tag.lower())
+        self.account = next_account
+        await get_token_manager().ensure_fresh(next_account, self.tag)
+        self.retries += 1
+        self._network_errors = 0
+        return True
+
+    def _truncate_for_network_error(self) -> bool:
+        """网络错误重试耗尽后截断一次历史，重置重试预算"""
+        history = self.request.history
+        if self._truncated_for_network or not history or len(history) <= 6 or not self.history_manager:
+            return False
+        from ..converters import fix_history_alternation
+        self._truncated_for_network = True
+        keep = max(len(history) // 2, 4)
+        self.request.history = fix_history_alternation(history[-keep:])
+        self.kiro_request = self.request.build()
+        self.retries = 0
+        self._network_errors = 0
+        print(f"[{self.tag}] 网络错误重试耗尽，截断历史到 {len(self.request.history)} 条后重新尝试")
+        return True
+
+    async def _handle_content_too_long(self) -> bool:
+        """内容超长：摘要/截断历史后重建请求，返回是否应重试"""
+        hm = self.history_manager
+        if not hm:
+            return False
+        history_chars, user_chars, total_chars = hm.estimate_request_chars(
+            self.request.history, self.request.user_content
+        )
+        print(f"[{self.tag}] 内容长度超限: history={history_chars} chars, user={user_chars} chars, total={total_chars} chars")
+        account = self.account
+
+        async def api_caller(prompt: str) -> str:
+            return await call_summary(account, prompt)
+
+        truncated_history, should_retry = await hm.handle_length_error_async(
+            self.request.history, self._length_retries, api_caller
+        )
+        if not should_retry:
+            print(f"[{self.tag}] 内容长度超限但未重试: retry={self._length_retries}")
+            return False
+        print(f"[{self.tag}] 内容长度超限，{hm.truncate_info}")
+        self._length_retries += 1
+        self.request.history = truncated_history
+        self.kiro_request = self.request.build()
+        return True
+
+    # ==================== 单次尝试 ====================
+
+    async def _send(self, account) -> httpx.Response:
+        """以流式方式发送请求；非 200 时读完错误体"""
+        client = http_pool.api_client_for(account.id)
+        upstream_request = client.build_request(
+            "POST", KIRO_API_URL, json=self.kiro_request, headers=account.get_headers()
+        )
+        resp = await client.send(upstream_request, stream=True)
+        if resp.status_code != 200:
+            try:
+                await resp.aread()
+            finally:
+                await resp.aclose()
+        return resp
+
+    async def _handle_status(self, resp: httpx.Response) -> bool:
+        """处理非 200 响应：返回 True 表示应重试，否则抛出 UpstreamError"""
+        status = resp.status_code
+        error_text = resp.text
+
+        # 配额超限
+        if status == 429 or is_quota_exceeded_error(status, error_text):
+            self.account.mark_quota_exceeded("Rate limited")
+            if self._can_retry() and await self._switch_account("配额超限"):
+                return True
+            raise UpstreamError(429, "rate_limit_error", "All accounts rate limited", error_text[:500])
+
+        # 可重试的服务端错误
+        if is_retryable_error(status):
+            if self._can_retry():
+                await self._backoff(f"服务端错误 {status}")
+                return True
+            raise UpstreamError(status, "api_error", "Server error after retries", error_text[:500])
+
+        print(f"[{self.tag}] Kiro API Error {status}: {error_text[:500]}")
+        error = classify_error(status, error_text)
+        print(format_error_log(error, self.account.id))
+        apply_error_to_account(error, self.account, self.tag)
+
+        if error.should_switch_account and self._can_retry():
+            if await self._switch_account(error.type.value):
+                return True
+
+        if error.type == ErrorType.CONTENT_TOO_LONG and await self._handle_content_too_long():
+            return True
+
+        http_status, error_type = ERROR_TYPE_MAP.get(error.type, (500, "api_error"))
+        if error.type == ErrorType.UNKNOWN and 400 <= status < 600:
+            http_status = status  # 未识别的错误透传上游状态码
+        raise UpstreamError(http_status, error_type, error.user_message, error_text[:500], error)
+
+    async def _handle_exception(self, e: Exception) -> bool:
+        """处理网络异常：返回 True 表示应重试，否则抛出 UpstreamError"""
+        if isinstance(e, httpx.TimeoutException):
+            status, error_type, message = 408, "timeout_error", "Request timeout after retries"
+        elif isinstance(e, httpx.ConnectError):
+            status, error_type, message = 502, "connection_error", "Connection error after retries"
+        elif is_retryable_error(None, e):
+            status, error_type, message = 502, "api_error", f"Network error after retries: {type(e).__name__}"
+        else:
+            print(f"[{self.tag}] 不可重试的错误: {type(e).__name__}: {str(e)[:300]}")
+            raise UpstreamError(500, "api_error", str(e)) from e
+
+        if self._can_retry():
+            # 超时只退避重试；连接/读取错误连续 ≥2 次时换账号
+            if not isinstance(e, httpx.TimeoutException):
+                self._network_errors += 1
+                if self._network_errors >= 2 and await self._switch_account(f"网络错误 {type(e).__name__}"):
+                    return True
+            await self._backoff(f"网络错误 {type(e).__name__}")
+            return True
+
+        if self._truncate_for_network_error():
+            return True
+        raise UpstreamError(status, error_type, message, str(e)[:500]) from e
+
+    async def _attempt(self, account, prime: bool = False):
+        """单次尝试：非 200 返回已读完的响应，200 返回事件流（prime 时已收到首帧）"""
+        sent_at = time.time()
+        resp = await self._send(account)
+        if resp.status_code != 200:
+            return resp
+        upstream = UpstreamStream(resp, account, self, sent_at)
+        if prime:
+            try:
+                await upstream.prime()
+            except BaseException:
+                await upstream.aclose()
+                raise
+        return upstream
+
+    async def _attempt_hedged(self):
+        """发起请求，首帧超时后用另一个账号对冲，先出数据者胜出
+
+        返回值与 _attempt 相同；两路都失败时以原请求的结果为准。
+        """
+        policy = get_hedge_policy()
+        delay = policy.delay_seconds()
+        if delay is None:
+            return await self._attempt(self.account)
+        policy.record_request()
+
+        started = time.time()
+        primary = asyncio.create_task(self._attempt(self.account, prime=True))
+        tasks = {primary: self.account}
+        winner = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if not done:
+                from .state import state
+                hedge_account = state.get_next_available_account(self.account.id)
+                if hedge_account and policy.try_acquire():
+                    print(f"[{self.tag}] {delay * 1000:.0f}ms 内无首帧，对冲请求: {self.account.id} + {hedge_account.id}")
+                    await get_token_manager().ensure_fresh(hedge_account, self.tag)
+                    tasks[asyncio.create_task(self._attempt(hedge_account, prime=True))] = hedge_account
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # 同时完成时优先原请求
+                for task in sorted(done, key=lambda t: t is not primary):
+                    outcome = None if task.exception() else task.result()
+                    if isinstance(outcome, UpstreamStream):
+                        winner = outcome
+                        if task is not primary:
+                            policy.record_win()
+                            print(f"[{self.tag}] 对冲请求胜出: {tasks[task].id}")
+                            if not primary.done():
+                                # 落败的原请求至少等了这么久，计入其 TTFB
+                                _registry().record_ttfb(self.account.id, (time.time() - started) * 1000)
+                        self.account = tasks[task]
+                        return outcome
+                    if task is not primary and isinstance(outcome, httpx.Response) and outcome.status_code == 429:
+                        tasks[task].mark_quota_exceeded("Rate limited")
+            return primary.result()
+        finally:
+            await self._discard(list(tasks), winner)
+
+    @staticmethod
+    async def _discard(tasks, winner):
+        """取消未完成的任务，关闭落败方已打开的响应"""
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for outcome in results:
+            if isinstance(outcome, UpstreamStream) and outcome is not winner:
+                await outcome.aclose()
+
+    def _record_success(self):
+        account = self.account
+        account.request_count += 1
+        account.last_used = time.time()
+        if account.id == self._admitted_id:
+            self._admitted_id = None
+        else:
+            # 故障转移到的账号没有经过准入；全局额度在准入时已经计过
+            get_rate_limiter().record_account(account.id)
+
+    # ==================== 对外接口 ====================
+
+    async def open(self, hedge: bool = True) -> UpstreamStream:
+        """发起请求直到拿到 200 响应，返回尚未读取的事件流
+
+        hedge=True 且对冲已启用时，首帧超时会并发请求第二个账号。
+        """
+        while True:
+            try:
+                if hedge:
+                    outcome = await self._attempt_hedged()
+                else:
+                    outcome = await self._attempt(self.account)
+            except Exception as e:
+                await self._handle_exception(e)
+                continue
+
+            if isinstance(outcome, httpx.Response):
+                await self._handle_status(outcome)
+                continue
+
+            self._record_success()
+            return outcome
+
+    def can_resume(self, partial_text: str = "") -> bool:
+        """是否还能续写；带图片的请求已有部分输出时不续写（续写请求把原消息移入历史，图片无法随之保留）"""
+        if partial_text and self._base_request.images:
+            return False
+        return self.resumes < self.max_resumes
+
+    async def resume(self, partial_text: str, error: Exception) -> UpstreamStream:
+        """流式读取中断后续写：已输出的文本作为前缀，返回只含后续内容的事件流
+
+        优先换到另一个账号；没有可用账号时在当前账号上重试。
+        """
+        self.resumes += 1
+        metrics.stream_resumes.inc(self.tag.lower())
+        if partial_text:
+            self.request = self._base_request.continuation(partial_text)
+        else:
+            self.request = self._base_request
+        self.kiro_request = self.request.build()
+        reason = f"流式读取中断 ({type(error).__name__})，已输出 {len(partial_text)} 字符"
+        if not await self._switch_account(reason):
+            print(f"[{self.tag}] {reason}，在当前账号续写")
+        return await self.open(hedge=False)
+
+    async def fetch(self) -> Tuple[dict, UpstreamStream]:
+        """非流式：打开并读完响应；读取中断同样计入重试"""
+        while True:
+            upstream = await self.open(hedge=False)
+            try:
+                result = await upstream.read_all()
+                return result, upstream
+            except UpstreamError:
+                raise  # 续写时 open() 的最终失败，保留原状态码和错误类型
+            except Exception as e:
+                await self._handle_exception(e)
+                if self.request is not self._base_request:
+                    # 续写也失败，整体重新请求
+                    self.request = self._base_request
+                    self.kiro_request = self.request.build()
@@ -2,10 +2,12 @@
 import hashlib
 import platform
 import subprocess
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 
 
+@lru_cache(maxsize=1)
 def get_raw_machine_id() -> Optional[str]:
     """获取系统原始 Machine ID"""
     system = platform.system()
@@ -65,8 +67,9 @@ def generate_machine_id(
     return hasher.hexdigest()
 
 
+@lru_cache(maxsize=1)
 def get_kiro_version() -> str:
-    """获取 Kiro IDE 版本号"""
+    """获取 Kiro IDE 版本号（进程内只探测一次）"""
     if platform.system() == "Darwin":
         kiro_paths = [
             "/Applications/Kiro.app/Contents/Info.plist",
@@ -87,8 +90,9 @@ def get_kiro_version() -> str:
     return "0.1.25"
 
 
+@lru_cache(maxsize=1)
 def get_system_info() -> tuple:
-    """获取系统运行时信息 (os_name, node_version)"""
+    """获取系统运行时信息 (os_name, node_version)，进程内只探测一次"""
     system = platform.system()
     
     if system == "Darwin":
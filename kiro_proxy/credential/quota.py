@@ -52,6 +52,7 @@ class QuotaManager:
             reason=reason
         )
         self.exceeded_records[credential_id] = record
+        _coordination().set_cooldown(credential_id, record.cooldown_until, reason)
         return record
     
     def is_available(self, credential_id: str) -> bool:
@@ -85,10 +86,36 @@ class QuotaManager:
     
     def restore(self, credential_id: str) -> bool:
         """手动恢复凭证"""
+        _coordination().clear_cooldown(credential_id)
         if credential_id in self.exceeded_records:
             del self.exceeded_records[credential_id]
             return True
         return False
+    
+    def sync_from(self, cooldowns: Dict[str, tuple]) -> list:
+        """用共享存储中的冷却 {id: (until, reason)} 覆盖本地记录，返回发生变化的凭证 id"""
+        now = time.time()
+        changed = []
+        for credential_id, (until, reason) in cooldowns.items():
+            record = self.exceeded_records.get(credential_id)
+            if record is None or record.cooldown_until != until:
+                self.exceeded_records[credential_id] = QuotaRecord(
+                    credential_id=credential_id,
+                    exceeded_at=now,
+                    cooldown_until=until,
+                    reason=reason
+                )
+                changed.append(credential_id)
+        # 其他进程已恢复的凭证
+        for credential_id in [k for k in self.exceeded_records if k not in cooldowns]:
+            del self.exceeded_records[credential_id]
+            changed.append(credential_id)
+        return changed
+
+
+def _coordination():
+    from ..core.coordination import get_store
+    return get_store()
 
 
 # 全局实例
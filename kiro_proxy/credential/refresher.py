@@ -1,6 +1,5 @@
 """Token 刷新器"""
 import httpx
-from ..core.http_pool import http_pool
 from datetime import datetime, timezone, timedelta
 from typing import Tuple
 
@@ -82,6 +81,7 @@ class TokenRefresher:
                     "Accept": "application/json, text/plain, */*",
                 }
             
+            from ..core.http_pool import http_pool  # 延迟导入：core 依赖 credential，顶层导入会循环
             resp = await http_pool.short_client.post(refresh_url, json=body, headers=headers)
             
             if resp.status_code != 200:
@@ -1,11 +1,10 @@
 """凭证数据类型"""
 import json
 import time
-from dataclasses import dataclass
-from datetime import datetime, timezone, timedelta
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
 from enum import Enum
-from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 
 
 class CredentialStatus(Enum):
@@ -33,6 +32,9 @@ class KiroCredentials:
     last_refresh: Optional[str] = None
     start_url: Optional[str] = None
     
+    # (expires_at 原始值, 解析出的时间戳)，expires_at 变化时重新解析
+    _expires_cache: Tuple[Optional[str], Optional[float]] = field(default=(None, None), repr=False, compare=False)
+    
     @classmethod
     def from_file(cls, path: str) -> "KiroCredentials":
         """从文件加载凭证"""
@@ -71,51 +73,45 @@ class KiroCredentials:
             "startUrl": self.start_url,
         }
     
+    def save_updates(self) -> dict:
+        """需要合并进凭证文件的字段（保留文件中其他字段）"""
+        return {k: v for k, v in self.to_dict().items() if v is not None}
+    
     def save_to_file(self, path: str):
-        """保存凭证到文件"""
-        existing = {}
-        if Path(path).exists():
+        """保存凭证到文件（经延迟合并写入，原子替换）"""
+        from ..core.persistence import write_behind
+        write_behind.merge(path, self.save_updates())
+    
+    def expires_epoch(self) -> Optional[float]:
+        """过期时间戳（秒），无法解析时返回 None"""
+        raw, epoch = self._expires_cache
+        if raw == self.expires_at and raw is not None:
+            return epoch
+        epoch = None
+        if self.expires_at:
             try:
-                with open(path) as f:
-                    existing = json.load(f)
+                if "T" in self.expires_at:
+                    expires = datetime.fromisoformat(self.expires_at.replace("Z", "+00:00"))
+                    if expires.tzinfo is None:
+                        expires = expires.replace(tzinfo=timezone.utc)
+                    epoch = expires.timestamp()
+                else:
+                    epoch = float(int(self.expires_at))
             except Exception:
-                pass
-        
-        existing.update({k: v for k, v in self.to_dict().items() if v is not None})
-        
-        with open(path, "w") as f:
-            json.dump(existing, f, indent=2)
+                epoch = None
+        self._expires_cache = (self.expires_at, epoch)
+        return epoch
     
     def is_expired(self) -> bool:
-        """检查 token 是否已过期"""
-        if not self.expires_at:
-            return True
-        
-        try:
-            if "T" in self.expires_at:
-                expires = datetime.fromisoformat(self.expires_at.replace("Z", "+00:00"))
-                now = datetime.now(timezone.utc)
-                return expires <= now + timedelta(minutes=5)
-            
-            expires_ts = int(self.expires_at)
-            now_ts = int(time.time())
-            return now_ts >= (expires_ts - 300)
-        except Exception:
+        """检查 token 是否已过期（提前 5 分钟）"""
+        epoch = self.expires_epoch()
+        if epoch is None:
             return True
+        return time.time() >= epoch - 300
     
     def is_expiring_soon(self, minutes: int = 10) -> bool:
         """检查 token 是否即将过期"""
-        if not self.expires_at:
-            return False
-        
-        try:
-            if "T" in self.expires_at:
-                expires = datetime.fromisoformat(self.expires_at.replace("Z", "+00:00"))
-                now = datetime.now(timezone.utc)
-                return expires < now + timedelta(minutes=minutes)
-            
-            expires_ts = int(self.expires_at)
-            now_ts = int(time.time())
-            return now_ts >= (expires_ts - minutes * 60)
-        except Exception:
+        epoch = self.expires_epoch()
+        if epoch is None:
             return False
+        return time.time() >= epoch - minutes * 60
@@ -4,6 +4,13 @@ import uuid
 import time
 import httpx
 from ..core.http_pool import http_pool
+from ..core.hedging import get_hedge_policy
+from ..core.admission import get_admission
+from ..core import coordination
+from ..core.token_manager import get_token_manager
+from ..core.probe import get_probe_engine
+from ..core.persistence import get_persistence_stats
+from .. import prefork
 from pathlib import Path
 from datetime import datetime
 from dataclasses import asdict
@@ -33,7 +40,19 @@ async def get_status():
 
 async def get_stats():
     """获取统计信息"""
-    return state.get_stats()
+    stats = state.get_stats()
+    stats["http_pool"] = http_pool.get_stats()
+    stats["hedge"] = get_hedge_policy().get_stats()
+    stats["sessions"] = state.sessions.get_stats()
+    stats["admission"] = get_admission().get_stats()
+    stats["coordination"] = coordination.get_stats()
+    stats["tokens"] = get_token_manager().get_stats()
+    stats["probe"] = get_probe_engine().get_stats()
+    stats["persistence"] = get_persistence_stats()
+    cluster = prefork.get_cluster_stats()
+    if cluster is not None:
+        stats["cluster"] = cluster
+    return stats
 
 
 async def event_logging_batch(request: Request):
@@ -109,7 +128,7 @@ async def add_account(request: Request):
         name=name,
         token_path=token_path
     )
-    state.accounts.append(account)
+    state.add_account(account)
     
     # 预加载凭证
     account.load_credentials()
@@ -122,9 +141,12 @@ async def add_account(request: Request):
 
 async def delete_account(account_id: str):
     """删除账号"""
-    state.accounts = [a for a in state.accounts if a.id != account_id]
+    state.remove_account(account_id)
+    get_admission().drop_account(account_id)
     # 清理配额记录
     quota_manager.restore(account_id)
+    # 释放该账号的连接
+    await http_pool.drop_account_client(account_id)
     # 保存配置
     state._save_accounts()
     return {"ok": True}
@@ -132,12 +154,12 @@ async def delete_account(account_id: str):
 
 async def toggle_account(account_id: str):
     """启用/禁用账号"""
-    for acc in state.accounts:
-        if acc.id == account_id:
-            acc.enabled = not acc.enabled
-            # 保存配置
-            state._save_accounts()
-            return {"ok": True, "enabled": acc.enabled}
+    acc = state.get_account(account_id)
+    if acc:
+        acc.enabled = not acc.enabled
+        # 保存配置
+        state._save_accounts()
+        return {"ok": True, "enabled": acc.enabled}
     raise HTTPException(404, "Account not found")
 
 
@@ -160,12 +182,9 @@ async def refresh_all_tokens():
 async def restore_account(account_id: str):
     """恢复账号（从冷却状态）"""
     restored = quota_manager.restore(account_id)
-    if restored:
-        for acc in state.accounts:
-            if acc.id == account_id:
-                from ..credential import CredentialStatus
-                acc.status = CredentialStatus.ACTIVE
-                break
+    acc = state.get_account(account_id)
+    if restored and acc:
+        acc.status = CredentialStatus.ACTIVE
     return {"ok": restored}
 
 
@@ -268,7 +287,7 @@ async def add_from_scan(request: Request):
         name=name,
         token_path=token_path
     )
-    state.accounts.append(account)
+    state.add_account(account)
     
     # 预加载凭证
     account.load_credentials()
@@ -306,7 +325,7 @@ async def import_config(request: Request):
                     token_path=token_path,
                     enabled=acc_data.get("enabled", True)
                 )
-                state.accounts.append(account)
+                state.add_account(account)
                 account.load_credentials()
                 imported += 1
     
@@ -386,95 +405,35 @@ async def get_detailed_stats():
     }
 
 
-async def run_health_check():
-    """手动触发健康检查"""
-    results = []
-    
-    for acc in state.accounts:
-        if not acc.enabled:
-            results.append({
-                "id": acc.id,
-                "name": acc.name,
-                "status": "disabled",
-                "healthy": False
-            })
-            continue
-        
-        try:
-            token = acc.get_token()
-            if not token:
-                acc.status = CredentialStatus.UNHEALTHY
-                results.append({
-                    "id": acc.id,
-                    "name": acc.name,
-                    "status": "no_token",
-                    "healthy": False
-                })
-                continue
-            
-            headers = {
-                "Authorization": f"Bearer {token}",
-                "content-type": "application/json"
-            }
-            
-            resp = await http_pool.model_client.get(
-                MODELS_URL,
-                headers=headers,
-                params={"origin": "AI_EDITOR"}
-            )
-            
-            if resp.status_code == 200:
-                if acc.status == CredentialStatus.UNHEALTHY:
-                    acc.status = CredentialStatus.ACTIVE
-                results.append({
-                    "id": acc.id,
-                    "name": acc.name,
-                    "status": "healthy",
-                    "healthy": True,
-                    "latency_ms": resp.elapsed.total_seconds() * 1000
-                })
-            elif resp.status_code == 401:
-                acc.status = CredentialStatus.UNHEALTHY
-                results.append({
-                    "id": acc.id,
-                    "name": acc.name,
-                    "status": "auth_failed",
-                    "healthy": False
-                })
-            elif resp.status_code == 429:
-                results.append({
-                    "id": acc.id,
-                    "name": acc.name,
-                    "status": "rate_limited",
-                    "healthy": True  # 限流不代表不健康
-                })
-            else:
-                results.append({
-                    "id": acc.id,
-                    "name": acc.name,
-                    "status": f"error_{resp.status_code}",
-                    "healthy": False
-                })
-                    
-        except Exception as e:
-            results.append({
-                "id": acc.id,
-                "name": acc.name,
-                "status": "error",
-                "healthy": False,
-                "error": str(e)
-            })
+async def run_health_check(force: bool = False):
+    """手动触发健康检查（结果足够新时直接返回缓存）"""
+    engine = get_probe_engine()
+    accounts = state.accounts
+    results = None if force else engine.cached_results(accounts)
+    cached = results is not None
+    if results is None:
+        results = await engine.check_all(accounts)
+        order = {acc.id: i for i, acc in enumerate(accounts)}
+        results.sort(key=lambda r: order.get(r.id, 0))
     
-    healthy_count = len([r for r in results if r["healthy"]])
+    healthy_count = len([r for r in results if r.healthy])
     return {
         "ok": True,
+        "cached": cached,
         "total": len(results),
         "healthy": healthy_count,
         "unhealthy": len(results) - healthy_count,
-        "results": results
+        "results": [r.to_dict() for r in results]
     }
 
 
+def stream_probe(kind: str = "health"):
+    """手动全量健康检查 / 刷新的 SSE 进度流"""
+    if kind not in ("health", "refresh"):
+        raise HTTPException(400, "kind must be 'health' or 'refresh'")
+    return get_probe_engine().stream(state.accounts, kind)
+
+
 # ==================== Kiro 登录 API ====================
 
 async def get_browsers():
@@ -527,7 +486,7 @@ async def poll_kiro_login():
             name="在线登录账号",
             token_path=file_path
         )
-        state.accounts.append(account)
+        state.add_account(account)
         account.load_credentials()
         state._save_accounts()
         
@@ -618,7 +577,7 @@ async def exchange_social_token(request: Request):
             name=f"{provider} 登录账号",
             token_path=file_path
         )
-        state.accounts.append(account)
+        state.add_account(account)
         account.load_credentials()
         state._save_accounts()
         
@@ -662,10 +621,14 @@ async def get_flows(
     has_error: bool = None,
     bookmarked: bool = None,
     search: str = None,
+    min_duration_ms: float = None,
+    max_duration_ms: float = None,
+    start_time: float = None,
+    end_time: float = None,
     limit: int = 50,
     offset: int = 0,
 ):
-    """查询 Flows"""
+    """查询 Flows（分页，total 为匹配总数）"""
     from ..core.flow_monitor import FlowState
     
     state_enum = None
@@ -675,13 +638,17 @@ async def get_flows(
         except ValueError:
             pass
     
-    flows = flow_monitor.query(
+    flows, total = flow_monitor.query_page(
         protocol=protocol,
         model=model,
         account_id=account_id,
         state=state_enum,
         has_error=has_error,
         bookmarked=bookmarked,
+        min_duration_ms=min_duration_ms,
+        max_duration_ms=max_duration_ms,
+        start_time=start_time,
+        end_time=end_time,
         search=search,
         limit=limit,
         offset=offset,
@@ -689,7 +656,9 @@ async def get_flows(
     
     return {
         "flows": [f.to_dict() for f in flows],
-        "total": len(flows),
+        "total": total,
+        "limit": limit,
+        "offset": offset,
     }
 
 
@@ -845,7 +814,7 @@ async def import_accounts(request: Request):
                 token_path=file_path,
                 enabled=acc_data.get("enabled", True)
             )
-            state.accounts.append(account)
+            state.add_account(account)
             account.load_credentials()
             imported += 1
         except Exception as e:
@@ -899,7 +868,7 @@ async def add_manual_token(request: Request):
         name=name,
         token_path=file_path
     )
-    state.accounts.append(account)
+    state.add_account(account)
     account.load_credentials()
     state._save_accounts()
     
@@ -996,7 +965,7 @@ async def complete_remote_login(session_id: str, request: Request):
             name=f"远程登录 ({provider})",
             token_path=file_path
         )
-        state.accounts.append(account)
+        state.add_account(account)
         account.load_credentials()
         state._save_accounts()
         
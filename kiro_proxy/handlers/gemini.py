@@ -1,25 +1,37 @@
-"""Gemini 协议处理 - /v1/models/{model}:generateContent"""
+"""Gemini 协议处理 - /v1/models/{model}:generateContent / :streamGenerateContent"""
 import json
 import uuid
 import time
 import hashlib
-import asyncio
-import httpx
-from ..core.http_pool import http_pool
 from fastapi import Request, HTTPException
+from fastapi.responses import StreamingResponse, JSONResponse
 
-from ..config import KIRO_API_URL, map_model_name
-from ..core import state, is_retryable_error
+from ..config import map_model_name
+from ..core import state, metrics
 from ..core.state import RequestLog
 from ..core.history_manager import HistoryManager, get_history_config, is_content_length_error
-from ..core.error_handler import classify_error, ErrorType, format_error_log
-from ..core.rate_limiter import get_rate_limiter
-from ..kiro_api import build_headers, build_kiro_request, parse_event_stream, parse_event_stream_full, is_quota_exceeded_error
+from ..core.admission import get_admission, AdmissionRejected
+from ..core.token_manager import get_token_manager
+from ..core.upstream import UpstreamExecutor, UpstreamRequest, UpstreamError, call_summary
+from ..providers.kiro import TextDelta, ToolUseDelta
 from ..converters import convert_gemini_contents_to_kiro, convert_kiro_response_to_gemini, convert_gemini_tools_to_kiro
 
 
 async def handle_generate_content(model_name: str, request: Request):
     """处理 Gemini generateContent 请求"""
+    return await _handle_gemini(model_name, request, stream=False)
+
+
+async def handle_stream_generate_content(model_name: str, request: Request):
+    """处理 Gemini streamGenerateContent 请求
+
+    alt=sse 时按 SSE（data: {...}）输出，否则按 Gemini REST 默认的流式 JSON 数组输出。
+    """
+    return await _handle_gemini(model_name, request, stream=True)
+
+
+async def _handle_gemini(model_name: str, request: Request, stream: bool):
+    """Gemini 请求的公共流程：账号选择、消息转换、带故障转移的上游调用"""
     start_time = time.time()
     log_id = uuid.uuid4().hex[:8]
     
@@ -38,32 +50,19 @@ async def handle_generate_content(model_name: str, request: Request):
     if not account:
         raise HTTPException(503, "All accounts are rate limited")
     
-    # 检查 token 是否即将过期
-    if account.is_token_expiring_soon(5):
-        print(f"[Gemini] Token 即将过期，尝试刷新: {account.id}")
-        success, msg = await account.refresh_token()
-        if not success:
-            print(f"[Gemini] Token 刷新失败: {msg}")
+    # token 即将过期时后台刷新，已过期才等待
+    await get_token_manager().ensure_fresh(account, "Gemini")
     
     token = account.get_token()
     if not token:
         raise HTTPException(500, f"Failed to get token for account {account.name}")
     
-    # 构建 headers（提前构建，供摘要使用）
-    creds = account.get_credentials()
-    headers = build_headers(
-        token,
-        machine_id=account.get_machine_id(),
-        profile_arn=creds.profile_arn if creds else None,
-        client_id=creds.client_id if creds else None
-    )
-    
-    # 限速检查
-    rate_limiter = get_rate_limiter()
-    can_request, wait_seconds, reason = rate_limiter.can_request(account.id)
-    if not can_request:
-        print(f"[Gemini] 限速: {reason}")
-        await asyncio.sleep(wait_seconds)
+    # 准入控制：按限速排队，队列满或等待超时直接拒绝
+    try:
+        await get_admission().admit(account.id)
+    except AdmissionRejected as e:
+        print(f"[Gemini] 限速拒绝: {e.message}")
+        return JSONResponse(e.body("gemini"), status_code=e.status_code("gemini"), headers=e.headers)
     
     # 转换消息格式
     user_content, history, tool_results, kiro_tools = convert_gemini_contents_to_kiro(
@@ -73,19 +72,12 @@ async def handle_generate_content(model_name: str, request: Request):
     # 历史消息预处理
     history_manager = HistoryManager(get_history_config(), cache_key=session_id)
     
-    async def call_summary(prompt: str) -> str:
-        req = build_kiro_request(prompt, "claude-haiku-4.5", [])
-        try:
-            resp = await http_pool.short_client.post(KIRO_API_URL, json=req, headers=headers)
-            if resp.status_code == 200:
-                return parse_event_stream(resp.content)
-        except Exception as e:
-            print(f"[Summary] API 调用失败: {e}")
-        return ""
+    async def summary_caller(prompt: str) -> str:
+        return await call_summary(account, prompt)
 
     # 检查是否需要智能摘要或错误重试预摘要
     if history_manager.should_summarize(history) or history_manager.should_pre_summary_for_error_retry(history, user_content):
-        history = await history_manager.pre_process_async(history, user_content, call_summary)
+        history = await history_manager.pre_process_async(history, user_content, summary_caller)
     else:
         history = history_manager.pre_process(history, user_content)
     
@@ -95,162 +87,125 @@ async def handle_generate_content(model_name: str, request: Request):
     
     if history_manager.was_truncated:
         print(f"[Gemini] {history_manager.truncate_info}")
-
-    async def call_summary(prompt: str) -> str:
-        req = build_kiro_request(prompt, "claude-haiku-4.5", [])
-        try:
-            resp = await http_pool.short_client.post(KIRO_API_URL, json=req, headers=headers)
-            if resp.status_code == 200:
-                return parse_event_stream(resp.content)
-        except Exception as e:
-            print(f"[Summary] API 调用失败: {e}")
-        return ""
     
-    # 构建 Kiro 请求
-    kiro_request = build_kiro_request(
-        user_content, model, history,
-        tools=kiro_tools if kiro_tools else None,
-        tool_results=tool_results if tool_results else None
+    action = "streamGenerateContent" if stream else "generateContent"
+    executor = UpstreamExecutor(
+        account,
+        UpstreamRequest(user_content, model, history, kiro_tools, tool_results=tool_results),
+        history_manager,
+        tag="Gemini",
+        admitted=True,
     )
+    try:
+        if stream:
+            # 首字节前完成重试/切换账号，成功后流式透传
+            upstream = await executor.open()
+        else:
+            result, upstream = await executor.fetch()
+    except UpstreamError as e:
+        _log_request(log_id, model, executor.account, f"/v1/models/{model_name}:{action}", e.status_code, start_time, e.detail or e.message)
+        raise HTTPException(e.status_code, e.message)
+    
+    if stream:
+        alt_sse = request.query_params.get("alt") == "sse"
+        return _stream_gemini_response(upstream, model, model_name, log_id, start_time, alt_sse)
+    
+    _log_request(log_id, model, upstream.account, f"/v1/models/{model_name}:{action}", 200, start_time)
     
-    error_msg = None
-    status_code = 200
-    content = ""
-    current_account = account
-    max_retries = 2
-    
-    for retry in range(max_retries + 1):
-        try:
-            resp = await http_pool.api_client.post(KIRO_API_URL, json=kiro_request, headers=headers)
-            status_code = resp.status_code
-            
-            # 处理配额超限
-            if resp.status_code == 429 or is_quota_exceeded_error(resp.status_code, resp.text):
-                current_account.mark_quota_exceeded("Rate limited")
-                next_account = state.get_next_available_account(current_account.id)
-                if next_account and retry < max_retries:
-                    print(f"[Gemini] 配额超限，切换账号: {current_account.id} -> {next_account.id}")
-                    current_account = next_account
-                    token = current_account.get_token()
-                    creds = current_account.get_credentials()
-                    headers = build_headers(
-                        token,
-                        machine_id=current_account.get_machine_id(),
-                        profile_arn=creds.profile_arn if creds else None,
-                        client_id=creds.client_id if creds else None
-                    )
-                    continue
-                raise HTTPException(429, "All accounts rate limited")
-            
-            # 处理可重试的服务端错误
-            if is_retryable_error(resp.status_code):
-                if retry < max_retries:
-                    print(f"[Gemini] 服务端错误 {resp.status_code}，重试 {retry + 1}/{max_retries}")
-                    import asyncio
-                    await asyncio.sleep(0.5 * (2 ** retry))
-                    continue
-                raise HTTPException(resp.status_code, f"Server error after {max_retries} retries")
-            
-            if resp.status_code != 200:
-                error_msg = resp.text
-                
-                # 使用统一的错误处理
-                error = classify_error(resp.status_code, error_msg)
-                print(format_error_log(error, current_account.id))
-                
-                # 账号封禁 - 禁用账号
-                if error.should_disable_account:
-                    current_account.enabled = False
-                    from ..credential import CredentialStatus
-                    current_account.status = CredentialStatus.SUSPENDED
-                    print(f"[Gemini] 账号 {current_account.id} 已被禁用 (封禁)")
-                
-                # 配额超限 - 标记冷却
-                if error.type == ErrorType.RATE_LIMITED:
-                    current_account.mark_quota_exceeded(error_msg[:100])
-                
-                # 尝试切换账号
-                if error.should_switch_account:
-                    next_account = state.get_next_available_account(current_account.id)
-                    if next_account and retry < max_retries:
-                        print(f"[Gemini] 切换账号: {current_account.id} -> {next_account.id}")
-                        current_account = next_account
-                        headers["Authorization"] = f"Bearer {current_account.get_token()}"
-                        continue
-                
-                # 检查是否为内容长度超限错误
-                if error.type == ErrorType.CONTENT_TOO_LONG:
-                    history_chars, user_chars, total_chars = history_manager.estimate_request_chars(
-                        history, user_content
-                    )
-                    print(f"[Gemini] 内容长度超限: history={history_chars} chars, user={user_chars} chars, total={total_chars} chars")
-                    truncated_history, should_retry = await history_manager.handle_length_error_async(
-                        history, retry, call_summary
-                    )
-                    if should_retry:
-                        print(f"[Gemini] 内容长度超限，{history_manager.truncate_info}")
-                        history = truncated_history
-                        kiro_request = build_kiro_request(
-                            user_content, model, history,
-                            tools=kiro_tools if kiro_tools else None,
-                            tool_results=tool_results if tool_results else None
-                        )
-                        continue
-                    else:
-                        print(f"[Gemini] 内容长度超限但未重试: retry={retry}/{max_retries}")
-                
-                raise HTTPException(resp.status_code, error.user_message)
-            
-            # 使用完整解析以支持工具调用
-            result = parse_event_stream_full(resp.content)
-            current_account.request_count += 1
-            current_account.last_used = time.time()
-            get_rate_limiter().record_request(current_account.id)
-            break
-                
-        except HTTPException:
-            raise
-        except httpx.TimeoutException:
-            error_msg = "Request timeout"
-            status_code = 408
-            if retry < max_retries:
-                print(f"[Gemini] 请求超时，重试 {retry + 1}/{max_retries}")
-                import asyncio
-                await asyncio.sleep(0.5 * (2 ** retry))
-                continue
-            raise HTTPException(408, "Request timeout after retries")
-        except httpx.ConnectError:
-            error_msg = "Connection error"
-            status_code = 502
-            if retry < max_retries:
-                print(f"[Gemini] 连接错误，重试 {retry + 1}/{max_retries}")
-                import asyncio
-                await asyncio.sleep(0.5 * (2 ** retry))
-                continue
-            raise HTTPException(502, "Connection error after retries")
-        except Exception as e:
-            error_msg = str(e)
-            status_code = 500
-            if is_retryable_error(None, e) and retry < max_retries:
-                print(f"[Gemini] 网络错误，重试 {retry + 1}/{max_retries}: {type(e).__name__}")
-                import asyncio
-                await asyncio.sleep(0.5 * (2 ** retry))
-                continue
-            raise HTTPException(500, str(e))
-    
-    # 记录日志
+    # 使用转换函数生成 Gemini 格式响应
+    return convert_kiro_response_to_gemini(result, model)
+
+
+def _log_request(log_id: str, model: str, account, path: str, status_code: int, start_time: float, error: str = None):
+    """记录请求日志"""
     duration = (time.time() - start_time) * 1000
     state.add_log(RequestLog(
         id=log_id,
         timestamp=time.time(),
         method="POST",
-        path=f"/v1/models/{model_name}:generateContent",
+        path=path,
         model=model,
-        account_id=current_account.id if current_account else None,
+        account_id=account.id if account else None,
         status=status_code,
         duration_ms=duration,
-        error=error_msg
+        error=error
     ))
-    
-    # 使用转换函数生成 Gemini 格式响应
-    return convert_kiro_response_to_gemini(result, model)
+    metrics.observe_request("gemini", model, account.id if account else None, status_code, duration / 1000)
+
+
+def _gemini_chunk(model: str, text: str = "", tool_use: dict = None) -> dict:
+    """构建中间 GenerateContentResponse 块（不含 finishReason/usageMetadata）"""
+    chunk = convert_kiro_response_to_gemini({
+        "content": [text] if text else [],
+        "tool_uses": [tool_use] if tool_use else [],
+    }, model)
+    chunk["candidates"][0].pop("finishReason", None)
+    chunk.pop("usageMetadata", None)
+    return chunk
+
+
+def _stream_gemini_response(upstream, model: str, model_name: str, log_id: str, start_time: float, alt_sse: bool):
+    """将 Kiro event-stream 实时转为 Gemini 流式响应
+
+    - 文本增量逐块发送
+    - functionCall 需要完整参数，在工具调用结束（stop）时整体发送
+    - 最后一块带 finishReason 和 usageMetadata
+    """
+    async def generate():
+        decoder = upstream.decoder
+        sent_tools = set()
+        error_msg = None
+        status_code = 200
+        first = True
+        
+        def encode(chunk: dict) -> str:
+            nonlocal first
+            data = json.dumps(chunk, ensure_ascii=False)
+            if alt_sse:
+                return f"data: {data}\r\n\r\n"
+            prefix = "[" if first else ",\r\n"
+            first = False
+            return prefix + data
+        
+        try:
+            async for event in upstream.events():
+                if isinstance(event, TextDelta):
+                    yield encode(_gemini_chunk(model, text=event.text))
+                elif isinstance(event, ToolUseDelta) and event.stop:
+                    tool_use = decoder.get_tool_use(event.tool_use_id)
+                    if tool_use:
+                        sent_tools.add(event.tool_use_id)
+                        yield encode(_gemini_chunk(model, tool_use=tool_use))
+        except Exception as e:
+            error_msg = f"{type(e).__name__}: {e}"
+            status_code = 502
+            print(f"[Gemini] 流式读取中断: {error_msg}")
+        finally:
+            await upstream.aclose()
+        
+        result = decoder.result()
+        
+        # 未收到 stop 标记的工具调用在流结束时补发
+        for tool_use in result["tool_uses"]:
+            if tool_use["id"] not in sent_tools:
+                yield encode(_gemini_chunk(model, tool_use=tool_use))
+        
+        if error_msg:
+            yield encode({"error": {"code": status_code, "message": error_msg, "status": "UNAVAILABLE"}})
+        else:
+            final = convert_kiro_response_to_gemini(result, model)
+            final["candidates"][0]["content"]["parts"] = [{"text": ""}]
+            yield encode(final)
+        if not alt_sse:
+            yield "]"
+        
+        _log_request(log_id, model, upstream.account, f"/v1/models/{model_name}:streamGenerateContent", status_code, start_time, error_msg)
+    
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream" if alt_sse else "application/json",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
@@ -5,19 +5,17 @@ Codex CLI 使用的 API 端点，深度适配 Codex 源码
 import json
 import uuid
 import time
-import asyncio
-import httpx
-from ..core.http_pool import http_pool
 from fastapi import Request, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse
 
-from ..config import KIRO_API_URL, map_model_name
-from ..core import state, is_retryable_error, stats_manager
-from ..core.state import RequestLog
+from ..config import map_model_name
+from ..core import state, metrics
 from ..core.history_manager import HistoryManager, get_history_config
-from ..core.error_handler import classify_error, ErrorType, format_error_log
-from ..core.rate_limiter import get_rate_limiter
-from ..kiro_api import build_headers, build_kiro_request, parse_event_stream, parse_event_stream_full, is_quota_exceeded_error
+from ..core.error_handler import ErrorType
+from ..core.admission import get_admission, AdmissionRejected
+from ..core.token_manager import get_token_manager
+from ..core.upstream import UpstreamExecutor, UpstreamRequest, UpstreamError, call_summary
+from ..providers.kiro import TextDelta
 
 
 def _convert_responses_input_to_kiro(input_data, instructions: str = None):
@@ -373,25 +371,18 @@ async def handle_responses(request: Request):
     if not account:
         raise HTTPException(503, "All accounts are rate limited or unavailable")
     
-    if account.is_token_expiring_soon(5):
-        await account.refresh_token()
+    await get_token_manager().ensure_fresh(account, "Responses")
     
     token = account.get_token()
     if not token:
         raise HTTPException(500, f"Failed to get token for account {account.name}")
     
-    creds = account.get_credentials()
-    headers = build_headers(
-        token,
-        machine_id=account.get_machine_id(),
-        profile_arn=creds.profile_arn if creds else None,
-        client_id=creds.client_id if creds else None
-    )
-    
-    rate_limiter = get_rate_limiter()
-    can_request, wait_seconds, _ = rate_limiter.can_request(account.id)
-    if not can_request:
-        await asyncio.sleep(wait_seconds)
+    # 准入控制：按限速排队，队列满或等待超时直接拒绝
+    try:
+        await get_admission().admit(account.id)
+    except AdmissionRejected as e:
+        print(f"[Responses] 限速拒绝: {e.message}")
+        return JSONResponse(e.body("openai"), status_code=e.status_code("openai"), headers=e.headers)
     
     user_content, history, tool_results, images = _convert_responses_input_to_kiro(input_data, instructions)
     
@@ -408,14 +399,7 @@ async def handle_responses(request: Request):
     
     # 创建摘要 API 调用函数
     async def api_caller(prompt: str) -> str:
-        req = build_kiro_request(prompt, "claude-haiku-4.5", [])
-        try:
-            resp = await http_pool.short_client.post(KIRO_API_URL, json=req, headers=headers)
-            if resp.status_code == 200:
-                return parse_event_stream(resp.content)
-        except Exception as e:
-            print(f"[Responses] Summary API 调用失败: {e}")
-        return ""
+        return await call_summary(account, prompt)
     
     # 检查是否需要智能摘要或错误重试预摘要
     if history_manager.should_summarize(history) or history_manager.should_pre_summary_for_error_retry(history, user_content):
@@ -486,12 +470,14 @@ async def handle_responses(request: Request):
             if not arm.get("content"):
                 arm["content"] = "I understand."
     
-    kiro_request = build_kiro_request(
-        user_content, model, history,
-        tools=kiro_tools,
-        images=images,
-        tool_results=tool_results if tool_results else None
+    executor = UpstreamExecutor(
+        account,
+        UpstreamRequest(user_content, model, history, kiro_tools, images, tool_results),
+        history_manager,
+        tag="Responses",
+        admitted=True,
     )
+    kiro_request = executor.kiro_request
     
     # 调试：打印完整的 Kiro 请求（使用深拷贝避免修改原始请求）
     if tool_results:
@@ -512,21 +498,25 @@ async def handle_responses(request: Request):
         print(f"[Responses] Kiro request structure: {json.dumps(debug_request, indent=2)}")
     
     if stream:
-        return await _handle_stream(kiro_request, headers, account, model, log_id, start_time)
+        return await _handle_stream(executor, model, log_id, start_time)
     
     # 非流式
-    resp = await http_pool.api_client.post(KIRO_API_URL, json=kiro_request, headers=headers)
-    if resp.status_code != 200:
-        raise HTTPException(resp.status_code, resp.text)
-    
-    result = parse_event_stream_full(resp.content)
-    account.request_count += 1
-    account.last_used = time.time()
-    get_rate_limiter().record_request(account.id)
-    
+    try:
+        result, _ = await executor.fetch()
+    except UpstreamError as e:
+        if e.status_code == 400:
+            _print_400_debug(executor.kiro_request)
+        _observe(model, executor.account, e.status_code, start_time)
+        raise HTTPException(e.status_code, e.message)
+    
+    _observe(model, executor.account, 200, start_time)
     return _build_response(result, model, log_id)
 
 
+def _observe(model: str, account, status_code: int, start_time: float):
+    metrics.observe_request("responses", model, account.id if account else None, status_code, time.time() - start_time)
+
+
 def _build_response(result: dict, model: str, response_id: str) -> dict:
     """构建非流式响应"""
     text = "".join(result.get("content", []))
@@ -560,7 +550,7 @@ def _build_response(result: dict, model: str, response_id: str) -> dict:
     }
 
 
-async def _handle_stream(kiro_request, headers, account, model, log_id, start_time):
+async def _handle_stream(executor: UpstreamExecutor, model, log_id, start_time):
     """流式处理 - Codex 期望的 SSE 格式"""
     
     # 保存完整请求用于调试
@@ -569,7 +559,7 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
     os.makedirs(debug_dir, exist_ok=True)
     debug_file = f"{debug_dir}/{log_id}_request.json"
     with open(debug_file, 'w', encoding='utf-8') as f:
-        json.dump(kiro_request, f, indent=2, ensure_ascii=False)
+        json.dump(executor.kiro_request, f, indent=2, ensure_ascii=False)
     print(f"[Responses] Saved request to {debug_file}")
     
     async def generate():
@@ -578,138 +568,71 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
         created_at = int(time.time())
         full_content = ""
         tool_uses = []
-        error_occurred = False
         
         print(f"[Responses] Request: model={model}, log_id={log_id}")
         
         try:
-            async with http_pool.api_client.stream("POST", KIRO_API_URL, json=kiro_request, headers=headers) as response:
-                
-                if response.status_code != 200:
-                    error_text = await response.aread()
-                    error_msg = error_text.decode()[:500]
-                    print(f"[Responses] Kiro error: {response.status_code} - {error_msg[:200]}")
-                    
-                    # 打印更多调试信息
-                    if response.status_code == 400:
-                        cs = kiro_request.get("conversationState", {})
-                        hist = cs.get("history", [])
-                        print(f"[Responses] 400 Debug: history_len={len(hist)}")
-                        if hist:
-                            # 检查每条 history 的详细结构
-                            for i, h in enumerate(hist[:5]):  # 只打印前5条
-                                if "userInputMessage" in h:
-                                    uim = h["userInputMessage"]
-                                    has_ctx = "userInputMessageContext" in uim
-                                    has_tr = has_ctx and "toolResults" in uim.get("userInputMessageContext", {})
-                                    content_len = len(uim.get("content", ""))
-                                    uim_keys = list(uim.keys())
-                                    print(f"[Responses]   hist[{i}]: user, keys={uim_keys}, content_len={content_len}, has_toolResults={has_tr}")
-                                elif "assistantResponseMessage" in h:
-                                    arm = h["assistantResponseMessage"]
-                                    arm_keys = list(arm.keys())
-                                    has_tu = "toolUses" in arm
-                                    tu_count = len(arm.get("toolUses", []) or []) if has_tu else 0
-                                    content_len = len(arm.get("content", "") or "")
-                                    print(f"[Responses]   hist[{i}]: assistant, keys={arm_keys}, content_len={content_len}, has_toolUses={has_tu}, toolUses_count={tu_count}")
-                                else:
-                                    print(f"[Responses]   hist[{i}]: UNKNOWN keys={list(h.keys())}")
-                            if len(hist) > 5:
-                                print(f"[Responses]   ... ({len(hist) - 5} more)")
-                        
-                        # 打印 currentMessage 结构
-                        cm = cs.get("currentMessage", {})
-                        if "userInputMessage" in cm:
-                            uim = cm["userInputMessage"]
-                            print(f"[Responses] currentMessage: keys={list(uim.keys())}, content_len={len(uim.get('content', ''))}")
-                            if "userInputMessageContext" in uim:
-                                ctx = uim["userInputMessageContext"]
-                                print(f"[Responses]   context keys={list(ctx.keys())}")
-                                if "toolResults" in ctx:
-                                    print(f"[Responses]   toolResults count={len(ctx['toolResults'])}")
-                                if "tools" in ctx:
-                                    print(f"[Responses]   tools count={len(ctx['tools'])}")
-                    
-                    error_occurred = True
-                    
-                    # 映射错误代码
-                    error_code = "api_error"
-                    error_lower = error_msg.lower()
-                    if response.status_code == 429 or "rate limit" in error_lower or "throttl" in error_lower:
-                        error_code = "rate_limit_exceeded"
-                    elif "context" in error_lower or "too long" in error_lower or "content length" in error_lower:
-                        error_code = "context_length_exceeded"
-                    elif "quota" in error_lower or "insufficient" in error_lower:
-                        error_code = "insufficient_quota"
-                    elif response.status_code == 401 or response.status_code == 403:
-                        error_code = "authentication_error"
-                    
-                    yield _sse("response.failed", {
-                        "type": "response.failed",
-                        "response": {
-                            "id": response_id,
-                            "object": "response",
-                            "status": "failed",
-                            "error": {"code": error_code, "message": error_msg[:200]}
-                        }
+            upstream = await executor.open()
+        except UpstreamError as e:
+            print(f"[Responses] Kiro error: {e.status_code} - {e.message[:200]}")
+            if e.status_code == 400:
+                _print_400_debug(executor.kiro_request)
+            _observe(model, executor.account, e.status_code, start_time)
+            yield _sse("response.failed", {
+                "type": "response.failed",
+                "response": {
+                    "id": response_id,
+                    "object": "response",
+                    "status": "failed",
+                    "error": {"code": _map_error_code(e), "message": e.message[:200]}
+                }
+            })
+            return
+        
+        try:
+            # 1. response.created
+            yield _sse("response.created", {
+                "type": "response.created",
+                "response": {
+                    "id": response_id,
+                    "object": "response",
+                    "created_at": created_at,
+                    "status": "in_progress",
+                    "model": model,
+                    "output": []
+                }
+            })
+
+            # 2. response.output_item.added
+            yield _sse("response.output_item.added", {
+                "type": "response.output_item.added",
+                "output_index": 0,
+                "item": {
+                    "id": item_id,
+                    "type": "message",
+                    "status": "in_progress",
+                    "role": "assistant",
+                    "content": []
+                }
+            })
+
+            # 3. 流式读取并发送 delta
+            async for event in upstream.events():
+                if isinstance(event, TextDelta):
+                    yield _sse("response.output_text.delta", {
+                        "type": "response.output_text.delta",
+                        "item_id": item_id,
+                        "output_index": 0,
+                        "content_index": 0,
+                        "delta": event.text
                     })
-                    return
-                
-                # 1. response.created
-                yield _sse("response.created", {
-                    "type": "response.created",
-                    "response": {
-                        "id": response_id,
-                        "object": "response",
-                        "created_at": created_at,
-                        "status": "in_progress",
-                        "model": model,
-                        "output": []
-                    }
-                })
-                
-                # 2. response.output_item.added
-                yield _sse("response.output_item.added", {
-                    "type": "response.output_item.added",
-                    "output_index": 0,
-                    "item": {
-                        "id": item_id,
-                        "type": "message",
-                        "status": "in_progress",
-                        "role": "assistant",
-                        "content": []
-                    }
-                })
-                
-                # 3. 流式读取并发送 delta
-                full_response = b""
-                async for chunk in response.aiter_bytes():
-                    full_response += chunk
-                    
-                    # 尝试解析增量内容
-                    content = _extract_content_from_chunk(chunk)
-                    if content:
-                        full_content += content
-                        yield _sse("response.output_text.delta", {
-                            "type": "response.output_text.delta",
-                            "item_id": item_id,
-                            "output_index": 0,
-                            "content_index": 0,
-                            "delta": content
-                        })
-                
-                # 解析完整响应获取工具调用
-                result = parse_event_stream_full(full_response)
-                tool_uses = result.get("tool_uses", [])
-                if not full_content:
-                    full_content = "".join(result.get("content", []))
-                
-                account.request_count += 1
-                account.last_used = time.time()
-                get_rate_limiter().record_request(account.id)
-                    
+
+            # 流结束后直接从解码器取工具调用，无需重新解析
+            result = upstream.result()
+            tool_uses = result.get("tool_uses", [])
+            full_content = upstream.text
         except Exception as e:
-            error_occurred = True
+            _observe(model, upstream.account, 502, start_time)
             yield _sse("response.failed", {
                 "type": "response.failed",
                 "response": {
@@ -769,6 +692,7 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
             output_items.append(tool_item)
         
         # 6. response.completed - 必须发送!
+        _observe(model, upstream.account, 200, start_time)
         yield _sse("response.completed", {
             "type": "response.completed",
             "response": {
@@ -791,40 +715,62 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
     return StreamingResponse(generate(), media_type="text/event-stream")
 
 
+def _map_error_code(e: UpstreamError) -> str:
+    """映射为 Responses API 的错误代码"""
+    if e.error_type == "rate_limit_error":
+        error_lower = e.detail.lower()
+        if "quota" in error_lower or "insufficient" in error_lower:
+            return "insufficient_quota"
+        return "rate_limit_exceeded"
+    if e.error is not None and e.error.type == ErrorType.CONTENT_TOO_LONG:
+        return "context_length_exceeded"
+    if e.error_type == "authentication_error":
+        return "authentication_error"
+    return "api_error"
+
+
+def _print_400_debug(kiro_request: dict):
+    """400 错误时打印请求结构，便于排查格式问题"""
+    cs = kiro_request.get("conversationState", {})
+    hist = cs.get("history", [])
+    print(f"[Responses] 400 Debug: history_len={len(hist)}")
+    if hist:
+        # 检查每条 history 的详细结构
+        for i, h in enumerate(hist[:5]):  # 只打印前5条
+            if "userInputMessage" in h:
+                uim = h["userInputMessage"]
+                has_ctx = "userInputMessageContext" in uim
+                has_tr = has_ctx and "toolResults" in uim.get("userInputMessageContext", {})
+                content_len = len(uim.get("content", ""))
+                uim_keys = list(uim.keys())
+                print(f"[Responses]   hist[{i}]: user, keys={uim_keys}, content_len={content_len}, has_toolResults={has_tr}")
+            elif "assistantResponseMessage" in h:
+                arm = h["assistantResponseMessage"]
+                arm_keys = list(arm.keys())
+                has_tu = "toolUses" in arm
+                tu_count = len(arm.get("toolUses", []) or []) if has_tu else 0
+                content_len = len(arm.get("content", "") or "")
+                print(f"[Responses]   hist[{i}]: assistant, keys={arm_keys}, content_len={content_len}, has_toolUses={has_tu}, toolUses_count={tu_count}")
+            else:
+                print(f"[Responses]   hist[{i}]: UNKNOWN keys={list(h.keys())}")
+        if len(hist) > 5:
+            print(f"[Responses]   ... ({len(hist) - 5} more)")
+    
+    # 打印 currentMessage 结构
+    cm = cs.get("currentMessage", {})
+    if "userInputMessage" in cm:
+        uim = cm["userInputMessage"]
+        print(f"[Responses] currentMessage: keys={list(uim.keys())}, content_len={len(uim.get('content', ''))}")
+        if "userInputMessageContext" in uim:
+            ctx = uim["userInputMessageContext"]
+            print(f"[Responses]   context keys={list(ctx.keys())}")
+            if "toolResults" in ctx:
+                print(f"[Responses]   toolResults count={len(ctx['toolResults'])}")
+            if "tools" in ctx:
+                print(f"[Responses]   tools count={len(ctx['tools'])}")
+
+
 def _sse(event_type: str, data: dict) -> str:
     """生成 SSE 格式的事件"""
     return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
 
-
-def _extract_content_from_chunk(chunk: bytes) -> str:
-    """从 AWS event-stream chunk 中提取文本内容"""
-    content = ""
-    pos = 0
-    
-    while pos < len(chunk):
-        if pos + 12 > len(chunk):
-            break
-        
-        total_len = int.from_bytes(chunk[pos:pos+4], 'big')
-        if total_len == 0 or total_len > len(chunk) - pos:
-            break
-        
-        headers_len = int.from_bytes(chunk[pos+4:pos+8], 'big')
-        payload_start = pos + 12 + headers_len
-        payload_end = pos + total_len - 4
-        
-        if payload_start < payload_end:
-            try:
-                payload = json.loads(chunk[payload_start:payload_end].decode('utf-8'))
-                if 'assistantResponseEvent' in payload:
-                    c = payload['assistantResponseEvent'].get('content')
-                    if c:
-                        content += c
-                elif 'content' in payload and 'toolUseId' not in payload:
-                    content += payload['content']
-            except:
-                pass
-        
-        pos += total_len
-    
-    return content
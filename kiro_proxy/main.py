@@ -6,13 +6,17 @@ import sys
 from pathlib import Path
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from .config import MODELS_URL, get_all_kiro_models, get_custom_models, add_custom_model, remove_custom_model, _load_custom_models, BUILTIN_KIRO_MODELS
-from .core import state, scheduler, stats_manager
+from .core import state, scheduler, stats_manager, flow_monitor
 from .core.log_broadcaster import log_broadcaster
 from .core.http_pool import http_pool
+from .core import coordination, metrics
+from .core.token_manager import token_manager
+from .core.persistence import token_watcher, write_behind
+from . import prefork
 from .handlers import anthropic, openai, gemini, admin
 from .handlers import responses as responses_handler
 
@@ -37,20 +41,53 @@ def get_resource_path(relative_path: str) -> Path:
     return base_path / relative_path
 
 
+def _apply_settings(kind: str, config: dict):
+    """应用其他 worker 广播的运行时设置（prefork 模式）"""
+    appliers = {
+        "history": update_history_config,
+        "rate-limit": lambda data: get_rate_limiter().update_config(**data),
+        "session-affinity": lambda data: state.sessions.update_config(**data),
+        "hedge": lambda data: get_hedge_policy().update_config(**data),
+        "flow-capture": lambda data: flow_monitor.update_config(**data),
+    }
+    if kind in appliers:
+        appliers[kind](config)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     # 启动时
     log_broadcaster.install()  # 安装日志广播
+    metrics.loop_monitor.start()  # 测量事件循环延迟
     _load_custom_models()  # 加载自定义模型
-    await http_pool.warmup()  # 预热 HTTP 连接池
+    flow_monitor.configure()  # Flow 存储的条数 / 内存预算 / 采集策略
+    flow_monitor.start()  # 后台记录 Flow
+    coordination.configure()  # 选择协调存储（多 worker 共享账号池）
+    coordination.start()
+    for acc in state.accounts:
+        acc.get_headers()  # 预构建各账号的请求头模板
+    http_pool.start([acc.id for acc in state.accounts if acc.enabled and state.registry.owns(acc.id)])  # 后台预热连接池并保活
+    token_watcher.start(lambda: [acc.token_path for acc in state.accounts], state.reload_token_file)  # 热加载外部更新的凭证
+    token_manager.start(state.managed_accounts)  # 安排 Token 主动刷新，过期账号立即并发刷新
     await scheduler.start()
+    stats_manager.start()  # 后台定期快照统计
+    prefork.start_reporter()  # prefork 模式下向监督进程上报统计
+    prefork.start_config_watch(_apply_settings)  # prefork 模式下同步其他 worker 的账号 / 设置修改
     yield
     # 关闭时
-    from .core import stats_manager
-    stats_manager.force_save()  # 持久化统计
+    await stats_manager.stop()  # 写入最终统计快照
+    await prefork.stop_reporter()
+    await prefork.stop_config_watch()
     await scheduler.stop()
+    await token_manager.stop()
+    await coordination.stop()
+    await token_watcher.stop()
     await http_pool.close_all()  # 关闭连接池
+    await metrics.loop_monitor.stop()
+    await flow_monitor.stop()  # 写入队列中剩余的 Flow 事件
+    flow_monitor.store.close()  # 删除 Flow 磁盘段
+    write_behind.flush_sync()  # 写入尚未落盘的配置和凭证
 
 
 app = FastAPI(title="Kiro API Proxy", docs_url="/docs", redoc_url=None, lifespan=lifespan)
@@ -200,6 +237,12 @@ async def gemini_generate(model_name: str, request: Request):
     return await gemini.handle_generate_content(model_name, request)
 
 
+@app.post("/v1beta/models/{model_name}:streamGenerateContent")
+@app.post("/v1/models/{model_name}:streamGenerateContent")
+async def gemini_stream_generate(model_name: str, request: Request):
+    return await gemini.handle_stream_generate_content(model_name, request)
+
+
 # ==================== 管理 API ====================
 
 @app.get("/api/status")
@@ -216,6 +259,12 @@ async def api_stats():
     return await admin.get_stats()
 
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 抓取端点"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/api/logs")
 async def api_logs(limit: int = 100):
     return await admin.get_logs(limit)
@@ -353,9 +402,23 @@ async def api_detailed_stats():
 
 
 @app.post("/api/health-check")
-async def api_health_check():
-    """手动触发健康检查"""
-    return await admin.run_health_check()
+async def api_health_check(force: bool = False):
+    """手动触发健康检查（force=true 时忽略缓存）"""
+    return await admin.run_health_check(force)
+
+
+@app.get("/api/health-check/stream")
+async def api_health_check_stream(kind: str = "health"):
+    """手动全量健康检查 / Token 刷新（kind=refresh）的 SSE 进度流"""
+    return StreamingResponse(
+        admin.stream_probe(kind),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+        }
+    )
 
 
 @app.get("/api/browsers")
@@ -427,6 +490,10 @@ async def api_flows(
     has_error: bool = None,
     bookmarked: bool = None,
     search: str = None,
+    min_duration_ms: float = None,
+    max_duration_ms: float = None,
+    start_time: float = None,
+    end_time: float = None,
     limit: int = 50,
     offset: int = 0,
 ):
@@ -439,6 +506,10 @@ async def api_flows(
         has_error=has_error,
         bookmarked=bookmarked,
         search=search,
+        min_duration_ms=min_duration_ms,
+        max_duration_ms=max_duration_ms,
+        start_time=start_time,
+        end_time=end_time,
         limit=limit,
         offset=offset,
     )
@@ -550,6 +621,7 @@ async def api_remove_custom_model(model_id: str):
 
 from .core import get_history_config, update_history_config, TruncateStrategy
 from .core.rate_limiter import get_rate_limiter
+from .core.admission import get_admission
 
 @app.get("/api/settings/history")
 async def api_get_history_config():
@@ -563,6 +635,7 @@ async def api_update_history_config(request: Request):
     """更新历史消息管理配置"""
     data = await request.json()
     update_history_config(data)
+    prefork.publish_settings("history", get_history_config().to_dict())
     return {"ok": True, "config": get_history_config().to_dict()}
 
 
@@ -578,7 +651,11 @@ async def api_get_rate_limit_config():
         "max_requests_per_minute": limiter.config.max_requests_per_minute,
         "global_max_requests_per_minute": limiter.config.global_max_requests_per_minute,
         "quota_cooldown_seconds": limiter.config.quota_cooldown_seconds,
-        "stats": limiter.get_stats()
+        "max_queue_depth": limiter.config.max_queue_depth,
+        "global_max_queue_depth": limiter.config.global_max_queue_depth,
+        "max_queue_wait": limiter.config.max_queue_wait,
+        "stats": limiter.get_stats(),
+        "admission": get_admission().get_stats()
     }
 
 
@@ -588,13 +665,73 @@ async def api_update_rate_limit_config(request: Request):
     data = await request.json()
     limiter = get_rate_limiter()
     limiter.update_config(**data)
-    return {"ok": True, "config": {
+    config = {
         "enabled": limiter.config.enabled,
         "min_request_interval": limiter.config.min_request_interval,
         "max_requests_per_minute": limiter.config.max_requests_per_minute,
         "global_max_requests_per_minute": limiter.config.global_max_requests_per_minute,
         "quota_cooldown_seconds": limiter.config.quota_cooldown_seconds,
-    }}
+        "max_queue_depth": limiter.config.max_queue_depth,
+        "global_max_queue_depth": limiter.config.global_max_queue_depth,
+        "max_queue_wait": limiter.config.max_queue_wait,
+    }
+    prefork.publish_settings("rate-limit", config)
+    return {"ok": True, "config": config}
+
+
+# ==================== 会话粘性配置 API ====================
+
+@app.get("/api/settings/session-affinity")
+async def api_get_session_affinity_config():
+    """获取会话粘性配置"""
+    return {**state.sessions.get_config(), "stats": state.sessions.get_stats()}
+
+
+@app.post("/api/settings/session-affinity")
+async def api_update_session_affinity_config(request: Request):
+    """更新会话粘性配置"""
+    data = await request.json()
+    state.sessions.update_config(**data)
+    prefork.publish_settings("session-affinity", state.sessions.get_config())
+    return {"ok": True, "config": state.sessions.get_config()}
+
+
+# ==================== 对冲请求配置 API ====================
+
+from .core.hedging import get_hedge_policy
+
+@app.get("/api/settings/hedge")
+async def api_get_hedge_config():
+    """获取对冲请求配置"""
+    policy = get_hedge_policy()
+    return {**policy.get_config(), "stats": policy.get_stats()}
+
+
+@app.post("/api/settings/hedge")
+async def api_update_hedge_config(request: Request):
+    """更新对冲请求配置"""
+    data = await request.json()
+    policy = get_hedge_policy()
+    policy.update_config(**data)
+    prefork.publish_settings("hedge", policy.get_config())
+    return {"ok": True, "config": policy.get_config()}
+
+
+# ==================== Flow 采集配置 API ====================
+
+@app.get("/api/settings/flow-capture")
+async def api_get_flow_capture_config():
+    """获取 Flow 采集策略"""
+    return {**flow_monitor.get_config(), "stats": flow_monitor.get_stats()["capture"]}
+
+
+@app.post("/api/settings/flow-capture")
+async def api_update_flow_capture_config(request: Request):
+    """更新 Flow 采集策略"""
+    data = await request.json()
+    flow_monitor.update_config(**data)
+    prefork.publish_settings("flow-capture", flow_monitor.get_config())
+    return {"ok": True, "config": flow_monitor.get_config()}
 
 
 # ==================== 文档 API ====================
@@ -668,7 +805,7 @@ def run(port: int = 8080):
     print(f"  Kiro API Proxy v1.7.16")
     print(f"  http://localhost:{port}")
     print(f"{'='*50}\n")
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(app, host="0.0.0.0", port=port, **prefork.uvicorn_options())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,376 @@
+"""多 worker（prefork）服务模式
+
+kiro-proxy serve --workers N：
+- 每个 worker 是独立进程，用 SO_REUSEPORT 绑定同一端口，由内核分发连接
+- 账号按 id 排序后确定性地分区，每个 worker 只调度自己分区内的账号，
+  worker 之间不需要共享状态
+- 安装了 uvloop / httptools 时自动使用
+- 监督进程负责重启崩溃的 worker，并汇总各 worker 的 /api/stats
+- 持久化统计按 worker 分文件（stats-{index}.json），各 worker 只写自己的文件
+- 管理接口的修改只落在内核分到的那个 worker 上，其余 worker 靠轮询同步：
+  账号增删 / 启停写入 config.json，运行时设置写入 cluster_settings.json，
+  每个 worker 监视这两个文件的 mtime 并重建账号表 / 应用设置
+- 会话粘性表在每个 worker 内独立维护（同一会话可能被分到不同 worker），
+  需要跨 worker 的粘性时请配置共享协调存储（KIRO_PROXY_COORDINATION）
+"""
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+WORKER_ENV = "KIRO_PROXY_WORKER"   # "index/count"
+CLUSTER_STATS_FILE = "cluster_stats.json"
+CLUSTER_SETTINGS_FILE = "cluster_settings.json"
+
+REPORT_INTERVAL = 2.0      # worker 上报统计的间隔（秒）
+RESTART_BACKOFF_MAX = 30.0  # 连续崩溃时的最大重启间隔（秒）
+STABLE_SECONDS = 10.0      # 存活超过该时长后重置退避
+
+_report_queue = None
+_report_task = None
+_config_watcher = None
+
+
+# ==================== 公共 ====================
+
+def uvicorn_options() -> dict:
+    """安装了 uvloop / httptools 时使用，否则退回标准实现"""
+    options = {"loop": "asyncio", "http": "h11"}
+    try:
+        import uvloop  # noqa: F401
+        options["loop"] = "uvloop"
+    except ImportError:
+        pass
+    try:
+        import httptools  # noqa: F401
+        options["http"] = "httptools"
+    except ImportError:
+        pass
+    return options
+
+
+def worker_info() -> Optional[Tuple[int, int]]:
+    """当前进程的 (index, count)，非 worker 进程返回 None"""
+    value = os.environ.get(WORKER_ENV)
+    if not value:
+        return None
+    index, count = value.split("/", 1)
+    return int(index), int(count)
+
+
+def _cluster_stats_path() -> Path:
+    from .core.persistence import CONFIG_DIR
+    return CONFIG_DIR / CLUSTER_STATS_FILE
+
+
+def _cluster_settings_path() -> Path:
+    from .core.persistence import CONFIG_DIR
+    return CONFIG_DIR / CLUSTER_SETTINGS_FILE
+
+
+def get_cluster_stats() -> Optional[dict]:
+    """读取监督进程汇总的各 worker 统计（非 prefork 模式返回 None）"""
+    if worker_info() is None:
+        return None
+    try:
+        return json.loads(_cluster_stats_path().read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+# ==================== worker ====================
+
+def _snapshot() -> dict:
+    from .core import state
+    stats = state.get_stats()
+    stats["partition"] = state.registry.get_partition()
+    return stats
+
+
+async def _report_loop(index: int):
+    import asyncio
+    while True:
+        try:
+            _report_queue.put_nowait((index, os.getpid(), time.time(), _snapshot()))
+        except Exception as e:
+            print(f"[Prefork] worker {index} 上报统计失败: {e}")
+        await asyncio.sleep(REPORT_INTERVAL)
+
+
+def start_reporter():
+    """worker 进程中启动统计上报（在应用 lifespan 中调用）"""
+    global _report_task
+    info = worker_info()
+    if info is None or _report_queue is None:
+        return
+    import asyncio
+    _report_task = asyncio.create_task(_report_loop(info[0]))
+
+
+async def stop_reporter():
+    global _report_task
+    if _report_task is not None:
+        _report_task.cancel()
+        _report_task = None
+
+
+def publish_settings(kind: str, config: dict):
+    """把某类运行时设置的完整配置广播给其他 worker（非 prefork 模式不做任何事）"""
+    if worker_info() is None:
+        return
+    from .core.persistence import write_behind
+    write_behind.merge(_cluster_settings_path(), {kind: config})
+
+
+def _read_settings() -> dict:
+    try:
+        return json.loads(_cluster_settings_path().read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def _apply_settings(apply: Callable[[str, dict], None], settings: dict):
+    for kind, config in settings.items():
+        try:
+            apply(kind, config)
+        except Exception as e:
+            print(f"[Prefork] 应用设置 {kind} 失败: {e}")
+
+
+async def _reload_accounts():
+    from .core import state
+    from .core.admission import get_admission
+    from .core.http_pool import http_pool
+    from .core.token_manager import token_manager
+    from .credential import quota_manager
+    removed, added = state.reload_accounts()
+    for account_id in removed:
+        get_admission().drop_account(account_id)
+        quota_manager.restore(account_id)
+        token_manager.unschedule(account_id)
+        await http_pool.drop_account_client(account_id)
+    for account in added:
+        if state.registry.manages(account.id):
+            token_manager.schedule(account)
+    if removed or added:
+        print(f"[Prefork] 账号列表已同步: 新增 {len(added)} 个, 移除 {len(removed)} 个")
+
+
+def start_config_watch(apply: Callable[[str, dict], None]):
+    """worker 进程中监视 config.json 与集群设置文件（在应用 lifespan 中调用）
+
+    apply(kind, config) 把一类运行时设置应用到本进程。
+    """
+    global _config_watcher
+    if worker_info() is None:
+        return
+    from .core.persistence import CONFIG_FILE, MtimeWatcher
+    from .config import _load_custom_models
+    config_path, settings_path = str(CONFIG_FILE), str(_cluster_settings_path())
+
+    async def on_change(path: str):
+        if path == config_path:
+            await _reload_accounts()
+            _load_custom_models()
+        elif path == settings_path:
+            _apply_settings(apply, _read_settings())
+
+    _apply_settings(apply, _read_settings())  # 重启的 worker 追上已广播的设置
+    _config_watcher = MtimeWatcher()
+    _config_watcher.start(lambda: [config_path, settings_path], on_change)
+
+
+async def stop_config_watch():
+    global _config_watcher
+    if _config_watcher is not None:
+        await _config_watcher.stop()
+        _config_watcher = None
+
+
+def _bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _worker_main(index: int, count: int, host: str, port: int, queue):
+    global _report_queue
+    os.environ[WORKER_ENV] = f"{index}/{count}"
+    _report_queue = queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # 由监督进程统一处理 Ctrl+C
+
+    import uvicorn
+    from .main import app
+    from .core import state
+
+    state.current_port = port
+    state.registry.set_partition(index, count)
+    owned = state.registry.get_partition()["accounts"]
+    print(f"[Prefork] worker {index} (pid {os.getpid()}) 负责账号: {', '.join(owned) or '无'}")
+
+    config = uvicorn.Config(app, host=host, port=port, **uvicorn_options())
+    server = uvicorn.Server(config)
+    server.run(sockets=[_bind_socket(host, port)])
+
+
+# ==================== 监督进程 ====================
+
+class Supervisor:
+    """启动并看护 worker 进程，汇总统计"""
+
+    def __init__(self, workers: int, host: str, port: int):
+        self.count = workers
+        self.host = host
+        self.port = port
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queue = self._ctx.Queue()
+        self._procs: Dict[int, multiprocessing.Process] = {}
+        self._started_at: Dict[int, float] = {}
+        self._restart_at: Dict[int, float] = {}
+        self._backoff: Dict[int, float] = {}
+        self._restarts: Dict[int, int] = {}
+        self._reports: Dict[int, tuple] = {}
+        self._stopping = False
+
+    def _spawn(self, index: int):
+        proc = self._ctx.Process(
+            target=_worker_main,
+            args=(index, self.count, self.host, self.port, self._queue),
+            name=f"kiro-worker-{index}",
+            daemon=True,
+        )
+        proc.start()
+        self._procs[index] = proc
+        self._started_at[index] = time.time()
+
+    def _check_workers(self):
+        now = time.time()
+        for index, proc in list(self._procs.items()):
+            if proc.is_alive():
+                if now - self._started_at[index] >= STABLE_SECONDS:
+                    self._backoff[index] = 0.0
+                continue
+            if index not in self._restart_at:
+                backoff = self._backoff.get(index, 0.0)
+                backoff = min(RESTART_BACKOFF_MAX, backoff * 2 if backoff else 1.0)
+                self._backoff[index] = backoff
+                self._restart_at[index] = now + backoff
+                self._reports.pop(index, None)
+                print(f"[Prefork] worker {index} (pid {proc.pid}) 退出，代码 {proc.exitcode}，{backoff:.0f} 秒后重启")
+            elif now >= self._restart_at[index]:
+                del self._restart_at[index]
+                self._restarts[index] = self._restarts.get(index, 0) + 1
+                self._spawn(index)
+
+    def _drain_reports(self):
+        while True:
+            try:
+                index, pid, at, stats = self._queue.get_nowait()
+            except Exception:
+                return
+            proc = self._procs.get(index)
+            if proc is not None and proc.pid == pid:
+                self._reports[index] = (pid, at, stats)
+
+    def aggregate(self) -> dict:
+        """汇总各 worker 的统计"""
+        workers = []
+        total_requests = total_errors = available = cooldown = 0
+        accounts_total = 0
+        for index in range(self.count):
+            proc = self._procs.get(index)
+            report = self._reports.get(index)
+            stats = report[2] if report else None
+            if stats:
+                total_requests += stats.get("total_requests", 0)
+                total_errors += stats.get("total_errors", 0)
+                available += stats.get("accounts_available", 0)
+                cooldown += stats.get("accounts_cooldown", 0)
+                accounts_total = max(accounts_total, stats.get("accounts_total", 0))
+            workers.append({
+                "index": index,
+                "pid": proc.pid if proc else None,
+                "alive": bool(proc and proc.is_alive()),
+                "restarts": self._restarts.get(index, 0),
+                "reported_at": report[1] if report else None,
+                "stats": stats,
+            })
+        return {
+            "workers": self.count,
+            "total_requests": total_requests,
+            "total_errors": total_errors,
+            "error_rate": f"{(total_errors / max(1, total_requests) * 100):.1f}%",
+            "accounts_total": accounts_total,
+            "accounts_available": available,
+            "accounts_cooldown": cooldown,
+            "per_worker": workers,
+            "updated_at": time.time(),
+        }
+
+    def _write_stats(self):
+        from .core.persistence import atomic_write_json
+        atomic_write_json(_cluster_stats_path(), self.aggregate(), indent=None)
+
+    def _handle_signal(self, signum, frame):
+        self._stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        self._clear_files()  # 上次运行遗留的设置不再生效
+        for index in range(self.count):
+            self._spawn(index)
+        try:
+            while not self._stopping:
+                self._drain_reports()
+                self._check_workers()
+                try:
+                    self._write_stats()
+                except OSError as e:
+                    print(f"[Prefork] 写入汇总统计失败: {e}")
+                time.sleep(1.0)
+        finally:
+            self.stop()
+
+    def stop(self):
+        print("[Prefork] 正在停止 worker...")
+        for proc in self._procs.values():
+            if proc.is_alive():
+                proc.terminate()  # SIGTERM：uvicorn 优雅关闭
+        deadline = time.time() + 15
+        for proc in self._procs.values():
+            proc.join(timeout=max(0.0, deadline - time.time()))
+            if proc.is_alive():
+                proc.kill()
+        self._clear_files()
+
+    @staticmethod
+    def _clear_files():
+        for path in (_cluster_stats_path(), _cluster_settings_path()):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def serve(port: int = 8080, workers: int = 2, host: str = "0.0.0.0"):
+    """以 prefork 模式启动服务"""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("[Prefork] 当前平台不支持 SO_REUSEPORT，退回单进程模式")
+        from .main import run
+        run(port=port)
+        return
+
+    print(f"\n{'='*50}")
+    print(f"  Kiro API Proxy (prefork x{workers})")
+    print(f"  http://localhost:{port}")
+    print(f"{'='*50}\n")
+    Supervisor(workers, host, port).run()
@@ -1,5 +1,5 @@
 """Provider 模块"""
 from .base import BaseProvider
-from .kiro import KiroProvider
+from .kiro import KiroProvider, EventStreamDecoder, TextDelta, ToolUseDelta, MetadataEvent
 
-__all__ = ["BaseProvider", "KiroProvider"]
+__all__ = ["BaseProvider", "KiroProvider", "EventStreamDecoder", "TextDelta", "ToolUseDelta", "MetadataEvent"]
@@ -2,7 +2,8 @@
 import json
 import uuid
 import binascii
-from typing import Dict, Any, List, Optional, Tuple
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Tuple, Union
 
 from .base import BaseProvider
 from ..credential import (
@@ -11,6 +12,274 @@ from ..credential import (
 )
 
 
+# ==================== AWS event-stream 解码 ====================
+
+@dataclass
+class TextDelta:
+    """文本增量（assistantResponseEvent）"""
+    text: str
+
+
+@dataclass
+class ToolUseDelta:
+    """工具调用片段（toolUseEvent）
+
+    同一个 tool_use_id 会分多帧到达：首帧带 name，后续帧的 input 是 JSON 字符串片段，
+    最后一帧 stop=True。
+    """
+    tool_use_id: str
+    name: str = ""
+    input: str = ""
+    stop: bool = False
+
+
+@dataclass
+class MetadataEvent:
+    """其他事件（计量、上下文用量、异常等）"""
+    event_type: str
+    payload: Dict[str, Any] = field(default_factory=dict)
+    message_type: str = "event"  # event / exception / error
+
+
+KiroEvent = Union[TextDelta, ToolUseDelta, MetadataEvent]
+
+
+def _decode_event_headers(data: memoryview) -> Dict[str, Any]:
+    """解码 event-stream 头部
+
+    格式: name_len(1) name value_type(1) value，value 编码由 value_type 决定。
+    """
+    headers = {}
+    pos = 0
+    end = len(data)
+    while pos < end:
+        name_len = data[pos]
+        pos += 1
+        name = bytes(data[pos:pos + name_len]).decode("utf-8", errors="replace")
+        pos += name_len
+        value_type = data[pos]
+        pos += 1
+
+        if value_type == 0:      # bool true
+            value = True
+        elif value_type == 1:    # bool false
+            value = False
+        elif value_type in (2, 3, 4, 5):  # byte / short / int / long
+            size = {2: 1, 3: 2, 4: 4, 5: 8}[value_type]
+            value = int.from_bytes(data[pos:pos + size], "big", signed=True)
+            pos += size
+        elif value_type in (6, 7):  # bytes / string
+            size = int.from_bytes(data[pos:pos + 2], "big")
+            pos += 2
+            value = bytes(data[pos:pos + size])
+            if value_type == 7:
+                value = value.decode("utf-8", errors="replace")
+            pos += size
+        elif value_type == 8:    # timestamp (ms)
+            value = int.from_bytes(data[pos:pos + 8], "big", signed=True)
+            pos += 8
+        elif value_type == 9:    # uuid
+            value = bytes(data[pos:pos + 16]).hex()
+            pos += 16
+        else:
+            break  # 未知类型，无法继续定位后续头部
+
+        headers[name] = value
+    return headers
+
+
+class EventStreamDecoder:
+    """增量 AWS event-stream 解码器
+
+    - 跨 chunk 缓冲：帧被网络分片切开时保留尾部，等下一个 chunk 拼接后再解析
+    - 每帧只解析一次（memoryview 切片，不拷贝整段响应）
+    - 按 :event-type 头部区分事件类型，产出 TextDelta / ToolUseDelta / MetadataEvent
+    - 同时累积文本和工具调用，流结束后 result() 直接给出与 parse_response 相同的结构
+
+    用法:
+        decoder = EventStreamDecoder()
+        async for chunk in response.aiter_bytes():
+            for event in decoder.feed(chunk):
+                ...
+        result = decoder.result()
+    """
+
+    PRELUDE_LEN = 12
+    MIN_FRAME_LEN = 16            # prelude + message CRC
+    MAX_FRAME_LEN = 16 * 1024 * 1024
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._content_parts: List[str] = []
+        self._tools: Dict[str, Dict[str, Any]] = {}
+        self.metadata: Dict[str, Dict[str, Any]] = {}
+        self.frame_count = 0
+        self.dropped_frames = 0
+
+    def feed(self, chunk: bytes) -> List[KiroEvent]:
+        """喂入一段字节，返回本次解析出的完整事件"""
+        if not chunk:
+            return []
+        self._buffer += chunk
+
+        events: List[KiroEvent] = []
+        pos = 0
+        with memoryview(self._buffer) as view:
+            size = len(view)
+            while size - pos >= self.PRELUDE_LEN:
+                total_len = int.from_bytes(view[pos:pos + 4], "big")
+                if total_len < self.MIN_FRAME_LEN or total_len > self.MAX_FRAME_LEN:
+                    # 长度字段损坏，无法再定位帧边界，丢弃剩余数据
+                    print(f"[EventStream] 帧长度异常 ({total_len})，丢弃 {size - pos} 字节")
+                    self.dropped_frames += 1
+                    pos = size
+                    break
+                if size - pos < total_len:
+                    break  # 帧不完整，等待下一个 chunk
+
+                frame = view[pos:pos + total_len]
+                pos += total_len
+                event = self._decode_frame(frame)
+                frame.release()
+                if event is not None:
+                    events.append(event)
+
+        if pos:
+            del self._buffer[:pos]
+        return events
+
+    @property
+    def pending_bytes(self) -> int:
+        """缓冲区中尚未组成完整帧的字节数"""
+        return len(self._buffer)
+
+    def discard_partial(self) -> int:
+        """丢弃缓冲区中不完整的帧（连接中断后换新响应续读时使用）"""
+        dropped = len(self._buffer)
+        self._buffer.clear()
+        return dropped
+
+    @property
+    def has_tool_uses(self) -> bool:
+        """是否已收到工具调用事件"""
+        return bool(self._tools)
+
+    def _decode_frame(self, frame: memoryview) -> Optional[KiroEvent]:
+        """解码单帧，CRC 校验失败或无负载时返回 None"""
+        total_len = len(frame)
+        headers_len = int.from_bytes(frame[4:8], "big")
+
+        # CRC32 校验 - 借鉴 kiro.rs 的实现
+        # Prelude CRC: 前 8 字节的 CRC32
+        prelude_crc = int.from_bytes(frame[8:12], "big")
+        if prelude_crc != binascii.crc32(frame[:8]) & 0xFFFFFFFF:
+            self.dropped_frames += 1
+            return None
+        # Message CRC: 整个消息（不含最后 4 字节）的 CRC32
+        msg_crc = int.from_bytes(frame[total_len - 4:], "big")
+        if msg_crc != binascii.crc32(frame[:total_len - 4]) & 0xFFFFFFFF:
+            self.dropped_frames += 1
+            return None
+
+        self.frame_count += 1
+
+        header_end = self.PRELUDE_LEN + headers_len
+        try:
+            headers = _decode_event_headers(frame[self.PRELUDE_LEN:header_end])
+        except (IndexError, ValueError):
+            headers = {}
+
+        message_type = headers.get(":message-type", "event")
+        event_type = headers.get(":event-type") or headers.get(":exception-type")
+
+        payload_bytes = frame[header_end:total_len - 4]
+        if not len(payload_bytes):
+            return None
+        try:
+            payload = json.loads(payload_bytes.tobytes())
+        except (ValueError, UnicodeDecodeError):
+            return None
+        if not isinstance(payload, dict):
+            return None
+
+        return self._to_event(event_type, message_type, payload)
+
+    def _to_event(self, event_type: Optional[str], message_type: str, payload: Dict[str, Any]) -> Optional[KiroEvent]:
+        """按事件类型生成事件，并累积文本/工具调用"""
+        if message_type != "event":
+            event = MetadataEvent(event_type or message_type, payload, message_type)
+            self.metadata[event.event_type] = payload
+            return event
+
+        if event_type == "toolUseEvent" or "toolUseId" in payload:
+            tool_id = payload.get("toolUseId", "")
+            if not tool_id:
+                return None
+            delta = ToolUseDelta(
+                tool_use_id=tool_id,
+                name=payload.get("name", "") or "",
+                input=payload.get("input", "") or "",
+                stop=bool(payload.get("stop", False)),
+            )
+            tool = self._tools.get(tool_id)
+            if tool is None:
+                tool = self._tools[tool_id] = {"id": tool_id, "name": delta.name, "input_parts": []}
+            elif delta.name and not tool["name"]:
+                tool["name"] = delta.name
+            if delta.input:
+                tool["input_parts"].append(delta.input)
+            return delta
+
+        if "assistantResponseEvent" in payload:
+            text = payload["assistantResponseEvent"].get("content")
+        elif event_type in (None, "assistantResponseEvent"):
+            text = payload.get("content")
+        else:
+            text = None
+
+        if text is None:
+            event = MetadataEvent(event_type or "unknown", payload)
+            self.metadata[event.event_type] = payload
+            return event
+        if not isinstance(text, str) or not text:
+            return None
+
+        self._content_parts.append(text)
+        return TextDelta(text)
+
+    @property
+    def text(self) -> str:
+        """已解码的全部文本"""
+        return "".join(self._content_parts)
+
+    def get_tool_use(self, tool_use_id: str) -> Optional[Dict[str, Any]]:
+        """组装单个工具调用（input 解析为 JSON）"""
+        tool_data = self._tools.get(tool_use_id)
+        if tool_data is None:
+            return None
+        input_str = "".join(tool_data["input_parts"])
+        try:
+            input_json = json.loads(input_str) if input_str else {}
+        except ValueError:
+            input_json = {"raw": input_str}
+        return {
+            "type": "tool_use",
+            "id": tool_data["id"],
+            "name": tool_data["name"],
+            "input": input_json
+        }
+
+    def result(self) -> Dict[str, Any]:
+        """汇总为 {content, tool_uses, stop_reason} 结构"""
+        tool_uses = [self.get_tool_use(tool_id) for tool_id in self._tools]
+
+        return {
+            "content": list(self._content_parts),
+            "tool_uses": tool_uses,
+            "stop_reason": "tool_use" if tool_uses else "end_turn",
+        }
+
+
 class KiroProvider(BaseProvider):
     """Kiro/CodeWhisperer Provider"""
     
@@ -44,14 +313,12 @@ class KiroProvider(BaseProvider):
         
         return self._machine_id
     
-    def build_headers(
-        self, 
-        token: str, 
-        agent_mode: str = "vibe",
-        **kwargs
-    ) -> Dict[str, str]:
-        """构建 Kiro API 请求头"""
-        machine_id = kwargs.get("machine_id") or self.get_machine_id()
+    def build_header_template(self, machine_id: Optional[str] = None, agent_mode: str = "vibe") -> Dict[str, str]:
+        """构建请求头中不随请求变化的部分（不含 invocation id 和 token）
+
+        结果只取决于 machine_id 和 agent_mode，调用方可以缓存后复用。
+        """
+        machine_id = machine_id or self.get_machine_id()
         kiro_version = get_kiro_version()
         os_name, node_version = get_system_info()
         
@@ -61,12 +328,26 @@ class KiroProvider(BaseProvider):
             "x-amzn-kiro-agent-mode": agent_mode,
             "x-amz-user-agent": f"aws-sdk-js/1.0.0 KiroIDE-{kiro_version}-{machine_id}",
             "user-agent": f"aws-sdk-js/1.0.0 ua/2.1 os/{os_name} lang/js md/nodejs#{node_version} api/codewhispererruntime#1.0.0 m/E KiroIDE-{kiro_version}-{machine_id}",
-            "amz-sdk-invocation-id": str(uuid.uuid4()),
             "amz-sdk-request": "attempt=1; max=1",
-            "Authorization": f"Bearer {token}",
-            "Connection": "close",
         }
     
+    def build_headers(
+        self, 
+        token: str, 
+        agent_mode: str = "vibe",
+        **kwargs
+    ) -> Dict[str, str]:
+        """构建 Kiro API 请求头
+
+        可通过 template 传入 build_header_template() 的缓存结果，
+        此时每次只生成 invocation id 和 Authorization。
+        """
+        template = kwargs.get("template") or self.build_header_template(kwargs.get("machine_id"), agent_mode)
+        headers = dict(template)
+        headers["amz-sdk-invocation-id"] = str(uuid.uuid4())
+        headers["Authorization"] = f"Bearer {token}"
+        return headers
+    
     def build_request(
         self,
         messages: list = None,
@@ -117,108 +398,9 @@ class KiroProvider(BaseProvider):
     
     def parse_response(self, raw: bytes) -> Dict[str, Any]:
         """解析 AWS event-stream 格式响应"""
-        result = {
-            "content": [],
-            "tool_uses": [],
-            "stop_reason": "end_turn"
-        }
-        
-        tool_input_buffer = {}
-        pos = 0
-        
-        while pos < len(raw):
-            if pos + 12 > len(raw):
-                break
-            
-            total_len = int.from_bytes(raw[pos:pos+4], 'big')
-            headers_len = int.from_bytes(raw[pos+4:pos+8], 'big')
-            
-            if total_len == 0 or total_len > len(raw) - pos:
-                break
-            
-            # CRC32 校验 - 借鉴 kiro.rs 的实现
-            # Prelude CRC: 前 8 字节的 CRC32
-            prelude_crc = int.from_bytes(raw[pos+8:pos+12], 'big')
-            expected_prelude_crc = binascii.crc32(raw[pos:pos+8]) & 0xFFFFFFFF
-            if prelude_crc != expected_prelude_crc:
-                pos += total_len  # CRC 不匹配，跳过此消息
-                continue
-            
-            # Message CRC: 整个消息（不含最后 4 字节）的 CRC32
-            msg_crc = int.from_bytes(raw[pos+total_len-4:pos+total_len], 'big')
-            expected_msg_crc = binascii.crc32(raw[pos:pos+total_len-4]) & 0xFFFFFFFF
-            if msg_crc != expected_msg_crc:
-                pos += total_len  # CRC 不匹配，跳过此消息
-                continue
-            
-            header_start = pos + 12
-            header_end = header_start + headers_len
-            headers_data = raw[header_start:header_end]
-            event_type = None
-            
-            try:
-                headers_str = headers_data.decode('utf-8', errors='ignore')
-                if 'toolUseEvent' in headers_str:
-                    event_type = 'toolUseEvent'
-                elif 'assistantResponseEvent' in headers_str:
-                    event_type = 'assistantResponseEvent'
-            except Exception:
-                pass
-            
-            payload_start = pos + 12 + headers_len
-            payload_end = pos + total_len - 4
-            
-            if payload_start < payload_end:
-                try:
-                    payload = json.loads(raw[payload_start:payload_end].decode('utf-8'))
-                    
-                    if 'assistantResponseEvent' in payload:
-                        e = payload['assistantResponseEvent']
-                        if 'content' in e:
-                            result["content"].append(e['content'])
-                    elif 'content' in payload and event_type != 'toolUseEvent':
-                        result["content"].append(payload['content'])
-                    
-                    if event_type == 'toolUseEvent' or 'toolUseId' in payload:
-                        tool_id = payload.get('toolUseId', '')
-                        tool_name = payload.get('name', '')
-                        tool_input = payload.get('input', '')
-                        
-                        if tool_id:
-                            if tool_id not in tool_input_buffer:
-                                tool_input_buffer[tool_id] = {
-                                    "id": tool_id,
-                                    "name": tool_name,
-                                    "input_parts": []
-                                }
-                            if tool_name and not tool_input_buffer[tool_id]["name"]:
-                                tool_input_buffer[tool_id]["name"] = tool_name
-                            if tool_input:
-                                tool_input_buffer[tool_id]["input_parts"].append(tool_input)
-                except Exception:
-                    pass
-            
-            pos += total_len
-        
-        # 组装工具调用
-        for tool_id, tool_data in tool_input_buffer.items():
-            input_str = "".join(tool_data["input_parts"])
-            try:
-                input_json = json.loads(input_str)
-            except:
-                input_json = {"raw": input_str}
-            
-            result["tool_uses"].append({
-                "type": "tool_use",
-                "id": tool_data["id"],
-                "name": tool_data["name"],
-                "input": input_json
-            })
-        
-        if result["tool_uses"]:
-            result["stop_reason"] = "tool_use"
-        
-        return result
+        decoder = EventStreamDecoder()
+        decoder.feed(raw)
+        return decoder.result()
     
     def parse_response_text(self, raw: bytes) -> str:
         """解析响应，只返回文本内容"""
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 """Kiro API Proxy 启动脚本"""
+import multiprocessing
 import sys
 
 # ============================================================
@@ -11,6 +12,7 @@ import kiro_proxy
 import kiro_proxy.main
 import kiro_proxy.launcher
 import kiro_proxy.cli
+import kiro_proxy.prefork
 import kiro_proxy.config
 import kiro_proxy.converters
 import kiro_proxy.web
@@ -45,6 +47,9 @@ import kiro_proxy.auth.device_flow
 # ============================================================
 
 if __name__ == "__main__":
+    # prefork 模式下 worker 以 spawn 方式启动，打包后的可执行文件需要此调用
+    multiprocessing.freeze_support()
+    
     # CLI 子命令模式
     if len(sys.argv) > 1 and sys.argv[1] in ("accounts", "login", "status", "serve"):
         from kiro_proxy.cli import main
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""EventStreamDecoder 离线测试（不需要启动服务）"""
+
+import binascii
+import json
+
+from kiro_proxy.providers.kiro import EventStreamDecoder, MetadataEvent, TextDelta, ToolUseDelta
+
+
+def _header(name: str, value: str) -> bytes:
+    name_bytes, value_bytes = name.encode(), value.encode()
+    return bytes([len(name_bytes)]) + name_bytes + bytes([7]) + len(value_bytes).to_bytes(2, "big") + value_bytes
+
+
+def _frame(event_type: str, payload: dict, message_type: str = "event") -> bytes:
+    """按 AWS event-stream 格式编码一帧"""
+    headers = (
+        _header(":event-type", event_type)
+        + _header(":content-type", "application/json")
+        + _header(":message-type", message_type)
+    )
+    body = json.dumps(payload).encode()
+    total_len = 12 + len(headers) + len(body) + 4
+    prelude = total_len.to_bytes(4, "big") + len(headers).to_bytes(4, "big")
+    prelude += (binascii.crc32(prelude) & 0xFFFFFFFF).to_bytes(4, "big")
+    message = prelude + headers + body
+    return message + (binascii.crc32(message) & 0xFFFFFFFF).to_bytes(4, "big")
+
+
+FRAMES = [
+    _frame("assistantResponseEvent", {"content": "Hel"}),
+    _frame("assistantResponseEvent", {"content": "lo"}),
+    _frame("toolUseEvent", {"toolUseId": "t1", "name": "Write", "input": ""}),
+    _frame("toolUseEvent", {"toolUseId": "t1", "input": '{"path": "a.txt", '}),
+    _frame("toolUseEvent", {"toolUseId": "t1", "input": '"content": "hi"}'}),
+    _frame("toolUseEvent", {"toolUseId": "t1", "input": "", "stop": True}),
+    _frame("meteringEvent", {"usage": 1}),
+]
+STREAM = b"".join(FRAMES)
+
+
+def _feed_all(decoder: EventStreamDecoder, chunks) -> list:
+    events = []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    return events
+
+
+def test_whole_stream():
+    decoder = EventStreamDecoder()
+    events = decoder.feed(STREAM)
+    assert [type(e) for e in events] == [TextDelta, TextDelta, ToolUseDelta, ToolUseDelta, ToolUseDelta, ToolUseDelta, MetadataEvent]
+    assert decoder.text == "Hello"
+    assert decoder.frame_count == len(FRAMES)
+    assert decoder.pending_bytes == 0
+
+
+def test_byte_by_byte():
+    whole = EventStreamDecoder()
+    expected = whole.feed(STREAM)
+
+    decoder = EventStreamDecoder()
+    events = _feed_all(decoder, (STREAM[i:i + 1] for i in range(len(STREAM))))
+    assert events == expected
+    assert decoder.result() == whole.result()
+    assert decoder.dropped_frames == 0
+    assert decoder.pending_bytes == 0
+
+
+def test_split_across_crc_boundaries():
+    frame = FRAMES[0]
+    # prelude CRC 中间、prelude 之后、message CRC 之前 / 中间 / 最后一个字节
+    for cut in (4, 8, 10, 12, len(frame) - 4, len(frame) - 2, len(frame) - 1):
+        decoder = EventStreamDecoder()
+        assert decoder.feed(frame[:cut]) == []
+        assert decoder.pending_bytes == cut
+        events = decoder.feed(frame[cut:] + FRAMES[1])
+        assert events == [TextDelta("Hel"), TextDelta("lo")], cut
+        assert decoder.dropped_frames == 0
+
+
+def test_partial_tool_use_fragments():
+    decoder = EventStreamDecoder()
+    tool_frames = b"".join(FRAMES[2:6])
+    # 每个分片都切在帧中间，工具参数的 JSON 片段跨多帧到达
+    events = _feed_all(decoder, (tool_frames[i:i + 7] for i in range(0, len(tool_frames), 7)))
+
+    assert all(isinstance(e, ToolUseDelta) and e.tool_use_id == "t1" for e in events)
+    assert events[0].name == "Write"
+    assert events[-1].stop
+    assert "".join(e.input for e in events) == '{"path": "a.txt", "content": "hi"}'
+    assert decoder.has_tool_uses
+    result = decoder.result()
+    assert result["stop_reason"] == "tool_use"
+    assert result["tool_uses"] == [{
+        "type": "tool_use",
+        "id": "t1",
+        "name": "Write",
+        "input": {"path": "a.txt", "content": "hi"},
+    }]
+
+
+def test_incomplete_tool_input_kept_raw():
+    decoder = EventStreamDecoder()
+    decoder.feed(FRAMES[2] + FRAMES[3])
+    assert decoder.get_tool_use("t1")["input"] == {"raw": '{"path": "a.txt", '}
+
+
+def test_bad_crc_frame_dropped():
+    corrupted = bytearray(FRAMES[0])
+    corrupted[-6] ^= 0xFF  # 改动负载，message CRC 不再匹配
+    decoder = EventStreamDecoder()
+    events = decoder.feed(bytes(corrupted) + FRAMES[1])
+    assert events == [TextDelta("lo")]
+    assert decoder.dropped_frames == 1
+
+
+def test_discard_partial():
+    decoder = EventStreamDecoder()
+    decoder.feed(FRAMES[0] + FRAMES[1][:5])
+    assert decoder.pending_bytes == 5
+    assert decoder.discard_partial() == 5
+    assert decoder.feed(FRAMES[1]) == [TextDelta("lo")]
+    assert decoder.text == "Hello"
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""SessionRouter 离线测试（不需要启动服务）"""
+
+from kiro_proxy.core.account import Account
+from kiro_proxy.core.account_registry import AccountRegistry
+from kiro_proxy.core.session_router import SessionRouter
+
+
+def _router(*account_ids: str) -> SessionRouter:
+    registry = AccountRegistry()
+    for account_id in account_ids:
+        registry.add(Account(id=account_id, name=account_id, token_path=f"/nonexistent/{account_id}.json"))
+    return SessionRouter(registry)
+
+
+def _saturate(router: SessionRouter, account_id: str):
+    for _ in range(router.config.saturation_inflight):
+        router.registry.stream_started(account_id)
+
+
+def test_sticky_session():
+    router = _router("a", "b")
+    first = router.route("sess")
+    assert first is not None
+    assert router.route("sess") is first
+
+
+def test_saturated_single_account_still_routed():
+    router = _router("a")
+    assert router.route("sess").id == "a"
+    _saturate(router, "a")
+    # 没有其他账号可切换时，饱和的粘性账号仍然可用，不应返回 None（503）
+    assert router.route("sess").id == "a"
+    assert router.route("other").id == "a"
+
+
+def test_saturated_sticky_account_falls_back():
+    router = _router("a", "b")
+    sticky = router.route("sess")
+    _saturate(router, sticky.id)
+    fallback = router.route("sess")
+    assert fallback is not None and fallback.id != sticky.id
+    assert router.fallbacks == 1
+
+
+def test_disabled_sticky_account_not_reused():
+    router = _router("a")
+    account = router.route("sess")
+    account.enabled = False
+    assert router.route("sess") is None